@@ -0,0 +1,361 @@
+"""
+bench_codec.py
+
+Micro-benchmarks for the LoRaWAN frame layer.
+
+Runs on a PC with CPython, using the Host stand-ins for aesio etc:-
+
+    python3 Benchmarks/bench_codec.py [-n iterations] [-k name filter]
+
+and on a CircuitPython device: copy this file to CIRCUITPY (alongside settings.json
+and the lib folder) and run it from the REPL with:-
+
+    import bench_codec
+
+The device run uses fewer iterations, see DEVICE_ITERATIONS.
+
+For each benchmark it reports:-
+
+    ops/s       operations per second
+    us/op       microseconds per operation
+    alloc/op    bytes allocated per operation, temporaries included. On the device measured
+                with the garbage collector disabled (gc.mem_alloc()). CPython frees most
+                objects as soon as they are unreferenced so on the host each bytecode of the
+                operation is traced and the growth of the tracemalloc peak between them
+                added up, less the cost of tracing itself. Several temporaries made and freed
+                inside one call to C code count as the largest of them
+    retained/op bytes still held after the operations (tracemalloc snapshot difference)
+                e.g. caches and leaks. Host only, the device shows '-'
+    peak        the most memory in use above the starting point during one operation
+                (tracemalloc on CPython, gc.mem_alloc() on the device)
+
+Nothing is written to NVM, MAC command parsing uses a MAC_commands with its cache
+kept in RAM.
+"""
+
+import sys
+import time
+import gc
+import json
+from array import array
+
+ON_DEVICE = sys.implementation.name == "circuitpython"
+
+HOST_ITERATIONS = 2000
+DEVICE_ITERATIONS = 50
+
+# operations traced for the host alloc/op, tracing every bytecode is slow
+HOST_TRACED_OPS = 10
+
+if ON_DEVICE:
+    SETTINGS = "settings.json"
+    tracemalloc = None
+else:
+    import os
+    import types
+    import tracemalloc
+
+    ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    LIB = os.path.join(ROOT, "src", "lib", "lorawan")
+    SETTINGS = os.path.join(ROOT, "Example", "settings.json")
+
+    # Host/ provides aesio, LogManager and microcontroller
+    sys.path.insert(0, os.path.join(ROOT, "Host"))
+
+    # lorawan/__init__.py imports the radio code, which needs the board module,
+    # so register the package without running it. Only the codec and MAChandler are used.
+    lorawan = types.ModuleType("lorawan")
+    lorawan.__path__ = [LIB]
+    sys.modules["lorawan"] = lorawan
+
+from lorawan.LoRaWAN import new, release, encode_uplink
+from lorawan.LoRaWAN.MHDR import MHDR
+from lorawan.LoRaWAN.Direction import Direction
+from lorawan.LoRaWAN.FrameDecoder import DownlinkFrame
+from lorawan.LoRaWAN.Keystream import Keystream, KEYSTREAM_BLOCKS
+from lorawan.LoRaWAN.AES_CMAC import get_cmac, get_cipher
+from lorawan.MAChandler import MAC_commands
+
+# test keys, the same as the TTN console would show them
+APPKEY = bytes(range(0x10, 0x20))
+NWKSKEY = bytes(range(0x20, 0x30))
+APPSKEY = bytes(range(0x30, 0x40))
+DEVADDR = [0x26, 0x0B, 0x12, 0x34]      # big endian
+DEVADDR_LE = bytes(reversed(DEVADDR))
+DEVEUI = list(range(8))
+APPEUI = list(range(8, 16))
+DEVNONCE = [0x12, 0x34]
+
+UPLINK_SIZES = (1, 11, 51, 115, 222)
+DOWNLINK_SIZES = (0, 11, 51)
+
+#############################################################################
+# frame builders - not timed
+#############################################################################
+
+def _join_accept(withCFList=False):
+    """a join accept, encrypted the way a network server does (AES decrypt)"""
+    clear = bytearray([0x01, 0x02, 0x03, 0x13, 0x00, 0x00]) + DEVADDR_LE + bytearray([0x03, 0x01])
+    if withCFList:
+        clear += bytearray(16)
+    mic = get_cmac(APPKEY).digest(bytes([MHDR.JOIN_ACCEPT]) + clear)[:4]
+    block = bytes(clear + mic)
+    cipher = get_cipher(APPKEY)
+    out = bytearray(len(block))
+    if hasattr(cipher, "decrypt_into"):
+        cipher.decrypt_into(block, out)
+        return bytearray([MHDR.JOIN_ACCEPT]) + out
+    # aesio on the device can only encrypt, decryption is not timed so any
+    # 16/32 bytes will do. The MIC won't match but all the work is still done.
+    return bytearray([MHDR.JOIN_ACCEPT]) + block
+
+def _downlink(size, fopts=b""):
+    """a data downlink with size bytes of FRMPayload (no FPort if size is 0)"""
+    buf = bytearray(256)
+    n = encode_uplink(buf, NWKSKEY, APPSKEY, DEVADDR, 7, bytes(range(size)),
+                      fport=1 if size else None, fopts=fopts, mtype=MHDR.UNCONF_DATA_DOWN)
+    # encode_uplink computes an uplink MIC, redo it for a downlink
+    b0 = bytearray([0x49, 0, 0, 0, 0, Direction.DOWN]) + DEVADDR_LE + bytearray([7, 0, 0, 0, 0, n - 4])
+    mic = get_cmac(NWKSKEY).digest(buf, n - 4, b0)
+    buf[n - 4:n] = mic[:4]
+    return buf[:n]
+
+class _BenchMAC(MAC_commands):
+    """MAC_commands with the NVM cache disabled"""
+
+    def loadCache(self):
+        return False
+
+    def saveCache(self):
+        pass
+
+#############################################################################
+# benchmarks - each returns a function which performs one operation
+#############################################################################
+
+def bench_join_request():
+    def op():
+        msg = new(APPKEY)
+        msg.create(MHDR.JOIN_REQUEST, {'deveui': DEVEUI, 'appeui': APPEUI, 'devnonce': DEVNONCE})
+        msg.to_raw()
+        release(msg)
+    return op
+
+def bench_join_accept(withCFList=False):
+    packet = _join_accept(withCFList)
+    def op():
+        msg = new([], APPKEY)
+        msg.read(packet)
+        msg.get_payload()
+        msg.valid_mic()
+        msg.get_devaddr()
+        msg.derive_nwskey(DEVNONCE)
+        msg.derive_appskey(DEVNONCE)
+        release(msg)
+    return op
+
+def bench_uplink(size, keystream=False):
+    buf = bytearray(256)
+    payload = bytes(range(size))
+    ks = None
+    if keystream:
+        # normally done in the idle time after the previous uplink so not timed.
+        # It stays valid as long as the payload fits in the precomputed blocks
+        ks = Keystream()
+        ks.precompute(APPSKEY, Direction.UP, DEVADDR_LE, 1)
+    def op():
+        encode_uplink(buf, NWKSKEY, APPSKEY, DEVADDR, 1, payload, keystream=ks)
+    return op
+
+def bench_uplink_legacy(size):
+    payload = list(range(size))
+    def op():
+        msg = new(NWKSKEY, APPSKEY)
+        msg.create(MHDR.UNCONF_DATA_UP, {'devaddr': DEVADDR, 'fcnt': 1, 'data': payload, 'fport': 1})
+        msg.to_raw()
+        release(msg)
+    return op
+
+def bench_downlink(size):
+    packet = _downlink(size)
+    frame = DownlinkFrame()
+    out = bytearray(256)
+    devaddr = int.from_bytes(bytes(DEVADDR), "big")
+    def op():
+        frame.wrap(packet)
+        if frame.is_valid() and frame.is_for(devaddr) and frame.valid_mic(NWKSKEY):
+            if frame.fport is not None:
+                frame.decrypt(APPSKEY, out)
+    return op
+
+def bench_mac_commands():
+    with open(SETTINGS, "r") as f:
+        config = json.loads(f.read())
+    mac = _BenchMAC(config)
+    # LinkADRReq, DutyCycleReq, RXTimingSetupReq, DevStatusReq in FOpts
+    fopts = bytes([0x03, 0x52, 0x00, 0xFF, 0x01, 0x04, 0x00, 0x08, 0x01, 0x06])
+    frame = DownlinkFrame(_downlink(0, fopts))
+    def op():
+        mac.handleCommand(frame)
+    return op
+
+def benchmarks():
+    """name, setup function and args"""
+    b = [("join request build", bench_join_request, ()),
+         ("join accept decrypt+keys", bench_join_accept, (False,)),
+         ("join accept+cflist decrypt+keys", bench_join_accept, (True,))]
+    for size in UPLINK_SIZES:
+        b.append((f"uplink encode {size}B", bench_uplink, (size,)))
+    for size in UPLINK_SIZES:
+        if size <= 16 * KEYSTREAM_BLOCKS:
+            b.append((f"uplink encode {size}B keystream", bench_uplink, (size, True)))
+    for size in (11, 51):
+        b.append((f"uplink PhyPayload {size}B", bench_uplink_legacy, (size,)))
+    for size in DOWNLINK_SIZES:
+        b.append((f"downlink decode+MIC {size}B", bench_downlink, (size,)))
+    b.append(("MAC command parsing (4 cmds)", bench_mac_commands, ()))
+    return b
+
+#############################################################################
+# measurement
+#############################################################################
+
+def _time(op, iterations):
+    gc.collect()
+    start = time.monotonic_ns()
+    for _ in range(iterations):
+        op()
+    return time.monotonic_ns() - start
+
+def _traced(op, ops):
+    """
+    host only: bytes allocated by ops calls of op, and the number of Python
+    function calls traced
+
+    Tracing gets the tracemalloc peak before each bytecode and resets it, so
+    memory allocated and freed again in between still counts. Nothing the
+    tracer keeps is allocated after the peak is reset.
+    """
+    get = tracemalloc.get_traced_memory
+    reset = tracemalloc.reset_peak
+    counts = array("q", [0, 0, 0])     # bytes allocated, memory in use at the last reset, calls
+
+    def tracer(frame, event, arg):
+        frame.f_trace_opcodes = True
+        traced = get()
+        counts[0] += max(traced[1] - counts[1], 0)
+        counts[1] = traced[0]
+        if event == "call":
+            counts[2] += 1
+        del traced
+        reset()
+        return tracer
+
+    tracemalloc.start()
+    try:
+        counts[1] = get()[0]
+        reset()
+        sys.settrace(tracer)
+        try:
+            for _ in range(ops):
+                op()
+        finally:
+            sys.settrace(None)
+    finally:
+        tracemalloc.stop()
+    return counts[0], counts[2]
+
+def _nothing():
+    pass
+
+def _call_nothing():
+    for _ in range(100):
+        _nothing()
+
+def _tracing_cost():
+    """
+    host only: (bytes, bytes per function call) which _traced() counts that the
+    operation didn't allocate, e.g. the frame objects tracing creates
+    """
+    fixed = _traced(_nothing, 1)[0]
+    allocated, calls = _traced(_call_nothing, 1)
+    return fixed, (allocated - fixed) / (calls - 1)
+
+def _memory(op, iterations, cost=None):
+    """
+    return (bytes allocated per op or None, bytes retained per op or None, peak bytes during one op)
+
+    :param cost: host only, from _tracing_cost()
+    """
+    gc.collect()
+    if ON_DEVICE:
+        gc.disable()
+        try:
+            base = gc.mem_alloc()
+            op()
+            peak = gc.mem_alloc() - base
+            for _ in range(iterations - 1):
+                op()
+            alloc = (gc.mem_alloc() - base) // iterations
+        except MemoryError:
+            alloc = None
+        finally:
+            gc.enable()
+            gc.collect()
+        return alloc, None, peak
+
+    ops = min(iterations, HOST_TRACED_OPS)
+    fixed, perCall = cost
+    allocated, calls = _traced(op, ops)
+    alloc = max(int((allocated - fixed - calls * perCall) / ops), 0)
+
+    # leave out tracemalloc's own allocations, e.g. the snapshots
+    ignore = (tracemalloc.Filter(False, tracemalloc.__file__),)
+    tracemalloc.start()
+    try:
+        base = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        op()
+        peak = tracemalloc.get_traced_memory()[1] - base
+        before = tracemalloc.take_snapshot().filter_traces(ignore)
+        for _ in range(iterations):
+            op()
+        after = tracemalloc.take_snapshot().filter_traces(ignore)
+    finally:
+        tracemalloc.stop()
+    stats = after.compare_to(before, "filename")
+    # less than 0 if the warm up left something which has since been freed
+    retained = max(sum(stat.size_diff for stat in stats) // iterations, 0)
+    return alloc, retained, peak
+
+def run(iterations=None, nameFilter=None):
+    if iterations is None:
+        iterations = DEVICE_ITERATIONS if ON_DEVICE else HOST_ITERATIONS
+
+    print(f"{sys.implementation.name} {sys.version} iterations={iterations}")
+    print(f"{'benchmark':<34}{'ops/s':>10}{'us/op':>10}{'alloc/op':>10}{'retained/op':>12}{'peak':>8}")
+
+    cost = None if ON_DEVICE else _tracing_cost()
+
+    for name, setup, args in benchmarks():
+        if nameFilter and nameFilter not in name:
+            continue
+        op = setup(*args)
+        op() # warm up: fills the cipher context cache, first use allocations
+        elapsed = _time(op, iterations)
+        alloc, retained, peak = _memory(op, iterations, cost)
+        usPerOp = elapsed / iterations / 1000
+        opsPerSec = iterations * 1000000000 / elapsed if elapsed else 0
+        allocStr = "-" if alloc is None else str(alloc)
+        retainedStr = "-" if retained is None else str(retained)
+        print(f"{name:<34}{opsPerSec:>10.0f}{usPerOp:>10.1f}{allocStr:>10}{retainedStr:>12}{peak:>8}")
+
+if ON_DEVICE:
+    run()
+elif __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="LoRaWAN codec micro-benchmarks")
+    parser.add_argument("-n", "--iterations", type=int, default=HOST_ITERATIONS)
+    parser.add_argument("-k", "--filter", default=None, help="only run benchmarks whose name contains this")
+    cmd = parser.parse_args()
+    run(cmd.iterations, cmd.filter)
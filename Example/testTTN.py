@@ -49,8 +49,6 @@ LogMan.setAllLoggerLevels(LogMan.NOTSET) # record ALL log messages
 # create the LoRaWAN handler
 LW = Handler("settings.json")
 
-DUTY_CYCLE_PERCENT=LW.getDutyCycle() # is based on join frequency
-DUTY_WAIT=100-DUTY_CYCLE_PERCENT
         
 def downlinkCallback(msg,mtype,fport):
     # downlinks are sent ONLY after an uplink
@@ -80,15 +78,14 @@ def joinTTN(retries):
 
 # try to join TTN and send messages (uplinks)
 
-totalAirTime=0
-
 if joinTTN(JOIN_RETRIES):
         
     print("\nJOINED TTN")
 
     for i in range(0, NUM_MESSAGES_TO_SEND):
         # prepare your message here
-        # use LW.sendbytes for binary data
+        # use LW.sendbytes for binary data. Text is used here to keep the example
+        # simple, lorawan/PayloadCodec.py packs sensor readings into far fewer bytes
         msg=f"Hello World {i}"
         
         print("Sending {msg}")
@@ -102,24 +99,23 @@ if joinTTN(JOIN_RETRIES):
         # though there is a limit defined by the Lora Alliance
         # the default is fport 1. Stay below fport 200.
         
-        if i==NUM_MESSAGES_TO_SEND:
-            # no need to wait for DUTY_CYCLE
-            break
-        
-        LW.send(f"Hello World {i}") # send on fport 1
+        # queue the message, it is sent as soon as the regional duty cycle allows.
+        # LW.queue(msg,port,priority,deadline,key) can hold several messages,
+        # the highest priority is sent first
+        LW.queue(msg) # send on fport 1
         
-        # observe duty cycle limits
-        # in reality your messages would be very short and
-        # be sent intermittently
-        print("Observing legal duty cycle limitation")
+        # flush() waits for the duty cycle before each uplink so there is no
+        # need to sleep here. In your program loop you could call LW.sendQueued()
+        # instead, it only sends if the duty cycle allows it now
+        LW.flush()
         LastAirTime=LW.lastAirTime()
-        
-        time.sleep(DUTY_WAIT*LW.lastAirTime())
 
-        # TTN FUP is 30s per day
+        # TTN FUP is 30s of uplinks and 10 downlinks per day
+        # the handler keeps track of both over the last 24 hours. With "fair_use": 1
+        # in settings.json it also refuses, or the queue defers, uplinks over the limit
         print("Checking TTN FUP")
-        totalAirTime+=LastAirTime
-        if totalAirTime>=30:
+        airTimeLeft,downlinksLeft=LW.getFairUseRemaining()
+        if airTimeLeft<LastAirTime:
             print("TTN FUP limit reached")
             break
 
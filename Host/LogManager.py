@@ -0,0 +1,57 @@
+"""
+LogManager.py
+
+Host (CPython) version of src/lib/LogManager.py. The CircuitPython version needs
+adafruit_logging.mpy which CPython cannot load, this one provides the same LogMan
+interface on top of the standard logging module.
+
+DO NOT copy this file to a CircuitPython device.
+"""
+import logging
+import sys
+
+class LogMan:
+
+    stream=sys.stderr
+    handler=logging.StreamHandler(sys.stderr)
+    loggers={}
+
+    # logging levels
+    NOTSET=logging.NOTSET
+    DEBUG=logging.DEBUG
+    INFO=logging.INFO
+    WARNING=logging.WARNING
+    ERROR=logging.ERROR
+    CRITICAL=logging.CRITICAL
+
+    @staticmethod
+    def setNullHandler():
+        LogMan.handler=logging.NullHandler()
+
+    @staticmethod
+    def restoreLastHandler():
+        LogMan.handler=logging.StreamHandler(LogMan.stream)
+
+    @staticmethod
+    def setFileStream(filename,mode="a"):
+        LogMan.stream=open(filename,mode)
+        LogMan.handler=logging.StreamHandler(LogMan.stream)
+
+    @staticmethod
+    def getLogger(name,level=logging.WARNING):
+        log=logging.getLogger(name)
+        if LogMan.handler not in log.handlers:
+            log.addHandler(LogMan.handler)
+        log.setLevel(level)
+        LogMan.loggers[name]=log
+        return log
+
+    @staticmethod
+    def setAllLoggerLevels(newLevel):
+        for log in LogMan.loggers:
+            LogMan.loggers[log].setLevel(newLevel)
+
+    @staticmethod
+    def close():
+        if LogMan.stream not in (sys.stderr,sys.stdout):
+            LogMan.stream.close()
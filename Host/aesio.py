@@ -0,0 +1,304 @@
+"""
+aesio.py
+
+A pure Python stand-in for the CircuitPython aesio module so that the LoRaWAN
+codec can be run (and timed) on a Linux/Windows host with CPython.
+
+Only what the library needs is provided:- AES(key, mode, IV), MODE_ECB/CBC/CTR,
+encrypt_into(), decrypt_into() and rekey(). Keys may be 16, 24 or 32 bytes.
+
+Block encryption uses the usual four 256 entry T-tables so each round is 16 table
+lookups and some XORs rather than the byte-wise SubBytes/ShiftRows/MixColumns.
+
+If numpy is installed AES.encrypt_blocks() encrypts many 16 byte blocks in one go
+which is what the batch decoder uses. Without numpy it falls back to a loop.
+
+DO NOT copy this file to a CircuitPython device - aesio is built into the firmware.
+"""
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+MODE_ECB = 1
+MODE_CBC = 2
+MODE_CTR = 6
+
+############################################# table generation #############################################
+
+
+def _xtime(a):
+    a <<= 1
+    if a & 0x100:
+        a ^= 0x11B
+    return a
+
+
+def _mul(a, b):
+    r = 0
+    while b:
+        if b & 1:
+            r ^= a
+        a = _xtime(a)
+        b >>= 1
+    return r
+
+
+def _make_sbox():
+    sbox = [0] * 256
+    inv = [0] * 256
+    for x in range(256):
+        # multiplicative inverse in GF(2^8), 0 maps to 0
+        y = 0
+        if x:
+            for c in range(1, 256):
+                if _mul(x, c) == 1:
+                    y = c
+                    break
+        # affine transform
+        s = y
+        for i in range(1, 5):
+            s ^= ((y << i) | (y >> (8 - i))) & 0xFF
+        s ^= 0x63
+        sbox[x] = s
+        inv[s] = x
+    return sbox, inv
+
+
+_SBOX, _INV_SBOX = _make_sbox()
+
+
+def _rot(w):
+    return ((w >> 8) | (w << 24)) & 0xFFFFFFFF
+
+
+def _make_tables(sbox, coef):
+    t0 = []
+    for x in range(256):
+        s = sbox[x]
+        t0.append((_mul(s, coef[0]) << 24) | (_mul(s, coef[1]) << 16) | (_mul(s, coef[2]) << 8) | _mul(s, coef[3]))
+    t1 = [_rot(w) for w in t0]
+    t2 = [_rot(w) for w in t1]
+    t3 = [_rot(w) for w in t2]
+    return t0, t1, t2, t3
+
+
+_TE0, _TE1, _TE2, _TE3 = _make_tables(_SBOX, (2, 1, 1, 3))
+_TD0, _TD1, _TD2, _TD3 = _make_tables(_INV_SBOX, (14, 9, 13, 11))
+
+_RCON = [0x01, 0x02, 0x04, 0x08, 0x10, 0x20, 0x40, 0x80, 0x1B, 0x36]
+
+_BLOCK = 16
+
+############################################# the AES class #############################################
+
+
+class AES:
+    """
+    Same interface as the CircuitPython aesio.AES class
+    """
+
+    def __init__(self, key, mode=MODE_ECB, IV=None, segment_size=8):
+        self.mode = mode
+        self.rekey(key, IV)
+
+    def rekey(self, key, IV=None):
+        key = bytes(key)
+        if len(key) not in (16, 24, 32):
+            raise ValueError("Key length must be 16, 24 or 32 bytes")
+        if self.mode not in (MODE_ECB, MODE_CBC, MODE_CTR):
+            raise NotImplementedError("Requested AES mode is unsupported")
+        if self.mode != MODE_ECB:
+            if IV is None or len(IV) != _BLOCK:
+                raise ValueError("IV must be 16 bytes")
+            self._iv = bytearray(IV)
+        self._ek = self._expand(key)
+        self._dk = self._inverse(self._ek)
+        self._rounds = len(self._ek) // 4 - 1
+        self._npk = None
+
+    #########################
+    # key schedule
+
+    def _expand(self, key):
+        nk = len(key) // 4
+        rounds = nk + 6
+        w = [int.from_bytes(key[4 * i:4 * i + 4], "big") for i in range(nk)]
+        for i in range(nk, 4 * (rounds + 1)):
+            t = w[i - 1]
+            if i % nk == 0:
+                t = ((t << 8) | (t >> 24)) & 0xFFFFFFFF
+                t = (_SBOX[t >> 24] << 24) | (_SBOX[(t >> 16) & 0xFF] << 16) | (_SBOX[(t >> 8) & 0xFF] << 8) | _SBOX[t & 0xFF]
+                t ^= _RCON[i // nk - 1] << 24
+            elif nk > 6 and i % nk == 4:
+                t = (_SBOX[t >> 24] << 24) | (_SBOX[(t >> 16) & 0xFF] << 16) | (_SBOX[(t >> 8) & 0xFF] << 8) | _SBOX[t & 0xFF]
+            w.append(w[i - nk] ^ t)
+        return w
+
+    def _inverse(self, ek):
+        # equivalent inverse cipher: reverse the round keys and apply InvMixColumns to the middle ones
+        rounds = len(ek) // 4 - 1
+        dk = []
+        for r in range(rounds, -1, -1):
+            for c in range(4):
+                w = ek[4 * r + c]
+                if 0 < r < rounds:
+                    w = _TD0[_SBOX[w >> 24]] ^ _TD1[_SBOX[(w >> 16) & 0xFF]] ^ _TD2[_SBOX[(w >> 8) & 0xFF]] ^ _TD3[_SBOX[w & 0xFF]]
+                dk.append(w)
+        return dk
+
+    #########################
+    # single block primitives
+
+    def _encrypt_block(self, src, dst, s=0, d=0):
+        k = self._ek
+        te0, te1, te2, te3 = _TE0, _TE1, _TE2, _TE3
+        s0 = ((src[s] << 24) | (src[s + 1] << 16) | (src[s + 2] << 8) | src[s + 3]) ^ k[0]
+        s1 = ((src[s + 4] << 24) | (src[s + 5] << 16) | (src[s + 6] << 8) | src[s + 7]) ^ k[1]
+        s2 = ((src[s + 8] << 24) | (src[s + 9] << 16) | (src[s + 10] << 8) | src[s + 11]) ^ k[2]
+        s3 = ((src[s + 12] << 24) | (src[s + 13] << 16) | (src[s + 14] << 8) | src[s + 15]) ^ k[3]
+        i = 4
+        for _ in range(self._rounds - 1):
+            t0 = te0[s0 >> 24] ^ te1[(s1 >> 16) & 0xFF] ^ te2[(s2 >> 8) & 0xFF] ^ te3[s3 & 0xFF] ^ k[i]
+            t1 = te0[s1 >> 24] ^ te1[(s2 >> 16) & 0xFF] ^ te2[(s3 >> 8) & 0xFF] ^ te3[s0 & 0xFF] ^ k[i + 1]
+            t2 = te0[s2 >> 24] ^ te1[(s3 >> 16) & 0xFF] ^ te2[(s0 >> 8) & 0xFF] ^ te3[s1 & 0xFF] ^ k[i + 2]
+            t3 = te0[s3 >> 24] ^ te1[(s0 >> 16) & 0xFF] ^ te2[(s1 >> 8) & 0xFF] ^ te3[s2 & 0xFF] ^ k[i + 3]
+            s0, s1, s2, s3 = t0, t1, t2, t3
+            i += 4
+        sb = _SBOX
+        for c, (a, b, e, f) in enumerate(((s0, s1, s2, s3), (s1, s2, s3, s0), (s2, s3, s0, s1), (s3, s0, s1, s2))):
+            w = k[i + c]
+            dst[d + 4 * c] = sb[a >> 24] ^ (w >> 24)
+            dst[d + 4 * c + 1] = sb[(b >> 16) & 0xFF] ^ ((w >> 16) & 0xFF)
+            dst[d + 4 * c + 2] = sb[(e >> 8) & 0xFF] ^ ((w >> 8) & 0xFF)
+            dst[d + 4 * c + 3] = sb[f & 0xFF] ^ (w & 0xFF)
+
+    def _decrypt_block(self, src, dst, s=0, d=0):
+        k = self._dk
+        td0, td1, td2, td3 = _TD0, _TD1, _TD2, _TD3
+        s0 = ((src[s] << 24) | (src[s + 1] << 16) | (src[s + 2] << 8) | src[s + 3]) ^ k[0]
+        s1 = ((src[s + 4] << 24) | (src[s + 5] << 16) | (src[s + 6] << 8) | src[s + 7]) ^ k[1]
+        s2 = ((src[s + 8] << 24) | (src[s + 9] << 16) | (src[s + 10] << 8) | src[s + 11]) ^ k[2]
+        s3 = ((src[s + 12] << 24) | (src[s + 13] << 16) | (src[s + 14] << 8) | src[s + 15]) ^ k[3]
+        i = 4
+        for _ in range(self._rounds - 1):
+            t0 = td0[s0 >> 24] ^ td1[(s3 >> 16) & 0xFF] ^ td2[(s2 >> 8) & 0xFF] ^ td3[s1 & 0xFF] ^ k[i]
+            t1 = td0[s1 >> 24] ^ td1[(s0 >> 16) & 0xFF] ^ td2[(s3 >> 8) & 0xFF] ^ td3[s2 & 0xFF] ^ k[i + 1]
+            t2 = td0[s2 >> 24] ^ td1[(s1 >> 16) & 0xFF] ^ td2[(s0 >> 8) & 0xFF] ^ td3[s3 & 0xFF] ^ k[i + 2]
+            t3 = td0[s3 >> 24] ^ td1[(s2 >> 16) & 0xFF] ^ td2[(s1 >> 8) & 0xFF] ^ td3[s0 & 0xFF] ^ k[i + 3]
+            s0, s1, s2, s3 = t0, t1, t2, t3
+            i += 4
+        sb = _INV_SBOX
+        for c, (a, b, e, f) in enumerate(((s0, s3, s2, s1), (s1, s0, s3, s2), (s2, s1, s0, s3), (s3, s2, s1, s0))):
+            w = k[i + c]
+            dst[d + 4 * c] = sb[a >> 24] ^ (w >> 24)
+            dst[d + 4 * c + 1] = sb[(b >> 16) & 0xFF] ^ ((w >> 16) & 0xFF)
+            dst[d + 4 * c + 2] = sb[(e >> 8) & 0xFF] ^ ((w >> 8) & 0xFF)
+            dst[d + 4 * c + 3] = sb[f & 0xFF] ^ (w & 0xFF)
+
+    #########################
+    # aesio interface
+
+    def _check(self, src, dest):
+        if len(src) != len(dest):
+            raise ValueError("Source and dest buffers must be the same length")
+        if self.mode != MODE_CTR and len(src) % _BLOCK:
+            raise ValueError("Buffer must be a multiple of 16 bytes")
+
+    def encrypt_into(self, src, dest):
+        """encrypt src into dest. Both buffers must be the same length"""
+        self._check(src, dest)
+        n = len(src)
+        if self.mode == MODE_ECB:
+            for o in range(0, n, _BLOCK):
+                self._encrypt_block(src, dest, o, o)
+        elif self.mode == MODE_CBC:
+            iv = self._iv
+            blk = bytearray(_BLOCK)
+            for o in range(0, n, _BLOCK):
+                for i in range(_BLOCK):
+                    blk[i] = src[o + i] ^ iv[i]
+                self._encrypt_block(blk, dest, 0, o)
+                iv[:] = dest[o:o + _BLOCK]
+        else:
+            self._ctr(src, dest)
+
+    def decrypt_into(self, src, dest):
+        """decrypt src into dest. Both buffers must be the same length"""
+        self._check(src, dest)
+        n = len(src)
+        if self.mode == MODE_ECB:
+            for o in range(0, n, _BLOCK):
+                self._decrypt_block(src, dest, o, o)
+        elif self.mode == MODE_CBC:
+            iv = self._iv
+            nxt = bytearray(_BLOCK)
+            for o in range(0, n, _BLOCK):
+                nxt[:] = src[o:o + _BLOCK]
+                self._decrypt_block(src, dest, o, o)
+                for i in range(_BLOCK):
+                    dest[o + i] ^= iv[i]
+                iv[:] = nxt
+        else:
+            self._ctr(src, dest)
+
+    def _ctr(self, src, dest):
+        ctr = self._iv
+        ks = bytearray(_BLOCK)
+        for o in range(0, len(src), _BLOCK):
+            self._encrypt_block(ctr, ks)
+            for i in range(min(_BLOCK, len(src) - o)):
+                dest[o + i] = src[o + i] ^ ks[i]
+            # big endian increment of the counter block
+            for i in range(_BLOCK - 1, -1, -1):
+                ctr[i] = (ctr[i] + 1) & 0xFF
+                if ctr[i]:
+                    break
+
+    #########################
+    # host only extension
+
+    def encrypt_blocks(self, src, dest):
+        """
+        ECB encrypt a whole buffer of 16 byte blocks. Uses numpy to process all the blocks
+        in parallel when it is available otherwise loops over the blocks.
+
+        Not part of aesio - callers should check with hasattr() first.
+        """
+        if len(src) % _BLOCK or len(src) != len(dest):
+            raise ValueError("Buffers must be the same length and a multiple of 16 bytes")
+        if np is None or len(src) < 8 * _BLOCK:
+            for o in range(0, len(src), _BLOCK):
+                self._encrypt_block(src, dest, o, o)
+            return
+        if self._npk is None:
+            global _NP_TE, _NP_SBOX
+            if _NP_TE is None:
+                _NP_TE = [np.array(t, dtype=np.uint32) for t in (_TE0, _TE1, _TE2, _TE3)]
+                _NP_SBOX = np.array(_SBOX, dtype=np.uint32)
+            self._npk = np.array(self._ek, dtype=np.uint32).reshape(-1, 4)
+        te0, te1, te2, te3 = _NP_TE
+        k = self._npk
+        st = np.frombuffer(bytes(src), dtype=">u4").astype(np.uint32).reshape(-1, 4) ^ k[0]
+        for r in range(1, self._rounds):
+            s0, s1, s2, s3 = st[:, 0], st[:, 1], st[:, 2], st[:, 3]
+            st = np.stack((
+                te0[s0 >> 24] ^ te1[(s1 >> 16) & 0xFF] ^ te2[(s2 >> 8) & 0xFF] ^ te3[s3 & 0xFF],
+                te0[s1 >> 24] ^ te1[(s2 >> 16) & 0xFF] ^ te2[(s3 >> 8) & 0xFF] ^ te3[s0 & 0xFF],
+                te0[s2 >> 24] ^ te1[(s3 >> 16) & 0xFF] ^ te2[(s0 >> 8) & 0xFF] ^ te3[s1 & 0xFF],
+                te0[s3 >> 24] ^ te1[(s0 >> 16) & 0xFF] ^ te2[(s1 >> 8) & 0xFF] ^ te3[s2 & 0xFF],
+            ), axis=1) ^ k[r]
+        sb = _NP_SBOX
+        s0, s1, s2, s3 = st[:, 0], st[:, 1], st[:, 2], st[:, 3]
+        out = np.stack((
+            (sb[s0 >> 24] << 24) | (sb[(s1 >> 16) & 0xFF] << 16) | (sb[(s2 >> 8) & 0xFF] << 8) | sb[s3 & 0xFF],
+            (sb[s1 >> 24] << 24) | (sb[(s2 >> 16) & 0xFF] << 16) | (sb[(s3 >> 8) & 0xFF] << 8) | sb[s0 & 0xFF],
+            (sb[s2 >> 24] << 24) | (sb[(s3 >> 16) & 0xFF] << 16) | (sb[(s0 >> 8) & 0xFF] << 8) | sb[s1 & 0xFF],
+            (sb[s3 >> 24] << 24) | (sb[(s0 >> 16) & 0xFF] << 16) | (sb[(s1 >> 8) & 0xFF] << 8) | sb[s2 & 0xFF],
+        ), axis=1) ^ k[self._rounds]
+        dest[:] = out.astype(">u4").tobytes()
+
+
+_NP_TE = None
+_NP_SBOX = None
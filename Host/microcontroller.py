@@ -0,0 +1,11 @@
+"""
+microcontroller.py
+
+Host (CPython) stand-in for the CircuitPython microcontroller module. Only nvm is
+provided, as a RAM bytearray which starts erased (0xFF) like unwritten flash, so
+MAChandler can be imported. Nothing is kept between runs.
+
+DO NOT copy this file to a CircuitPython device.
+"""
+
+nvm = bytearray(b"\xff" * 8192)
@@ -54,6 +54,12 @@ try:
     ttnPort=config["settings"]["port"]
     ttnKeepAlive=config["settings"]["keepAlive"]
 
+    # FPort the device sends aggregated records on, see lorawan/Aggregator.py
+    aggregatePort=config["settings"].get("aggregate_port",100)
+
+    # FPort: list of fields, must match the device's lorawan/PayloadCodec.py schema
+    payloadSchemas={int(port):fields for port,fields in config.get("payload_schemas",{}).items()}
+
 except KeyError as e:
     raise Exception(f"Config file entry missing: {e}")
 
@@ -67,6 +73,90 @@ except Exception as e:\
 #
 
 
+def unpackRecords(payload):
+    """
+    split an aggregated uplink into its records
+
+    :param payload: bytes, [length:1][record:length]... as packed by lorawan/Aggregator.py
+    :return: list of bytes
+    """
+    records=[]
+    i=0
+    while i<len(payload):
+        end=i+1+payload[i]
+        if end>len(payload):
+            raise ValueError(f"record at offset {i} runs past the end of the payload")
+        records.append(payload[i+1:end])
+        i=end
+    return records
+
+class BitReader:
+    """reads the bit packed fields written by lorawan/PayloadCodec.py, MSB first"""
+
+    def __init__(self,data):
+        self.data=data
+        self.pos=0 # bits read
+
+    def read(self,bits):
+        if self.pos+bits>8*len(self.data):
+            raise ValueError("payload too short for the schema")
+        value=0
+        for i in range(bits):
+            byte=self.data[(self.pos+i)>>3]
+            value=(value<<1)|((byte>>(7-((self.pos+i)&7)))&1)
+        self.pos+=bits
+        return value
+
+    def readVarint(self):
+        value=0
+        shift=0
+        while True:
+            more=self.read(1)
+            value|=self.read(7)<<shift
+            shift+=7
+            if not more:
+                return value
+
+def unzigzag(value):
+    return (value>>1) if not value&1 else -((value+1)>>1)
+
+# (device_id,f_port): (sequence,fields) of the last frame decoded, the base for delta frames
+lastFrames={}
+
+def decodePayload(payload,schema,key):
+    """
+    mirror of PayloadEncoder.encode() in lorawan/PayloadCodec.py
+
+    :param payload: bytes
+    :param schema: list of field dicts (name, bits, scale, offset, delta_bits)
+    :param key: identifies the sender, delta frames are decoded against its last frame
+    :return: dict of name: value
+    """
+    r=BitReader(payload)
+    header=r.read(8)
+    sequence=header&0x7F
+    delta=header&0x80
+
+    if delta:
+        last=lastFrames.get(key)
+        if last is None or last[0]!=((sequence-1)&0x7F):
+            lastFrames.pop(key,None)
+            raise ValueError(f"delta frame {sequence} but the frame before it was not received, waiting for a key frame")
+        lastFields=last[1]
+
+    fields=[]
+    for i,field in enumerate(schema):
+        deltaBits=field.get("delta_bits")
+        bits=deltaBits if delta and deltaBits is not None else field.get("bits",16)
+        value=r.read(bits) if bits else r.readVarint()
+        if delta and deltaBits is not None:
+            value=lastFields[i]+unzigzag(value)
+        fields.append(value)
+
+    lastFrames[key]=(sequence,fields)
+    # rounded to hide float errors e.g. 21.400000000000006
+    return {field["name"]:round(q*field.get("scale",1)+field.get("offset",0),6) for field,q in zip(schema,fields)}
+
 def processUplink(client,obj,msg):
     """Called from run loop"""
     info=json.loads(msg.payload)
@@ -94,6 +184,25 @@ def processUplink(client,obj,msg):
         device_id=info["end_device_ids"]["device_id"]
         app_id=info["end_device_ids"]["application_ids"]["application_id"]
 
+        if f_port==aggregatePort:
+            try:
+                records=unpackRecords(frm_payload)
+            except ValueError as e:
+                print(f"f_port: {f_port} device_id: {device_id} bad aggregated payload {frm_payload.hex()}: {e}")
+                return
+            for record in records:
+                print(f"msg_type: {msg_type} f_port: {f_port} record: {record} device_id: {device_id} app_id: {app_id}")
+            return
+
+        if f_port in payloadSchemas:
+            try:
+                values=decodePayload(frm_payload,payloadSchemas[f_port],(device_id,f_port))
+            except ValueError as e:
+                print(f"f_port: {f_port} device_id: {device_id} payload {frm_payload.hex()} not decoded: {e}")
+                return
+            print(f"msg_type: {msg_type} f_port: {f_port} values: {values} device_id: {device_id} app_id: {app_id}")
+            return
+
         # check for a string message
         try:
             frm_payload = frm_payload.decode("ascii")
@@ -0,0 +1,142 @@
+"""
+Aggregator.py
+
+Packs small application records into one uplink. Every uplink carries 13 bytes
+of LoRaWAN header and MIC plus the preamble, at SF12 that is most of the airtime
+of a few bytes of sensor data. Sending several readings in one frame shares it.
+
+Records are length prefixed in the FRMPayload:
+
+    [length:1][record:length][length:1][record:length]...
+
+They are sent on their own FPort (AGGREGATE_PORT) so the application server
+knows to split them, see unpackRecords() in "TTN MQTT Client/TTN.py".
+
+A frame is queued, with Handler.queue(), when the next record would not fit
+in the largest payload allowed at the current data rate, when the oldest
+record has waited maxAge seconds (see poll()) or when flush() is called.
+Nothing is transmitted here, Handler.sendQueued() or flush() send the frames
+when the duty cycle and fair use policy allow.
+"""
+from LogManager import LogMan
+log=LogMan.getLogger("Aggregator") # uses the default log level
+
+import time
+
+# FPort used for aggregated uplinks
+AGGREGATE_PORT = 100
+
+# largest FRMPayload at any data rate in any region
+AGGREGATE_BUFFER = 242
+
+class UplinkAggregator:
+
+    def __init__(self, handler, port=AGGREGATE_PORT, maxAge=None, priority=0, deadline=None):
+        """
+        :param handler: the LorawanHandler.Handler whose uplink queue frames go in
+        :param port: FPort for the aggregated uplinks
+        :param maxAge: seconds the oldest record can wait before poll() queues it, None to wait for a full frame
+        :param priority: queue priority of the frames, see Handler.queue()
+        :param deadline: seconds a queued frame can wait to be sent, None to keep it till sent
+        """
+        self.handler = handler
+        self.port = port
+        self.maxAge = maxAge
+        self.priority = priority
+        self.deadline = deadline
+        self.buffer = bytearray(AGGREGATE_BUFFER)
+        self.length = 0         # bytes of buffer in use
+        self.records = 0
+        self.oldest = None      # time.monotonic() when the first waiting record was added
+
+    def __len__(self):
+        return self.records
+
+    def add(self, record):
+        """
+        add a record to the next uplink. Waiting records are queued first if
+        this one would not fit with them. Never transmits
+
+        :param record: str or bytes, up to the max payload at the current data rate less 1
+        :return: True if added, False if the record is too long to aggregate
+        """
+        if isinstance(record, str):
+            record = record.encode("utf-8")
+        size = len(record) + 1
+        maxPayload = self.handler.getMaxPayload()
+        if size > maxPayload or size > AGGREGATE_BUFFER:
+            log.warning(f"{len(record)} byte record is too long to aggregate at {maxPayload} bytes max payload")
+            return False
+        if self.length + size > maxPayload:
+            self.flush()
+        if not self.records:
+            self.oldest = time.monotonic()
+        self.buffer[self.length] = len(record)
+        self.buffer[self.length + 1:self.length + size] = record
+        self.length += size
+        self.records += 1
+        if self.length + 1 >= maxPayload:
+            # no room for even an empty record
+            self.flush()
+        return True
+
+    def due(self, now=None):
+        """
+        :param now: time.monotonic() value, default is now
+        :return: True if the oldest waiting record has waited maxAge seconds
+        """
+        if not self.records or self.maxAge is None:
+            return False
+        if now is None:
+            now = time.monotonic()
+        return now - self.oldest >= self.maxAge
+
+    def poll(self):
+        """
+        queue the waiting records if the oldest is due. Call this from your
+        program loop, before Handler.sendQueued()
+
+        :return: True if queued
+        """
+        if not self.due():
+            return False
+        self.flush()
+        return True
+
+    def frames(self):
+        """
+        split the waiting records into payloads no longer than the max payload
+        at the current data rate, which may have fallen since they were added,
+        and clear them
+
+        :return: list of bytes
+        """
+        maxPayload = self.handler.getMaxPayload()
+        frames = []
+        start = end = 0
+        while end < self.length:
+            size = self.buffer[end] + 1
+            if end + size - start > maxPayload and end > start:
+                frames.append(bytes(self.buffer[start:end]))
+                start = end
+            end += size
+        if end > start:
+            frames.append(bytes(self.buffer[start:end]))
+        self.length = 0
+        self.records = 0
+        self.oldest = None
+        return frames
+
+    def flush(self):
+        """
+        queue the waiting records now, to be sent by Handler.sendQueued(),
+        flush() or flush_async()
+
+        :return: False if the uplink queue was full and records were dropped
+        """
+        queued = True
+        for frame in self.frames():
+            if not self.handler.queue(frame, self.port, self.priority, self.deadline):
+                log.warning(f"uplink queue full, {len(frame)} bytes of records dropped")
+                queued = False
+        return queued
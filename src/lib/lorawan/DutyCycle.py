@@ -0,0 +1,131 @@
+"""
+DutyCycle.py
+
+Rolling window airtime ledger, one per sub-band of the frequency plan's
+duty_cycle_table.
+
+Each sub-band may be used for dutyCycle percent of any DUTY_CYCLE_WINDOW
+seconds (ETSI EN 300 220 uses one hour) e.g. 36s an hour at 1%. Sub-bands
+have separate budgets so a device which spreads its uplinks across them
+can send more often than the duty cycle of any one band allows.
+
+Times are time.monotonic() values. To keep memory, and the copy saved in
+NVM, small, transmissions close together are merged. A merged entry takes
+the start time of the later one so it leaves the window later than the
+real transmissions would. The ledger can only over estimate the airtime used.
+"""
+import time
+
+# seconds over which the duty cycle is measured
+DUTY_CYCLE_WINDOW = 3600
+
+# transmissions kept per sub-band, and kept when saved to NVM
+LEDGER_ENTRIES = 32
+SAVED_ENTRIES = 4
+
+class DutyCycleLedger:
+
+    def __init__(self, dutyCycles, window=DUTY_CYCLE_WINDOW):
+        """
+        :param dutyCycles: percent allowed for each sub-band e.g. [1.0, 1.0, 0.1, 10.0, 1.0]
+        :param window: seconds
+        """
+        self.dutyCycles = list(dutyCycles)
+        self.window = window
+        self.entries = [[] for dc in self.dutyCycles]   # per sub-band list of [start, airTime], oldest first
+
+    def budget(self, subBand):
+        """
+        :return: seconds of airtime allowed in the window
+        """
+        return self.window * self.dutyCycles[subBand] / 100
+
+    def expire(self, subBand, now):
+        """drop transmissions which have left the window"""
+        entries = self.entries[subBand]
+        cutoff = now - self.window
+        while entries and entries[0][0] <= cutoff:
+            entries.pop(0)
+
+    def record(self, subBand, start, airTime):
+        """
+        :param subBand: index into the duty cycle table
+        :param start: time.monotonic() when the transmission started
+        :param airTime: seconds
+        """
+        self.expire(subBand, start)
+        self.entries[subBand].append([start, airTime])
+        _merge(self.entries[subBand], LEDGER_ENTRIES)
+
+    def used(self, subBand, now=None):
+        """
+        :return: seconds of airtime used in the window ending now
+        """
+        if now is None:
+            now = time.monotonic()
+        self.expire(subBand, now)
+        total = 0.0
+        for start, airTime in self.entries[subBand]:
+            total += airTime
+        return total
+
+    def earliest(self, subBand, airTime, now=None):
+        """
+        when a transmission of airTime seconds fits in the sub-band's budget
+
+        :return: time.monotonic() value, now if it fits now, None if it never will
+        """
+        if now is None:
+            now = time.monotonic()
+        budget = self.budget(subBand)
+        if airTime > budget:
+            return None
+        excess = self.used(subBand, now) + airTime - budget
+        if excess <= 0:
+            return now
+        # wait for the oldest transmissions to leave the window
+        for start, used in self.entries[subBand]:
+            excess -= used
+            if excess <= 0:
+                return start + self.window
+        return now + self.window
+
+    def save(self, now=None):
+        """
+        :return: the ledger as a list per sub-band of [age (seconds before now), airTime], for the MAC cache
+        """
+        if now is None:
+            now = time.monotonic()
+        saved = []
+        for subBand, entries in enumerate(self.entries):
+            self.expire(subBand, now)
+            entries = [list(e) for e in entries]
+            _merge(entries, SAVED_ENTRIES)
+            # rounded so the restored ledger can't show less airtime, or older transmissions, than it held
+            saved.append([[int((now - start) * 10) / 10, round(airTime + 0.0005, 3)] for start, airTime in entries])
+        return saved
+
+    def load(self, saved, now=None):
+        """
+        restore a saved ledger. The time between the save and now is not known
+        (time.monotonic() restarts) so it is taken as none at all
+
+        :param saved: from save()
+        """
+        if now is None:
+            now = time.monotonic()
+        for subBand, entries in enumerate(saved[:len(self.entries)]):
+            self.entries[subBand] = [[now - age, airTime] for age, airTime in entries]
+
+def _merge(entries, maxEntries):
+    """
+    merge the two closest neighbouring entries until there are no more than maxEntries.
+    The merged entry keeps the later start time
+    """
+    while len(entries) > maxEntries:
+        best = 1
+        for i in range(2, len(entries)):
+            if entries[i][0] - entries[i - 1][0] < entries[best][0] - entries[best - 1][0]:
+                best = i
+        entries[best][1] += entries[best - 1][1]
+        del entries[best - 1]
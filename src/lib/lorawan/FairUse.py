@@ -0,0 +1,44 @@
+"""
+FairUse.py
+
+The Things Network fair use policy (FUP): each device may use 30s of uplink
+airtime and receive 10 downlinks, confirmed downlink ACKs included, in any
+24 hours.
+
+Kept as a rolling window ledger, the same as the duty cycle (see DutyCycle.py),
+with two entries: uplink airtime in seconds and downlinks counted as 1 each.
+"""
+from .DutyCycle import DutyCycleLedger
+
+FUP_WINDOW = 86400      # seconds
+FUP_AIRTIME = 30.0      # seconds of uplink airtime per window
+FUP_DOWNLINKS = 10      # downlinks per window
+
+class FairUseLedger(DutyCycleLedger):
+
+    UPLINK = 0
+    DOWNLINK = 1
+
+    def __init__(self, airTime=FUP_AIRTIME, downlinks=FUP_DOWNLINKS, window=FUP_WINDOW):
+        """
+        :param airTime: seconds of uplink airtime allowed in the window
+        :param downlinks: downlinks allowed in the window
+        :param window: seconds
+        """
+        super().__init__((), window)
+        self.budgets = (airTime, downlinks)
+        self.entries = [[], []]
+
+    def budget(self, kind):
+        """
+        :param kind: FairUseLedger.UPLINK or FairUseLedger.DOWNLINK
+        :return: seconds of airtime, or number of downlinks, allowed in the window
+        """
+        return self.budgets[kind]
+
+    def remaining(self, kind, now=None):
+        """
+        :param kind: FairUseLedger.UPLINK or FairUseLedger.DOWNLINK
+        :return: seconds of airtime, or number of downlinks, left in the window ending now
+        """
+        return max(self.budgets[kind] - self.used(kind, now), 0)
@@ -1,14 +1,74 @@
 # AES encryption routines - slightly changed from Python version
 # used to compute MIC and must be MODE_ECB
+#
+# An AES_CMAC object can be keyed once (e.g. with the NwkSKey after a join)
+# and then re-used for every frame. The expanded cipher and the K1/K2 subkeys
+# are only computed when the key changes. Use get_cmac() to share them.
 
 import aesio
 from struct import pack, unpack
 
 AES_MODE=aesio.MODE_ECB
 
+# keyed AES_CMAC objects, one per session key
+# there are normally only two or three keys in use (AppKey,NwkSKey,AppSKey)
+MAX_CONTEXTS=4
+_contexts={}
+
+def get_cmac(K):
+    """
+    return the keyed AES_CMAC for K, creating it the first time
+    the key is seen
+
+    :param K: 16 byte key (list, bytes or bytearray)
+    :return: AES_CMAC
+    """
+    K=bytes(K)
+    cmac=_contexts.get(K)
+    if cmac is None:
+        if len(_contexts)>=MAX_CONTEXTS:
+            _contexts.clear() # old session keys are no longer needed
+        cmac=AES_CMAC(K)
+        _contexts[K]=cmac
+    return cmac
+
+def get_cipher(K):
+    """
+    return the expanded aesio.AES (ECB) object for K
+
+    :param K: 16 byte key
+    :return: aesio.AES
+    """
+    return get_cmac(K).cipher
+
 class AES_CMAC:
+
+    def __init__(self, K=None):
+        # scratch blocks re-used by every digest()
+        self._X=bytearray(16)
+        self._Y=bytearray(16)
+        self._T=bytearray(16)
+        self.key=None
+        self.cipher=None
+        self.K1=None
+        self.K2=None
+        if K is not None:
+            self.set_key(K)
+
+    def set_key(self, K):
+        """expand the key and compute the subkeys, only if the key has changed"""
+        K=bytes(K)
+        if K==self.key:
+            return
+        self.key=K
+        self.cipher=aesio.AES(K,AES_MODE)
+        self.K1, self.K2 = self.gen_subkey(K)
+
     def gen_subkey(self, K):
-        AES_128 = aesio.AES(bytes(K),AES_MODE)
+        if self.cipher is not None and bytes(K)==self.key:
+            AES_128=self.cipher
+        else:
+            AES_128 = aesio.AES(bytes(K),AES_MODE)
 
         L=bytearray([0]*16)
         AES_128.encrypt_into(b'\x00'*16,L)
@@ -33,51 +93,105 @@ class AES_CMAC:
 
         return K1, K2
 
-    def xor_128(self, N1, N2):
-        J = b''
-        for i in range(len(N1)):
-            J += bytes([N1[i] ^ N2[i]])
+    def xor_128(self, N1, N2, J=None):
+        """J=N1 xor N2 without building a new bytes object per byte. J defaults to a scratch block"""
+        if J is None:
+            J = self._Y
+        for i in range(16):
+            J[i] = N1[i] ^ N2[i]
         return J
 
-    def pad(self, N):
-        const_Bsize = 16
-        padLen = 16-len(N)
-        return  N + b'\x80' + b'\x00'*(padLen-1)
+    def pad(self, N, J=None):
+        """copy N (less than 16 bytes) into J and add the 0x80,0x00.. padding"""
+        if J is None:
+            J = self._Y
+        padLen = len(N)
+        for i in range(16):
+            if i < padLen:
+                J[i] = N[i]
+            elif i == padLen:
+                J[i] = 0x80
+            else:
+                J[i] = 0x00
+        return J
 
     def encode(self, K, M):
+        """
+        compute the CMAC of M using key K. The key is only expanded if it has changed
+
+        :return: a new bytes object, unlike digest() it is not overwritten by the next CMAC
+        """
+        self.set_key(K)
+        return bytes(self.digest(M))
+
+    def digest(self, M, mLen=None, B0=None):
+        """
+        compute the CMAC of M using the key set by set_key()
+
+        The blocks are XORed in place in the scratch buffers owned by this object
+        so the number of objects created does not depend on len(M).
+
+        :param M: message buffer
+        :param mLen: number of bytes of M to use, default is all of M
+        :param B0: optional 16 byte block which is processed before M. This is how
+                   LoRaWAN data frames are MICed and saves concatenating B0 and M
+        :return: the 16 byte CMAC. This is a scratch buffer which is overwritten
+                 by the next call so copy (or slice) it if it must be kept
+        """
         const_Bsize = 16
-        const_Zero  = b'\x00'*16
 
-        AES_128= aesio.AES(bytes(K),AES_MODE)
-        K1, K2 = self.gen_subkey(K)
-        n      = int(len(M)/const_Bsize)
+        AES_128 = self.cipher
+        X = self._X
+        Y = self._Y
+        for i in range(const_Bsize):
+            X[i] = 0
 
-        if n == 0:
-            n = 1
-            flag = False
-        else:
-            if (len(M) % const_Bsize) == 0:
-                flag = True
+        if mLen is None:
+            mLen = len(M)
+
+        if B0 is not None:
+            if mLen == 0:
+                # B0 is the only, and complete, block
+                M = B0
+                mLen = const_Bsize
             else:
-                n += 1
-                flag = False
+                for i in range(const_Bsize):
+                    Y[i] = B0[i]
+                AES_128.encrypt_into(Y, X)
+
+        if mLen and (mLen % const_Bsize) == 0:
+            # the last block is complete
+            lastOffset = mLen - const_Bsize
+            flag = True
+        else:
+            lastOffset = mLen - (mLen % const_Bsize)
+            flag = False
+
+        offset = 0
+        while offset < lastOffset:
+            for i in range(const_Bsize):
+                Y[i] = X[i] ^ M[offset + i]
+            AES_128.encrypt_into(Y, X)
+            offset += const_Bsize
 
-        M_n = M[(n-1)*const_Bsize:]
         if flag is True:
-            M_last = self.xor_128(M_n,K1)
+            K1 = self.K1
+            for i in range(const_Bsize):
+                Y[i] = X[i] ^ M[offset + i] ^ K1[i]
         else:
-            M_last = self.xor_128(self.pad(M_n),K2)
-
-        X = bytearray([0]*16)
-    
-        for i in range(n-1):
-            M_i = M[(i)*const_Bsize:][:16]
-            Y   = self.xor_128(X, M_i)
-            AES_128.encrypt_into(Y,X)
-        Y = self.xor_128(M_last, X)
-        T=bytearray([0]*16)
-    
-        AES_128.encrypt_into(Y,T)
+            K2 = self.K2
+            remaining = mLen - offset
+            for i in range(const_Bsize):
+                if i < remaining:
+                    b = M[offset + i]
+                elif i == remaining:
+                    b = 0x80
+                else:
+                    b = 0x00
+                Y[i] = X[i] ^ b ^ K2[i]
+
+        T = self._T
+        AES_128.encrypt_into(Y, T)
 
         return T
 
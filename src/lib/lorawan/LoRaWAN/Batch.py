@@ -0,0 +1,142 @@
+#
+# batch MIC verification and payload decryption
+#
+# For decoding a lot of captured frames e.g. a days traffic from a fleet of devices
+# on a gateway or server side tool. Not intended for use on the device.
+#
+# Frames are grouped by devaddr so each device's keys are looked up and expanded once
+# and the keyed CMAC/cipher objects are shared by all its frames. The FRMPayload
+# keystream blocks (A_i) for all the frames of a device are encrypted in one call
+# when the cipher supports it (see Host/aesio.py encrypt_blocks) otherwise one
+# block at a time.
+#
+# The frame header layout is the same for uplinks and downlinks so DownlinkFrame
+# is used to read the fields.
+#
+from .Direction import Direction
+from .AES_CMAC import get_cmac, get_cipher
+from .DataPayload import b0_block
+from .FrameDecoder import DownlinkFrame
+
+def _encrypt_blocks(cipher, src, dest):
+    """ECB encrypt a buffer of 16 byte blocks, all at once if the cipher can"""
+    if hasattr(cipher, "encrypt_blocks"):
+        cipher.encrypt_blocks(src, dest)
+        return
+    s = memoryview(src)
+    d = memoryview(dest)
+    for o in range(0, len(src), 16):
+        cipher.encrypt_into(s[o:o + 16], d[o:o + 16])
+
+def _a_blocks(frame, direction, count, buf, pos):
+    """write the count A_i blocks for frame into buf at pos, returns the new pos"""
+    raw = frame.raw
+    fcnt = frame.fcnt
+    for i in range(count):
+        buf[pos] = 0x01
+        buf[pos + 5] = direction
+        buf[pos + 6] = raw[1]
+        buf[pos + 7] = raw[2]
+        buf[pos + 8] = raw[3]
+        buf[pos + 9] = raw[4]
+        buf[pos + 10] = fcnt & 0xFF
+        buf[pos + 11] = fcnt >> 8
+        buf[pos + 15] = i + 1
+        pos += 16
+    return pos
+
+def _decrypt_group(cipher, direction, frames, results):
+    """
+    decrypt the FRMPayloads of frames which all use the same key
+
+    :param frames: list of (index, DownlinkFrame)
+    :param results: list to store (devaddr, fcnt, fport, payload) in, at index
+    """
+    counts = []
+    total = 0
+    for index, frame in frames:
+        n = (len(frame.frm_payload) + 15) // 16
+        counts.append(n)
+        total += n
+    if total == 0:
+        for index, frame in frames:
+            results[index] = (frame.devaddr, frame.fcnt, frame.fport, bytearray())
+        return
+
+    ablocks = bytearray(16 * total)
+    pos = 0
+    for (index, frame), n in zip(frames, counts):
+        pos = _a_blocks(frame, direction, n, ablocks, pos)
+
+    stream = bytearray(16 * total)
+    _encrypt_blocks(cipher, ablocks, stream)
+
+    pos = 0
+    for (index, frame), n in zip(frames, counts):
+        payload = frame.frm_payload
+        out = bytearray(len(payload))
+        for i in range(len(payload)):
+            out[i] = payload[i] ^ stream[pos + i]
+        pos += 16 * n
+        results[index] = (frame.devaddr, frame.fcnt, frame.fport, out)
+
+def decode_frames(frames, keys, direction=Direction.UP):
+    """
+    verify the MIC and decrypt the FRMPayload of many data frames
+
+    FCnt is taken as the 16 bit counter sent in the frame.
+
+    :param frames: list of raw frames (bytes, bytearray or memoryview)
+    :param keys: dict, or function, which maps devaddr (int, as shown in the TTN console) to (NwkSKey, AppSKey)
+    :param direction: Direction.UP (default) or Direction.DOWN
+    :return: list, in the same order as frames, of (devaddr, fcnt, fport, payload) or None if
+             the frame was too short, the devaddr is unknown or the MIC is wrong.
+             FPort 0 payloads (MAC commands) are decrypted with the NwkSKey.
+    """
+    lookup = keys.get if hasattr(keys, "get") else keys
+    results = [None] * len(frames)
+
+    # group by device
+    devices = {}
+    for index, raw in enumerate(frames):
+        frame = DownlinkFrame(raw)
+        if not frame.is_valid():
+            continue
+        devaddr = frame.devaddr
+        if devaddr in devices:
+            devices[devaddr].append((index, frame))
+        else:
+            devices[devaddr] = [(index, frame)]
+
+    for devaddr in devices:
+        sessionKeys = lookup(devaddr)
+        if sessionKeys is None:
+            continue
+        nwkskey, appskey = sessionKeys
+        cmac = get_cmac(nwkskey)
+        appCipher = get_cipher(appskey)
+
+        appFrames = []
+        nwkFrames = []
+        for index, frame in devices[devaddr]:
+            raw = frame.raw
+            msgLen = frame.length - 4
+            b0 = b0_block(direction, raw[1:5], frame.fcnt, msgLen)
+            mic = cmac.digest(raw, msgLen, b0)
+            if mic[0] != raw[msgLen] or mic[1] != raw[msgLen + 1] or mic[2] != raw[msgLen + 2] or mic[3] != raw[msgLen + 3]:
+                continue
+
+            fport = frame.fport
+            if fport is None:
+                results[index] = (devaddr, frame.fcnt, None, bytearray())
+            elif fport == 0:
+                nwkFrames.append((index, frame))
+            else:
+                appFrames.append((index, frame))
+
+        if appFrames:
+            _decrypt_group(appCipher, direction, appFrames, results)
+        if nwkFrames:
+            _decrypt_group(cmac.cipher, direction, nwkFrames, results)
+
+    return results
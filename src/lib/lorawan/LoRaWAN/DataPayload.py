@@ -1,16 +1,96 @@
 #
 # frm_payload: data(0..N)
 #
-from .AES_CMAC import AES_CMAC
-import aesio
-import math
+from .AES_CMAC import get_cmac, get_cipher
 
 from LogManager import LogMan
 log=LogMan.getLogger("DataPayload") # uses the default log level
 
+# scratch blocks for the A_i counter block, its encryption and the MIC B0 block
+_a_block = bytearray(16)
+_s_block = bytearray(16)
+_b0_block = bytearray(16)
+
+def crypt_into(key, direction, devaddr, fcnt, data, out, offset=0, dataLen=None):
+    """
+    encrypt (or decrypt, it is the same operation) a FRMPayload
+    
+    Each 16 byte block of data is XORed with AES(key,A_i) where
+    A_i=[0x01,0,0,0,0,dir,devaddr(4),fcnt(4),0,i]
+    
+    A_i and its encryption are built in module scratch blocks and the result is
+    written straight into out, so no per-byte or per-block objects are created.
+    
+    :param key: AppSKey (or NwkSKey for FPort 0)
+    :param direction: Direction.UP or Direction.DOWN
+    :param devaddr: 4 bytes little endian, as sent over the air
+    :param fcnt: frame counter (int)
+    :param data: bytes to encrypt/decrypt
+    :param out: buffer for the result, may be data itself
+    :param offset: where to start writing in out
+    :param dataLen: number of bytes of data to use, default all of data
+    :return: out
+    """
+    if dataLen is None:
+        dataLen = len(data)
+
+    a = _a_block
+    s = _s_block
+    a[0] = 0x01
+    a[1] = a[2] = a[3] = a[4] = 0x00
+    a[5] = direction
+    for i in range(4):
+        a[6 + i] = devaddr[i]
+    a[10] = fcnt & 0xFF
+    a[11] = (fcnt >> 8) & 0xFF
+    a[12] = (fcnt >> 16) & 0xFF
+    a[13] = (fcnt >> 24) & 0xFF
+    a[14] = 0x00
+
+    cipher = get_cipher(key)
+
+    i = 0
+    block = 1
+    while i < dataLen:
+        a[15] = block
+        cipher.encrypt_into(a, s)
+        j = 0
+        while j < 16 and i < dataLen:
+            out[offset + i] = data[i] ^ s[j]
+            i += 1
+            j += 1
+        block += 1
+
+    return out
+
+def b0_block(direction, devaddr, fcnt, msgLen):
+    """
+    fill the scratch B0 block used as the first CMAC block of a data frame MIC
+    
+    :param devaddr: 4 bytes little endian, as sent over the air
+    :param fcnt: frame counter (int)
+    :param msgLen: length of MHDR|FHDR|FPort|FRMPayload
+    :return: the scratch B0 block
+    """
+    b0 = _b0_block
+    b0[0] = 0x49
+    b0[1] = b0[2] = b0[3] = b0[4] = 0x00
+    b0[5] = direction
+    for i in range(4):
+        b0[6 + i] = devaddr[i]
+    b0[10] = fcnt & 0xFF
+    b0[11] = (fcnt >> 8) & 0xFF
+    b0[12] = (fcnt >> 16) & 0xFF
+    b0[13] = (fcnt >> 24) & 0xFF
+    b0[14] = 0x00
+    b0[15] = msgLen
+    return b0
+
 
 class DataPayload:
 
+    __slots__ = ("mac_payload", "payload")
+
     def read(self, mac_payload, payload):
         log.debug(f"DataPayload.read() payload {payload}")
         self.mac_payload = mac_payload
@@ -30,96 +110,38 @@ class DataPayload:
         self.payload = self.encrypt_payload(key, direction, data)
 
     def compute_mic(self, key, direction, mhdr):
-        mic = [0x49]
-        mic += [0x00, 0x00, 0x00, 0x00]
-        mic += [direction]
-        mic += self.mac_payload.get_fhdr().get_devaddr()
-        mic += self.mac_payload.get_fhdr().get_fcnt()
-        mic += [0x00]
-        mic += [0x00]
-        mic += [0x00]
-        mic += [1 + self.mac_payload.length()]
-        mic += [mhdr.to_raw()]
-        mic += self.mac_payload.to_raw()
-
-        cmac = AES_CMAC()
-        computed_mic = cmac.encode(bytes(key), bytes(mic))[:4]
+        fhdr = self.mac_payload.get_fhdr()
+
+        msg = [mhdr.to_raw()]
+        msg += self.mac_payload.to_raw()
+
+        b0 = b0_block(direction, fhdr.get_devaddr_le(), fhdr.get_fcnt(), len(msg))
+
+        computed_mic = get_cmac(key).digest(bytes(msg), B0=b0)[:4]
         return list(map(int, computed_mic))
 
     def decrypt_payload(self, key, direction, mic):
         """TTN uses decryption so we only use encryption"""
         log.debug(f"decrypt_payload key {key}")
-        k = int(math.ceil(len(self.payload) / 16.0))
-
-        a = []
-        for i in range(k):
-            a += [0x01]
-            a += [0x00, 0x00, 0x00, 0x00]
-            a += [direction]
-            a += self.mac_payload.get_fhdr().get_devaddr()
-            a += self.mac_payload.get_fhdr().get_fcnt()
-            a += [0x00] # fcnt 32bit
-            a += [0x00] # fcnt 32bit
-            a += [0x00]
-            a += [i+1]
-
-        cipher = aesio.AES(bytes(key),aesio.MODE_ECB)
-        s=bytearray([0]*len(a))
-        cipher.encrypt_into(bytes(a),s)
-
-        padded_payload = bytearray([0]*16)
-        padding=bytearray([0x00] * 16)
-        
-        if type(self.payload) is list:
-            payload=bytearray(self.payload)
-        else:
-            payload=self.payload
-        
-        
-        for i in range(k):
-            idx = (i + 1) * 16
-            padded_payload += (payload[idx - 16:idx] + padding)[:16]
-
-        payload = []
-        for i in range(len(self.payload)):
-            payload += [s[i] ^ padded_payload[i]]
-        return list(map(int, payload))
+        return self.crypt_payload(key, direction, self.payload)
 
-         
     def encrypt_payload(self, key, direction, data):
         log.debug(f"encrypt_payload data {data} key {key}")
-        k = int(math.ceil(len(data) / 16.0))
-
-        a = []
-        for i in range(k):
-            a += [0x01]
-            a += [0x00, 0x00, 0x00, 0x00]
-            a += [direction]
-            a += self.mac_payload.get_fhdr().get_devaddr()
-            a += self.mac_payload.get_fhdr().get_fcnt()
-            a += [0x00] # fcnt 32bit
-            a += [0x00] # fcnt 32bit
-            a += [0x00]
-            a += [i+1]
-            
-        cipher = aesio.AES(bytes(key),aesio.MODE_ECB)
-        
-        s=bytearray([0]*len(a))
-        cipher.encrypt_into(bytearray(a),s)
+        payload = self.crypt_payload(key, direction, data)
+        log.debug(f"encrypt_payload returns {list(payload)}")
+        return payload
+
+    def crypt_payload(self, key, direction, data, out=None):
+        """
+        encrypt or decrypt data for this frame's devaddr and fcnt
         
-        data=bytearray(data)
+        :param data: bytes to encrypt/decrypt
+        :param out: optional bytearray for the result, may be data itself
+        :return: bytearray
+        """
+        if out is None:
+            out = bytearray(len(data))
 
-        padded_payload = bytearray()
-        padding=bytearray([0x00]*16)
-        for i in range(k):
-            idx = (i + 1) * 16
-            padded_payload += (data[idx - 16:idx] + padding)[:16]
+        fhdr = self.mac_payload.get_fhdr()
 
-        log.debug(f"data={data} padded payload {padded_payload}")
-        
-        payload = []
-        for i in range(len(data)):
-            payload += [s[i] ^ padded_payload[i]]
-            
-        log.debug(f"encrypt_payload returns {payload}")
-        return list(map(int, payload))
+        return crypt_into(key, direction, fhdr.get_devaddr_le(), fhdr.get_fcnt(), data, out)
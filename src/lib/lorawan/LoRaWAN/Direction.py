@@ -14,6 +14,8 @@ class Direction:
         MHDR.RFU: UP,
         MHDR.PROPRIETARY: UP }
 
+    __slots__ = ("direction",)
+
     def __init__(self, mhdr):
         self.set(mhdr)
 
@@ -2,22 +2,32 @@
 # fhdr: devaddr(4) fctrl(1) fcnt(2) fopts(0..N)
 #
 from .MalformedPacketException import MalformedPacketException
-from struct import unpack
 from .MHDR import MHDR
 
+# devaddr in over the air (little endian) order, see get_devaddr_le()
+_devaddr_le = bytearray(4)
+
 class FHDR:
 
+    __slots__ = ("devaddr", "fctrl", "fcnt", "fopts")
+
+    def __init__(self):
+        self.devaddr = 0            # int, as shown in the TTN console. 0 for join messages, which have none
+        self.fctrl = 0x00
+        self.fcnt = 0               # int
+        self.fopts = b""
+
     def read(self, mac_payload):
         if len(mac_payload) < 7:
             raise MalformedPacketException("Invalid fhdr")
 
-        self.devaddr = mac_payload[:4]
+        self.devaddr = mac_payload[0] | (mac_payload[1] << 8) | (mac_payload[2] << 16) | (mac_payload[3] << 24)
         self.fctrl = mac_payload[4]
-        self.fcnt = mac_payload[5:7]
+        self.fcnt = mac_payload[5] | (mac_payload[6] << 8)
         self.fopts = mac_payload[7:7 + (self.fctrl & 0xf)]
 
     def create(self, mtype, args):
-        self.devaddr = [0x00, 0x00, 0x00, 0x00]
+        self.devaddr = 0
         
         # for downlinks fctrl=[ADR:7,RFU:6,ACK:5,FPending:4,FOptsLen:3-0]
         # for uplinks   fctrl=[ADR:7,ADRACKREQ:6,ACK:5,CLASS_B:4,FOptslen:3-0]
@@ -27,39 +37,49 @@ class FHDR:
         else:
             self.fctrl = 0x00
 
-
         if 'fcnt' in args:
-            fcnt=args['fcnt']
-            self.fcnt = [fcnt & 0xFF,fcnt >> 8] # little endian
+            self.fcnt = args['fcnt']
         else:
-            self.fcnt = [0x00, 0x00]
+            self.fcnt = 0
         
         # BNN addition to add any fopts for MAC replies/commands
         if 'fopts' in args:
             self.fopts = args['fopts'] # should this be little endian?
             self.fctrl=self.fctrl | (len(self.fopts) & 0x0F)
         else:
-            self.fopts = []
+            self.fopts = b""
             
         if mtype == MHDR.UNCONF_DATA_UP or mtype == MHDR.UNCONF_DATA_DOWN or\
                 mtype == MHDR.CONF_DATA_UP or mtype == MHDR.CONF_DATA_DOWN:
-            self.devaddr = list(reversed(args['devaddr']))
+            devaddr = args['devaddr']  # int, or 4 bytes big endian as kept in the MAC cache
+            self.devaddr = devaddr if type(devaddr) is int else int.from_bytes(bytes(devaddr), "big")
 
     def length(self):
         return 4 + 1 + 2 + (self.fctrl & 0xf)
 
+    def has_devaddr(self):
+        """False for join messages, which have no FHDR"""
+        return self.devaddr != 0
+
     def to_raw(self):
         fhdr = []
-        fhdr += self.devaddr
-        fhdr += [self.fctrl]
-        fhdr += self.fcnt
+        fhdr += self.get_devaddr_le()
+        fhdr += [self.fctrl, self.fcnt & 0xFF, (self.fcnt >> 8) & 0xFF] # fcnt is little endian
         if self.fopts:
             fhdr += self.fopts
         return fhdr
 
     def get_devaddr(self):
+        """devaddr as an int"""
         return self.devaddr
 
+    def get_devaddr_le(self):
+        """devaddr as 4 bytes little endian, as sent over the air. Shared, overwritten by the next call"""
+        devaddr = self.devaddr
+        for i in range(4):
+            _devaddr_le[i] = (devaddr >> (8 * i)) & 0xFF
+        return _devaddr_le
+
     def set_devaddr(self, devaddr):
         self.devaddr = devaddr
 
@@ -70,6 +90,7 @@ class FHDR:
         self.fctrl = fctrl
 
     def get_fcnt(self):
+        """FCnt as an int"""
         return self.fcnt
 
     def set_fcnt(self, fcnt):
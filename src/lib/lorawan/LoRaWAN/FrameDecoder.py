@@ -0,0 +1,131 @@
+#
+# lazy downlink decoder
+#
+# lorawan data frame: mhdr(1) devaddr(4) fctrl(1) fcnt(2) fopts(0..15) fport(0..1) frm_payload(0..N) mic(4)
+#
+# DownlinkFrame wraps the received buffer in a memoryview. Header fields are
+# read from the buffer when asked for, nothing is copied, and the MIC check and
+# payload decryption are only done on demand. So a frame addressed to another
+# device can be rejected with a couple of integer compares.
+#
+# One DownlinkFrame can be re-used for every received packet, see wrap().
+#
+from .MHDR import MHDR
+from .Direction import Direction
+from .AES_CMAC import get_cmac
+from .DataPayload import crypt_into, b0_block
+
+# MHDR(1)+FHDR(7)+MIC(4)
+MIN_FRAME_LENGTH = 12
+
+class DownlinkFrame:
+
+    def __init__(self, packet=None, length=None):
+        self.raw = None
+        self.length = 0
+        if packet is not None:
+            self.wrap(packet, length)
+
+    def wrap(self, packet, length=None):
+        """
+        point at a new packet. Nothing is decoded until a field is used
+
+        :param packet: received bytes (bytearray or memoryview)
+        :param length: number of valid bytes in packet, default all of it
+        :return: self
+        """
+        self.raw = memoryview(packet)
+        self.length = len(packet) if length is None else length
+        return self
+
+    def is_valid(self):
+        """True if the packet is long enough to hold the header, FOpts and MIC it claims to have"""
+        return self.length >= MIN_FRAME_LENGTH and (MIN_FRAME_LENGTH + (self.raw[5] & 0x0F)) <= self.length
+
+    @property
+    def mhdr(self):
+        return self.raw[0]
+
+    @property
+    def mtype(self):
+        return self.raw[0] & MHDR.MHDR_TYPE
+
+    @property
+    def devaddr(self):
+        """devaddr as an int, the same value as the big endian devaddr shown in the TTN console"""
+        raw = self.raw
+        return raw[1] | (raw[2] << 8) | (raw[3] << 16) | (raw[4] << 24)
+
+    def is_for(self, devaddr):
+        """
+        :param devaddr: int, see devaddr
+        :return: True if the frame is addressed to devaddr
+        """
+        return self.devaddr == devaddr
+
+    @property
+    def fctrl(self):
+        return self.raw[5]
+
+    @property
+    def fopts_len(self):
+        return self.raw[5] & 0x0F
+
+    @property
+    def fcnt(self):
+        return self.raw[6] | (self.raw[7] << 8)
+
+    @property
+    def fopts(self):
+        """FOpts (MAC commands) as a memoryview of the packet"""
+        return self.raw[8:8 + (self.raw[5] & 0x0F)]
+
+    @property
+    def fport(self):
+        """FPort or None if the frame only carries FOpts"""
+        pos = 8 + (self.raw[5] & 0x0F)
+        if pos < self.length - 4:
+            return self.raw[pos]
+        return None
+
+    @property
+    def frm_payload(self):
+        """the encrypted FRMPayload as a memoryview of the packet, empty if there is no FPort"""
+        pos = 9 + (self.raw[5] & 0x0F)
+        end = self.length - 4
+        if pos > end:
+            pos = end
+        return self.raw[pos:end]
+
+    @property
+    def mic(self):
+        return self.raw[self.length - 4:self.length]
+
+    def valid_mic(self, nwkskey):
+        """
+        compute the MIC over the packet (no copies) and compare with the received MIC
+
+        :param nwkskey: network session key
+        :return: True if the MIC matches
+        """
+        raw = self.raw
+        msgLen = self.length - 4
+        b0 = b0_block(Direction.DOWN, raw[1:5], self.fcnt, msgLen)
+        computed = get_cmac(nwkskey).digest(raw, msgLen, b0)
+        for i in range(4):
+            if computed[i] != raw[msgLen + i]:
+                return False
+        return True
+
+    def decrypt(self, key, out=None):
+        """
+        decrypt the FRMPayload
+
+        :param key: AppSKey, or NwkSKey if FPort is 0
+        :param out: optional buffer for the result
+        :return: bytearray (or out)
+        """
+        payload = self.frm_payload
+        if out is None:
+            out = bytearray(len(payload))
+        return crypt_into(key, Direction.DOWN, self.raw[1:5], self.fcnt, payload, out)
@@ -0,0 +1,101 @@
+#
+# single pass uplink encoder
+#
+# lorawan data frame: mhdr(1) devaddr(4) fctrl(1) fcnt(2) fopts(0..15) fport(0..1) frm_payload(0..N) mic(4)
+#
+# The frame is written straight into a caller supplied bytearray (normally the
+# buffer which is then written to the radio FIFO). The FRMPayload is encrypted
+# into its place in the buffer and the MIC is calculated over the buffer, so
+# no intermediate lists are built at any layer.
+#
+from .MHDR import MHDR
+from .Direction import Direction
+from .AES_CMAC import get_cmac
+from .DataPayload import crypt_into, b0_block
+
+# MHDR(1)+FHDR(7)+MIC(4)
+FRAME_OVERHEAD = 12
+
+# devaddr in over the air (little endian) order
+_devaddr_le = bytearray(4)
+
+def frame_length(payloadLen, foptsLen=0, fport=1):
+    """
+    return the length of an encoded data frame without encoding it
+
+    :param payloadLen: length of the (unencrypted) application payload
+    :param foptsLen: number of FOpts bytes (MAC answers)
+    :param fport: None if the frame has no FPort (and no payload)
+    """
+    n = FRAME_OVERHEAD + foptsLen + payloadLen
+    if fport is not None:
+        n += 1
+    return n
+
+def encode_uplink(buf, nwkskey, appskey, devaddr, fcnt, payload, fport=1, fctrl=0x00, fopts=None, mtype=MHDR.UNCONF_DATA_UP, keystream=None):
+    """
+    encode a data uplink into buf in a single pass
+
+    :param buf: bytearray large enough for the frame (see frame_length())
+    :param nwkskey: network session key, used for the MIC
+    :param appskey: application session key, used to encrypt the payload
+    :param devaddr: 4 bytes big endian, as stored in the MAC cache and shown in the TTN console
+    :param fcnt: FCntUp (int)
+    :param payload: bytes to send, may be empty
+    :param fport: 1..223, 0 for MAC commands only. None for no FPort (payload must be empty)
+    :param fctrl: ADR,ADRACKReq,ACK and ClassB bits. FOptsLen is filled in here
+    :param fopts: MAC command answers, upto 15 bytes
+    :param mtype: MHDR.UNCONF_DATA_UP or MHDR.CONF_DATA_UP
+    :param keystream: optional Keystream pre-generated for this frame, ignored if it doesn't match
+    :return: length of the frame written to buf
+    """
+    payloadLen = len(payload)
+    foptsLen = 0 if fopts is None else len(fopts)
+
+    if foptsLen > 15:
+        raise ValueError(f"FOpts length {foptsLen} exceeds 15 bytes")
+    if fport is None and payloadLen > 0:
+        raise ValueError("A payload requires an FPort")
+
+    frameLen = frame_length(payloadLen, foptsLen, fport)
+    if frameLen > len(buf):
+        raise ValueError(f"frame length {frameLen} exceeds buffer size {len(buf)}")
+
+    # MHDR
+    buf[0] = mtype | MHDR.LORAWAN_V1
+
+    # FHDR - devaddr is sent little endian
+    addr = _devaddr_le
+    for i in range(4):
+        addr[i] = devaddr[3 - i]
+        buf[1 + i] = addr[i]
+    buf[5] = (fctrl & 0xF0) | foptsLen
+    buf[6] = fcnt & 0xFF
+    buf[7] = (fcnt >> 8) & 0xFF
+    pos = 8
+    for i in range(foptsLen):
+        buf[pos] = fopts[i]
+        pos += 1
+
+    # FPort and encrypted FRMPayload
+    if fport is not None:
+        buf[pos] = fport
+        pos += 1
+        if payloadLen:
+            # FPort 0 payloads are MAC commands encrypted with the NwkSKey
+            key = nwkskey if fport == 0 else appskey
+            if keystream is not None and keystream.matches(key, Direction.UP, addr, fcnt):
+                keystream.xor_into(payload, buf, pos, payloadLen)
+            else:
+                crypt_into(key, Direction.UP, addr, fcnt, payload, buf, pos, payloadLen)
+            pos += payloadLen
+
+    # MIC over B0|MHDR|FHDR|FPort|FRMPayload
+    b0 = b0_block(Direction.UP, addr, fcnt, pos)
+    mic = get_cmac(nwkskey).digest(buf, pos, b0)
+    buf[pos] = mic[0]
+    buf[pos + 1] = mic[1]
+    buf[pos + 2] = mic[2]
+    buf[pos + 3] = mic[3]
+
+    return frameLen
@@ -2,19 +2,29 @@
 # frm_payload: appnonce(3) netid(3) devaddr(4) dlsettings(1) rxdelay(1) cflist(0..16)
 #
 from .MalformedPacketException import MalformedPacketException
-from .AES_CMAC import AES_CMAC
-import aesio
+from .AES_CMAC import get_cmac, get_cipher
+from .Direction import Direction
 
 from LogManager import LogMan
 log=LogMan.getLogger("JOIN_ACCEPT") # uses the default log level
 
+# MHDR(1) + the largest join accept (payload and MIC, 32 bytes)
+# the join accept is decrypted in place after the MHDR so the MIC can be
+# computed over the same buffer
+_scratch = bytearray(33)
+_scratch_mv = memoryview(_scratch)
+_derive_block = bytearray(16)
 
 class JoinAcceptPayload:
 
+    __slots__ = ("encrypted_payload", "payload", "clear_mic", "appnonce", "netid",
+                 "devaddr", "dlsettings", "rxdelay", "cflist")
+
     def read(self, payload):
         if len(payload) < 12:
             raise MalformedPacketException("Invalid join accept payload length");
         self.encrypted_payload = payload
+        self.clear_mic = None # set by decrypt_payload
 
     def create(self, args):
         pass
@@ -37,7 +47,8 @@ class JoinAcceptPayload:
         return self.netid
 
     def get_devaddr(self):
-        return list(map(int, reversed(self.devaddr)))
+        """devaddr as an int, as shown in the TTN console"""
+        return self.devaddr
 
     def get_dlsettings(self):
         return self.dlsettings
@@ -49,99 +60,82 @@ class JoinAcceptPayload:
         return self.cflist
 
     def compute_mic(self, key, direction, mhdr):
-        mic = []
-        mic += [mhdr.to_raw()]
-        mic += self.to_clear_raw()
+        """
+        MIC over MHDR|clear payload. decrypt_payload MUST be called first
+        """
+        n = len(self.payload)
+        _scratch[0] = mhdr.to_raw()
+        _scratch[1:1 + n] = self.payload
 
-        cmac = AES_CMAC()
-        computed_mic = cmac.encode(bytes(key), bytes(mic))[:4]
-        log.debug(f"JoinAcceptPayload computed mic was {list(computed_mic)}") # debugging
-        return list(map(int, computed_mic))
+        computed_mic = get_cmac(key).digest(_scratch, 1 + n)
+        log.debug(f"JoinAcceptPayload computed mic was {list(computed_mic[:4])}") # debugging
+        return [computed_mic[0], computed_mic[1], computed_mic[2], computed_mic[3]]
 
+    def valid_mic(self, key, mhdr):
+        """compare the MIC computed over the clear payload with the MIC decrypted along with it"""
+        return self.compute_mic(key, Direction.DOWN, mhdr) == list(self.clear_mic)
 
     """
     The TTN server decrypts messages using AES mode ECB. In order to decrypt
     the message we need to encrypt it. This means the end device only needs to
     know how to encrypt a message
     
-    adafruit.aesio ECB mode only works on blocks of 16 bytes so we have to slice
-    the message and, if length is not a multiple of 16 add some padding
+    A join accept (payload and MIC) is always 16 or 32 bytes, the size of the
+    scratch buffer, so the blocks are encrypted in place with no padding.
     
     """
-    
-    def blockDecryptor(self,appkey,raw_payload):
+
+    def _ecb_in_place(self, key, n):
+        """encrypt the first n bytes after the MHDR slot of the scratch buffer, in place"""
+        cipher = get_cipher(key)
+        for o in range(1, 1 + n, 16):
+            block = _scratch_mv[o:o + 16]
+            cipher.encrypt_into(block, block)
+        return _scratch_mv[1:1 + n]
+
+    def _load(self, data, mic=None):
+        """copy data (and mic) into the scratch buffer, returns the total length"""
+        n = len(data)
+        total = n if mic is None else n + len(mic)
+        if total not in (16, 32):
+            raise MalformedPacketException(f"Invalid join accept length {total}, must be 16 or 32 bytes")
+        _scratch[1:1 + n] = bytes(data) if type(data) is list else data
+        if mic is not None:
+            _scratch[1 + n:1 + total] = bytes(mic) if type(mic) is list else mic
+        return total
+
+    def blockDecryptor(self, appkey, raw_payload):
         """decrypt the payload 16 bytes at a time"""
-        
-        AES_128 = aesio.AES(bytearray(appkey),aesio.MODE_ECB)
-        
-        encrypted=raw_payload
-        decrypted=bytearray()
-        startSlice=0
-        while startSlice<len(encrypted):
-            L=len(encrypted[startSlice:])
-            if  L<16:
-                slice=encrypted[startSlice:]+bytearray([0]*(16-L)) # padding, if required
-            else:
-                slice=encrypted[startSlice:startSlice+16]
-
-            # decrypt the block by encrypting it (see comments above)
-            d=bytearray([0]*16)
-            AES_128.encrypt_into(bytearray(slice),d)
-            decrypted+=d
-            
-            startSlice=startSlice+16
-
-        return decrypted
-    
+        return bytearray(self._ecb_in_place(appkey, self._load(raw_payload)))
+
     def decrypt_payload(self, key, direction, mic):
         
         log.debug(f"decrypt_payload encrypted payload {list(self.encrypted_payload)}")
         
-        a = []
-        a += self.encrypted_payload
-        a += mic
-         
-        p=self.blockDecryptor(key,a)
-        self.payload=p[:-4] # lose the MIC
+        n = self._load(self.encrypted_payload, mic)
+        p = self._ecb_in_place(key, n)
+        self.payload = bytearray(p[:-4]) # lose the MIC
+        self.clear_mic = bytes(p[-4:])
         
         # frm_payload: appnonce(3) netid(3) devaddr(4) dlsettings(1) rxdelay(1) cflist(0..16)
         # note values are little endian
         self.appnonce = self.payload[:3]
         self.netid = self.payload[3:6]
-        self.devaddr = self.payload[6:10]
+        self.devaddr = int.from_bytes(self.payload[6:10], "little")
         self.dlsettings = self.payload[10]
         self.rxdelay = self.payload[11]
         self.cflist = None
         if self.payload[12:]:
             self.cflist = self.payload[12:]
 
-        return list(map(int, self.payload))
+        return list(self.payload)
 
-    def blockEncryptor(self,appkey,payload):
-        """decrypt the payload 16 bytes at a time"""
+    def blockEncryptor(self, appkey, payload):
+        """encrypt the payload 16 bytes at a time"""
         
         log.debug(f"JoinAcceptPayload Block encrypting {list(payload)}")
         
-        AES_128 = aesio.AES(bytearray(appkey),aesio.MODE_ECB)
-        
-        encrypted=bytearray()
-        payload=bytearray(payload)
-        startSlice=0
-        while startSlice<len(payload):
-            L=len(payload[startSlice:])
-            if  L<16:
-                slice=payload[startSlice:]+bytearray([0]*(16-L)) # padding, if required
-            else:
-                slice=payload[startSlice:startSlice+16]
-
-            # decrypt the block by encrypting it (see comments above)
-            d=bytearray([0]*16)
-            AES_128.encrypt_into(bytearray(slice),d)
-            encrypted+=d
-            
-            startSlice=startSlice+16
-
-        return encrypted
+        return bytearray(self._ecb_in_place(appkey, self._load(payload)))
     
     # not certain this is ever called
     def encrypt_payload(self, key, direction, mhdr):
@@ -149,35 +143,32 @@ class JoinAcceptPayload:
         a += self.to_clear_raw()
         a += self.compute_mic(key, direction, mhdr)
         log.info("encrypt_payload() called for JOIN_ACCEPT")
-        if len(a)>16:
-            log.debug("encrypt_payload trying to encrypt data longer than 16 bytes")
     
         self.encrypted_payload=self.blockEncryptor(key,a)
-        return list(map(int, self.encrypted_payload))
+        return list(self.encrypted_payload)
+
+    def _derive(self, keyType, key, devnonce):
+        """
+        session keys are AES(AppKey, type|appnonce|netid|devnonce|pad16) using the
+        cipher already expanded for decrypting the join accept
+        """
+        a = _derive_block
+        a[0] = keyType
+        a[1:4] = self.appnonce
+        a[4:7] = self.netid
+        a[7] = devnonce[0]
+        a[8] = devnonce[1]
+        for i in range(9, 16):
+            a[i] = 0x00
+
+        e = bytearray(16)
+        get_cipher(key).encrypt_into(a, e)
+        return list(e)
 
     def derive_nwskey(self, key, devnonce):
         log.debug("derive nwskey")
-        a = [0x01]
-        a += self.get_appnonce()
-        a += self.get_netid()
-        a += devnonce
-        a += [0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00]
-
-        cipher = aesio.AES(bytes(key),aesio.MODE_ECB)
-        e=bytearray([0]*len(a)) # was 16
-        cipher.encrypt_into(bytes(a),e)
-        return list(map(int, e))
+        return self._derive(0x01, key, devnonce)
 
     def derive_appskey(self, key, devnonce):
-        log.debug("derive appskey")
-        a = [0x02]
-        a += self.get_appnonce()
-        a += self.get_netid()
-        a += devnonce
-        a += [0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00]
-
         log.debug(f"derive appskey join accept payload key {key} devnonce {devnonce}")
-        cipher = aesio.AES(bytes(key),aesio.MODE_ECB)
-        e=bytearray([0]*len(a))
-        cipher.encrypt_into(bytes(a),e)
-        return list(map(int, e))
+        return self._derive(0x02, key, devnonce)
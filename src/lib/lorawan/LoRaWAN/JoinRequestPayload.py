@@ -2,11 +2,13 @@
 # frm_payload: appeui(8) deveui(8) devnonce(2)
 #
 from .MalformedPacketException import MalformedPacketException
-from .AES_CMAC import AES_CMAC
+from .AES_CMAC import get_cmac
 
 
 class JoinRequestPayload:
 
+    __slots__ = ("deveui", "appeui", "devnonce")
+
     def read(self, payload):
         if len(payload) != 18:
             raise MalformedPacketException("Invalid join request");
@@ -43,8 +45,7 @@ class JoinRequestPayload:
         mic += self.to_raw()
 
         #print(f"compute_mic key {key} dir {direction} mhdr {mhdr} mic {mic}")
-        cmac = AES_CMAC()
-        computed_mic = cmac.encode(bytes(key), bytes(mic))[:4]
+        computed_mic = get_cmac(key).digest(bytes(mic))[:4]
         #print(f"JoinRequestPaylod computed_mic {computed_mic}")
         return list(map(int, computed_mic))
 
@@ -0,0 +1,115 @@
+#
+# pre-generated FRMPayload keystream
+#
+# FRMPayload encryption XORs the payload with S=AES(key,A_1)|AES(key,A_2)|...
+# For a given session the A_i blocks only change with FCnt so the keystream
+# for the next uplink can be generated while the radio is idle (e.g. during
+# the duty cycle wait after a transmission). When the application sends,
+# the encoder only has to XOR the payload with it.
+#
+from .AES_CMAC import get_cipher
+
+# 4 blocks covers payloads upto 64 bytes, longer payloads have the
+# remaining blocks generated when the frame is encoded
+KEYSTREAM_BLOCKS = 4
+
+class Keystream:
+
+    def __init__(self, maxBlocks=KEYSTREAM_BLOCKS):
+        self.stream = bytearray(16 * maxBlocks)
+        self.maxBlocks = maxBlocks
+        self.blocks = 0                # number of valid blocks in stream
+        self._a = bytearray(16)        # A_i counter block
+        self.cipher = None             # identifies the key the stream was made with
+        self.direction = None
+        self.devaddr = bytearray(4)    # little endian
+        self.fcnt = None
+
+    def invalidate(self):
+        """forget the current keystream e.g. after a re-join"""
+        self.cipher = None
+        self.fcnt = None
+
+    def precompute(self, key, direction, devaddr, fcnt, nbytes=None):
+        """
+        generate the keystream for a future frame
+
+        :param key: AppSKey
+        :param direction: Direction.UP or Direction.DOWN
+        :param devaddr: 4 bytes little endian, as sent over the air
+        :param fcnt: frame counter (int) of the frame which will use it
+        :param nbytes: expected payload size, default is the whole buffer
+        """
+        blocks = self.maxBlocks
+        if nbytes is not None:
+            blocks = min(blocks, (nbytes + 15) // 16)
+
+        a = self._a
+        a[0] = 0x01
+        a[1] = a[2] = a[3] = a[4] = 0x00
+        a[5] = direction
+        for i in range(4):
+            a[6 + i] = devaddr[i]
+            self.devaddr[i] = devaddr[i]
+        a[10] = fcnt & 0xFF
+        a[11] = (fcnt >> 8) & 0xFF
+        a[12] = (fcnt >> 16) & 0xFF
+        a[13] = (fcnt >> 24) & 0xFF
+        a[14] = 0x00
+
+        cipher = get_cipher(key)
+        stream = memoryview(self.stream)
+        for i in range(blocks):
+            a[15] = i + 1
+            cipher.encrypt_into(a, stream[16 * i:16 * (i + 1)])
+
+        self.blocks = blocks
+        self.cipher = cipher
+        self.direction = direction
+        self.fcnt = fcnt
+
+    def matches(self, key, direction, devaddr, fcnt):
+        """True if the keystream was generated for this key, direction, devaddr (little endian) and fcnt"""
+        if self.fcnt != fcnt or self.direction != direction:
+            return False
+        for i in range(4):
+            if self.devaddr[i] != devaddr[i]:
+                return False
+        return get_cipher(key) is self.cipher
+
+    def xor_into(self, data, out, offset=0, dataLen=None):
+        """
+        XOR data with the keystream into out. Blocks which were not pre-generated
+        are generated now, using the A_i block left by precompute()
+
+        :param data: bytes to encrypt/decrypt
+        :param out: buffer for the result
+        :param offset: where to start writing in out
+        :param dataLen: number of bytes of data to use, default all of data
+        :return: out
+        """
+        if dataLen is None:
+            dataLen = len(data)
+
+        stream = self.stream
+        ready = min(dataLen, 16 * self.blocks)
+        for i in range(ready):
+            out[offset + i] = data[i] ^ stream[i]
+
+        if ready < dataLen:
+            a = self._a
+            s = stream # the pre-generated blocks are spent, re-use the start of the buffer
+            i = ready
+            block = self.blocks + 1
+            while i < dataLen:
+                a[15] = block
+                self.cipher.encrypt_into(a, memoryview(s)[0:16])
+                j = 0
+                while j < 16 and i < dataLen:
+                    out[offset + i] = data[i] ^ s[j]
+                    i += 1
+                    j += 1
+                block += 1
+            self.invalidate()
+
+        return out
@@ -17,11 +17,16 @@ class MHDR:
     RFU = 0xC0 # rejoin for roaming
     PROPRIETARY = 0xE0
 
+    __slots__ = ("mhdr",)
+
     def __init__(self, mhdr):
-        self.mhdr = mhdr
+        self.set(mhdr)
+
+    def set(self, mhdr):
         mversion = mhdr & self.MHDR_MAJOR
         if mversion != self.LORAWAN_V1:
             raise MalformedPacketException("Invalid major version %d"%(mversion))
+        self.mhdr = mhdr
 
     def to_raw(self):
         return self.mhdr
@@ -8,14 +8,27 @@ from .JoinRequestPayload import JoinRequestPayload
 from .JoinAcceptPayload import JoinAcceptPayload
 from .DataPayload import DataPayload
 
+def _reuse(obj, cls):
+    """return obj if it is already a cls, so pooled messages keep their sub-objects"""
+    if type(obj) is cls:
+        return obj
+    return cls()
+
 class MacPayload:
 
+    __slots__ = ("fhdr", "fport", "frm_payload")
+
+    def __init__(self):
+        self.fhdr = None
+        self.fport = None
+        self.frm_payload = None
+
     def read(self, mtype, mac_payload):
 
         if len(mac_payload) < 1:
             raise MalformedPacketException("Invalid mac payload")
 
-        self.fhdr = FHDR()
+        self.fhdr = _reuse(self.fhdr, FHDR)
         self.fhdr.read(mac_payload)
 
 
@@ -25,20 +38,21 @@ class MacPayload:
         except:
             self.fport=None
 
+        frm_payload = self.frm_payload
         self.frm_payload = None
         if mtype == MHDR.JOIN_REQUEST:
-            self.frm_payload = JoinRequestPayload()
+            self.frm_payload = _reuse(frm_payload, JoinRequestPayload)
             self.frm_payload.read(mac_payload)
         if mtype == MHDR.JOIN_ACCEPT:
-            self.frm_payload = JoinAcceptPayload()
+            self.frm_payload = _reuse(frm_payload, JoinAcceptPayload)
             self.frm_payload.read(mac_payload)
         if mtype == MHDR.UNCONF_DATA_UP or mtype == MHDR.UNCONF_DATA_DOWN or\
                 mtype == MHDR.CONF_DATA_UP or mtype == MHDR.CONF_DATA_DOWN:
-            self.frm_payload = DataPayload()
+            self.frm_payload = _reuse(frm_payload, DataPayload)
             self.frm_payload.read(self, mac_payload[self.fhdr.length() + 1:])
 
     def create(self, mtype, key, args):
-        self.fhdr = FHDR()
+        self.fhdr = _reuse(self.fhdr, FHDR)
         self.fhdr.create(mtype, args)
         
         # added ability to specify the fport normally 1..254
@@ -49,27 +63,38 @@ class MacPayload:
         else:
             self.fport=1
             
+        frm_payload = self.frm_payload
         self.frm_payload = None
         if mtype == MHDR.JOIN_REQUEST:
-            self.frm_payload = JoinRequestPayload()
+            self.frm_payload = _reuse(frm_payload, JoinRequestPayload)
             self.frm_payload.create(args)
         if mtype == MHDR.JOIN_ACCEPT:
-            self.frm_payload = JoinAcceptPayload()
+            self.frm_payload = _reuse(frm_payload, JoinAcceptPayload)
             self.frm_payload.create(args)
         if mtype == MHDR.UNCONF_DATA_UP or mtype == MHDR.UNCONF_DATA_DOWN or\
                 mtype == MHDR.CONF_DATA_UP or mtype == MHDR.CONF_DATA_DOWN:
-            self.frm_payload = DataPayload()
+            self.frm_payload = _reuse(frm_payload, DataPayload)
             self.frm_payload.create(self, key, args)
 
     def length(self):
-        return len(self.to_raw())
+        """same as len(self.to_raw()) but without building the list"""
+        n = 0
+        hasDevaddr = self.fhdr.has_devaddr()
+        if hasDevaddr:
+            n += self.fhdr.length()
+        if self.frm_payload != None:
+            if hasDevaddr and self.fport is not None:
+                n += 1
+            n += self.frm_payload.length()
+        return n
 
     def to_raw(self):
         mac_payload = []
-        if self.fhdr.get_devaddr() != [0x00, 0x00, 0x00, 0x00]: 
+        hasDevaddr = self.fhdr.has_devaddr()
+        if hasDevaddr:
             mac_payload += self.fhdr.to_raw()
         if self.frm_payload != None:
-            if self.fhdr.get_devaddr() != [0x00, 0x00, 0x00, 0x00]:
+            if hasDevaddr:
                 if self.fport is not None: # BNN
                     mac_payload += [self.fport]
             mac_payload += self.frm_payload.to_raw()
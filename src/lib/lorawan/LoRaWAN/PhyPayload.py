@@ -8,27 +8,41 @@ from .MacPayload import MacPayload
 
 class PhyPayload:
 
+    __slots__ = ("nwkey", "appkey", "mhdr", "direction", "mac_payload", "mic")
+
     def __init__(self, nwkey, appkey):
         self.nwkey = nwkey
         self.appkey = appkey
+        self.mhdr = None
+        self.direction = None
+        self.mac_payload = None
+        self.mic = None
 
     def read(self, packet):
+        """
+        the fields are memoryview slices of packet, not copies, so packet must not be
+        re-used until this message has been finished with
+        """
         if len(packet) < 12:
             raise MalformedPacketException("Invalid lorawan packet")
         
-        self.mhdr = MHDR(packet[0])
-        self.mic = packet[-4:]
+        if type(packet) is not list:
+            packet = memoryview(packet)
+        self.set_mhdr(packet[0])
+        self.mic = bytes(packet[-4:])
         self.set_direction()
         try:
-            self.mac_payload = MacPayload()
+            if self.mac_payload is None:
+                self.mac_payload = MacPayload()
             self.mac_payload.read(self.get_mhdr().get_mtype(), packet[1:-4])
         except Exception as e:
             raise MalformedPacketException(f"cannot read packet {e}");
 
     def create(self, mhdr, args):
-        self.mhdr = MHDR(mhdr)
+        self.set_mhdr(mhdr)
         self.set_direction()
-        self.mac_payload = MacPayload()
+        if self.mac_payload is None:
+            self.mac_payload = MacPayload()
         self.mac_payload.create(self.get_mhdr().get_mtype(), self.appkey, args)
         self.mic = None
 
@@ -45,13 +59,22 @@ class PhyPayload:
         return self.mhdr;
 
     def set_mhdr(self, mhdr):
-        self.mhdr = mhdr
+        """mhdr can be an MHDR or the header byte"""
+        if type(mhdr) is MHDR:
+            self.mhdr = mhdr
+        elif self.mhdr is None:
+            self.mhdr = MHDR(mhdr)
+        else:
+            self.mhdr.set(mhdr)
 
     def get_direction(self):
         return self.direction.get()
 
     def set_direction(self):
-        self.direction = Direction(self.get_mhdr())
+        if self.direction is None:
+            self.direction = Direction(self.get_mhdr())
+        else:
+            self.direction.set(self.get_mhdr())
 
     def get_mac_payload(self):
         return self.mac_payload
@@ -75,9 +98,13 @@ class PhyPayload:
 
     def valid_mic(self):
         if self.get_mhdr().get_mtype() == MHDR.JOIN_ACCEPT:
-            return self.get_mic() == self.mac_payload.frm_payload.encrypt_payload(self.appkey, self.get_direction(), self.get_mhdr())[-4:]
+            # the MIC is encrypted along with the payload so compare it with the decrypted one
+            frm_payload = self.mac_payload.frm_payload
+            if frm_payload.clear_mic is None:
+                frm_payload.decrypt_payload(self.appkey, self.get_direction(), self.mic)
+            return frm_payload.valid_mic(self.appkey, self.get_mhdr())
         else:
-            return self.get_mic() == self.mac_payload.frm_payload.compute_mic(self.nwkey, self.get_direction(), self.get_mhdr())
+            return list(self.get_mic()) == self.mac_payload.frm_payload.compute_mic(self.nwkey, self.get_direction(), self.get_mhdr())
 
     def get_devaddr(self):
         if self.get_mhdr().get_mtype() == MHDR.JOIN_ACCEPT:
@@ -1,4 +1,21 @@
 from .PhyPayload import PhyPayload
+from .FrameEncoder import encode_uplink, frame_length
+
+# released PhyPayload objects, re-used by new() along with their MHDR, FHDR,
+# MacPayload etc. so building a message doesn't allocate a new object tree
+POOL_SIZE = 2
+_pool = []
 
 def new(nwkey = [], appkey = []):
+    if _pool:
+        msg = _pool.pop()
+        msg.nwkey = nwkey
+        msg.appkey = appkey
+        msg.mic = None
+        return msg
     return PhyPayload(nwkey, appkey)
+
+def release(msg):
+    """give a message from new() back for re-use. It must not be used afterwards"""
+    if len(_pool) < POOL_SIZE and msg not in _pool:
+        _pool.append(msg)
@@ -23,16 +23,31 @@ import time
 import gc
 import traceback
 
+try:
+    import asyncio
+except ImportError:
+    asyncio = None # only needed by the async API (send_async, join_async), adafruit_asyncio on CircuitPython
+
 
 from .SX127x.LoRaRadio import LoRa, MODE
 from .SX127x.board_config import BOARD
-from .SX127x.constants import BW
+from .SX127x.constants import BW, IRQ
+from .SX127x.RadioProfile import ProfileTable, profile_pair, RX_WINDOW_MARGIN
 from .LoRaWAN import new as lorawan_msg
+from .LoRaWAN import release as lorawan_release
+from .LoRaWAN import encode_uplink, frame_length
+from .LoRaWAN.FrameDecoder import DownlinkFrame
+from .LoRaWAN.Keystream import Keystream
+from .LoRaWAN.Direction import Direction
 from .LoRaWAN import MalformedPacketException
 from .LoRaWAN.MHDR import MHDR
+from .LoRaWAN.AES_CMAC import get_cmac
     
 
 from .MAChandler import MAC_commands
+from .UplinkQueue import Uplink, UplinkQueue
+from .DutyCycle import DutyCycleLedger
+from .FairUse import FairUseLedger
 from .Config import JsonConfig
 from .Strings import *
 
@@ -48,6 +63,34 @@ VERBOSE=True
 # dio_mappings
 txDone_map=[1,0,0,0,0,0]
 rxDone_map=[0,0,0,0,0,0]
+cadDone_map=[2,2,0,0,0,0]   # DIO0 CadDone, DIO1 CadDetected
+
+# seconds between checks for TxDone/RxDone. The MCU can sleep in between
+IRQ_POLL_INTERVAL=0.001
+
+# TX and RX window times are kept in integer time.monotonic_ns(). CircuitPython's
+# float time.monotonic() loses resolution with uptime, about 8ms after a day and
+# 60ms after a week, which would open the short RX single windows late
+NS_PER_S=1000000000
+RX_WINDOW_MARGIN_NS=int(RX_WINDOW_MARGIN*NS_PER_S)
+
+def seconds_ns(seconds):
+    """:return: seconds as integer nanoseconds"""
+    return int(seconds*NS_PER_S)
+
+# longest downlink once its preamble has been detected (SF12, 51 byte payload)
+MAX_DOWNLINK_AIRTIME=3.0
+
+# MHDR(1) AppEUI(8) DevEUI(8) DevNonce(2) MIC(4)
+JOIN_REQUEST_LENGTH=23
+
+# uplinks kept waiting for duty cycle budget, see queue()
+UPLINK_QUEUE_LENGTH=8
+
+# listen before talk. CAD takes about 2 symbols (66ms at SF12)
+CAD_TIMEOUT=0.25
+LBT_ATTEMPTS=4      # channels to try before transmitting anyway
+LBT_BACKOFF=500     # max ms to wait when every channel has been found busy
 
 class radioSettings:
     # used by configureRadio
@@ -105,7 +148,13 @@ class Handler(LoRa):
         
         self.txDone=False
         self.rxDone=False
+        self.txBuffer=bytearray(256)   # uplinks are encoded straight into this (FIFO size)
+        self.rxFrame=DownlinkFrame()   # re-used to decode every downlink
+        self.keystream=Keystream()     # FRMPayload keystream for the next uplink, see prepareNextUplink()
+        self.devAddr=0                 # int, big endian, used to filter downlinks. See loadSessionKeys()
         self.dutyCycle=0  # set when selecting a JOIN frequency
+        self.radioProfiles={}          # (freq,sf,bw) -> RadioProfile, see getRadioProfile()
+        self.profileTables={}          # channel list name -> (MAC channelsVersion,ProfileTable), see getProfileTable()
 
         try:
             """
@@ -133,31 +182,58 @@ class Handler(LoRa):
 
         # for downlink DATA messages
         self.downlinkCallback=None
+        self.pendingCallbacks=[]     # coroutines returned by an async downlinkCallback, see runPendingCallbacks()
+        self.radioLock=asyncio.Lock() if asyncio else None # one async transmission at a time
         
         # status
         self.transmitting=False
         self.validMsgRecvd=False     # used to detect valid msg receive in RX1
         
-        self.txStart=None            # used to compute last airTime for FUP management
+        self.txStart=None            # when the last transmission started/ended (time.monotonic_ns())
         self.txEnd=None
+        self.txAirTime=0             # calculated time on air of the last transmission, see lastAirTime()
+        self.txChannels=None         # JOIN_FREQS or TX_FREQS, the channel list of the last transmission
+        
+        # seconds of airtime used per sub-band (duty cycle table entry) since start up
+        # the last entry is for frequencies not in the table
+        self.airTimeUsed=[0.0]*(self.MAC.getNumSubBands()+1)
+        # rolling window of the airtime used per sub-band, kept across resets in the MAC cache
+        self.dutyCycleLedger=DutyCycleLedger(self.MAC.getSubBandDutyCycles())
+        saved=self.MAC.getDutyCycleLedger()
+        if saved:
+            self.dutyCycleLedger.load(saved)
+        # TTN fair use policy, uplink airtime and downlinks in the last 24 hours
+        self.fairUse=FairUseLedger()
+        saved=self.MAC.getFairUseLedger()
+        if saved:
+            self.fairUse.load(saved)
+        
+        self.uplinks=UplinkQueue(UPLINK_QUEUE_LENGTH) # see queue() and sendQueued()
+        
+        # ABP keys, or OTAA keys cached in NVM, can be expanded now
+        if self.registered():
+            self.loadSessionKeys()
         
         # if we are a class C device we should be listening unless transmitting
         # but we can only liste if we have joined
         
         if self.registered() and self.getDeviceClass()=="C":
-            self.configureRadio(RadioSteetings.RX2)
-            self.set_mode(MODE.RXCONT)
+            self.set_dio_mapping(rxDone_map)
+            self.switchToRX2()
             
 
     def setDownlinkCallback(self,func=None):
         """
         Configure the callback function which will receive
-        two parameters: decodedPayload and mtype.
+        three parameters: decodedPayload, mtype and FPort.
 
         decodedPayload will be a bytearray. It may be decodable as ascii.
         
         mtype will be MHDR.UNCONF_DATA_DOWN or MHDR.CONF_DATA_DOWN.
 
+        The callback may be an async function when the async API (send_async,
+        join_async, receive_async) is used. It is awaited once the RX windows have closed.
+
         See test_downlink.py for usage.
 
         func: function to call when a downlink message is received
@@ -168,16 +244,21 @@ class Handler(LoRa):
         else:
             log.error(f"downlinkCallback is not callable. Type was {type(func)}")
         
-    def configureRadio(self,cfg):
+    def configureRadio(self,cfg,avoid=None):
         """
         change radio settings
         
         called whenever there's a change of radio settings
         
         :param cfg: (see radioSettings class)
+        :param avoid: JOIN/SEND channel indexes not to use, see listenBeforeTalk()
         """
         freq,sf,bw=0,0,0
         whichCfg="unknown"
+        profile=None
+        
+        if cfg in (radioSettings.JOIN,radioSettings.SEND,radioSettings.TEST):
+            self.txChannels=None    # set below if sent on a channel of the frequency plan
         
         if cfg==radioSettings.TEST:
             freq,sf,bw=radioTestCfg
@@ -188,15 +269,19 @@ class Handler(LoRa):
                 freq,sf,bw=radioTestCfg # fixed frequency 
                 whichCfg="TEST"
             else:
-                freq,sf,bw=self.MAC.getJoinSettings()
+                freq,sf,bw=self.MAC.getJoinSettings(avoid)
+                profile=self.getProfileTable(JOIN_FREQS).get(self.MAC.currentChannel,self.MAC.getDataRate())
                 whichCfg="JOIN"
+                self.txChannels=JOIN_FREQS
         elif cfg==radioSettings.SEND:
             # return a randomly selected frequency from ALL available channels
-            freq,sf,bw=self.MAC.getSendSettings()
+            freq,sf,bw=self.MAC.getSendSettings(avoid)
+            profile=self.getProfileTable(TX_FREQS).get(self.MAC.currentChannel,self.MAC.getDataRate())
             whichCfg="SEND"
+            self.txChannels=TX_FREQS
         elif cfg==radioSettings.RX1:
-            # freq is normally the same as the SEND freq unless a MAC command has changed that
-            freq,sf,bw=self.MAC.getRX1Settings()
+            profile=self.getRX1Profile()
+            freq,sf,bw=profile.freq,profile.sf,profile.bw
             whichCfg="RX1"
         elif cfg==radioSettings.RX2:
             freq,sf,bw=self.MAC.getRX2Settings()
@@ -205,20 +290,99 @@ class Handler(LoRa):
             log.error(f"configureRadio unknown config {cfg}")
             raise Exception(f"Unknown radio config {cfg}")
         
-        self.set_pa_config(
-            pa_select=1,
-            max_power=self.config[TTN][MAX_POWER],
-            output_power=self.config[TTN][OUTPUT_POWER]
-            )
-   
+        if profile is None:
+            # downlinks are sent with the I and Q signals inverted
+            invertIQ=1 if cfg in (radioSettings.RX1,radioSettings.RX2) else 0
+            profile=self.getRadioProfile(freq,sf,bw,invertIQ) # raises a runtime error if freq is invalid
+        
         log.info(f"configureRadio {whichCfg} freq={freq} sf={sf} bw={bw} max power{self.config[TTN][MAX_POWER]} output power {self.config[TTN][OUTPUT_POWER]}")
    
         # now configure the radio
         self.set_mode(MODE.STDBY)
         self.dutyCycle=self.MAC.getMaxDutyCycle(freq)
-        self.set_freq(freq) # this will raise a runtime error if freq is invalid or frequency not set
-        self.set_spreading_factor(sf)
-        self.set_bw(bw)
+        self.set_profile(profile)
+        
+    def _profileSettings(self):
+        """RadioProfile keyword arguments from the config"""
+        return {
+            "max_power":self.config[TTN][MAX_POWER],
+            "output_power":self.config[TTN][OUTPUT_POWER],
+            "sync_word":self.config[TTN][SYNC_WORD],
+            "rx_crc":self.config[TTN][RX_CRC],
+            }
+        
+    def getProfileTable(self,channels,invertIQ=0):
+        """
+        return the ProfileTable for one of the MAC channel lists
+        
+        The table is rebuilt when the MAC changes a channel frequency
+        (NewChannelReq) so the register values always match the channel list.
+        
+        :param channels: JOIN_FREQS, TX_FREQS or RX1_FREQS
+        :param invertIQ: 1 for downlink channels
+        :return: ProfileTable
+        """
+        version,table=self.profileTables.get(channels,(None,None))
+        if version!=self.MAC.channelsVersion:
+            table=ProfileTable(self.MAC.cache[channels],self.MAC.dataRates,invert_iq=invertIQ,**self._profileSettings())
+            self.profileTables[channels]=(self.MAC.channelsVersion,table)
+        return table
+        
+    def getRadioProfile(self,freq,sf,bw,invertIQ=0):
+        """
+        return the RadioProfile for a frequency and data rate which isn't in
+        one of the channel lists e.g. RX2 or the test frequency
+        
+        Profiles are created on first use and kept.
+        
+        :param freq: MHz
+        :param sf: spreading factor
+        :param bw: BW register value
+        :param invertIQ: 1 for the RX windows, 0 for transmitting
+        :return: RadioProfile
+        """
+        key=(freq,sf,bw)
+        profile=self.radioProfiles.get(key)
+        if profile is None:
+            profile=profile_pair(freq,sf,bw,**self._profileSettings())
+            self.radioProfiles[key]=profile
+        return profile.rx if invertIQ else profile
+        
+    def loadSessionKeys(self):
+        """
+        expand the session keys once, after a join or when ABP/cached keys are loaded.
+        Also caches the devaddr as an int for filtering downlinks.
+        
+        The keyed CMAC (NwkSKey) and cipher (AppSKey) objects are re-used for every
+        uplink and downlink so the keys and CMAC subkeys are not recomputed per frame.
+        """
+        self.devAddr=int.from_bytes(self.MAC.getDevAddr(),"big")
+        
+        nwkskey=self.MAC.getNwkSKey()
+        appskey=self.MAC.getAppSKey()
+        if not nwkskey or not appskey:
+            log.debug("loadSessionKeys() no session keys yet")
+            return
+        get_cmac(nwkskey)
+        get_cmac(appskey)
+        
+        self.keystream.invalidate()
+        self.prepareNextUplink()
+        
+    def prepareNextUplink(self):
+        """
+        generate the payload keystream for the next FCntUp while the radio is idle
+        so that sending only has to XOR the payload with it.
+        
+        Called after each uplink and whenever the session keys change
+        """
+        appskey=self.MAC.getAppSKey()
+        FCntUp=self.MAC.getFCntUp()
+        if not appskey or FCntUp is None:
+            return
+        devaddr=self.MAC.getDevAddr()
+        devaddr.reverse() # over the air order
+        self.keystream.precompute(appskey,Direction.UP,devaddr,FCntUp)
         
     def getDutyCycle(self):
         """duty cycle is set when frequency is known. I am using one of the JOIN frequencys for that"""
@@ -244,129 +408,131 @@ class Handler(LoRa):
         log.debug(f"appkey {appkey}")
         
         lorawan = lorawan_msg([], appkey) # create the phyPayload object
-        lorawan.read(PhyPayload)          # and load the phyPayload into it
+        try: # the pooled message is released however this returns
+            lorawan.read(PhyPayload)          # and load the phyPayload into it
                 
-        decodedPayload=lorawan.get_payload() # calls lorawan.mac_payload.frm_payload.decrypt_payload(self.appkey, self.get_direction(), self.mic)
+            decodedPayload=lorawan.get_payload() # calls lorawan.mac_payload.frm_payload.decrypt_payload(self.appkey, self.get_direction(), self.mic)
         
-        log.debug(f"decoded_payload {decodedPayload}")
+            log.debug(f"decoded_payload {decodedPayload}")
        
         
-        try:
-            log.debug("Checking MIC")
-            lorawan.valid_mic() # throws an exception if MIC not valid
-            log.debug("MIC is valid")
-        except Exception as e:
-            # if decoding failed it probably isn't a valid lorawan packet
-            log.error(f"Invalid MIC in JOIN_ACCEPT msg: {e}")
-            traceback.print_exception(e)
-            return
+            try:
+                log.debug("Checking MIC")
+                if not lorawan.valid_mic():
+                    log.error("Invalid MIC in JOIN_ACCEPT msg, ignored")
+                    return
+                log.debug("MIC is valid")
+            except Exception as e:
+                # if decoding failed it probably isn't a valid lorawan packet
+                log.error(f"Invalid MIC in JOIN_ACCEPT msg: {e}")
+                traceback.print_exception(e)
+                return
               
-        self.MAC.setLastSNR(self.get_pkt_snr_value()) # used for last status req
+            self.MAC.setLastSNR(self.get_pkt_snr_value()) # used for last status req
         
-        # if we receive a valid message in RX1 we don't need
-        # to switch to RX2
-        self.validMsgRecvd=True
+            # if we receive a valid message in RX1 we don't need
+            # to switch to RX2
+            self.validMsgRecvd=True
+            self.recordDownlink()
             
-        # values from the JOIN_ACCEPT payload
-        # spec says payload is
-        # join_nonce:3,netId:3;devaddr:4,DL_settings:1,RX_delay:1,cfList:16 (optional)
+            # values from the JOIN_ACCEPT payload
+            # spec says payload is
+            # join_nonce:3,netId:3;devaddr:4,DL_settings:1,RX_delay:1,cfList:16 (optional)
                
-        frm_payload=lorawan.get_mac_payload().get_frm_payload()
+            frm_payload=lorawan.get_mac_payload().get_frm_payload()
         
-        log.debug(f"FRM payload {frm_payload}")
+            log.debug(f"FRM payload {frm_payload}")
             
             
-        self.MAC.setRX1Delay(frm_payload.get_rxdelay())
-        self.MAC.setDLsettings(frm_payload.get_dlsettings())
+            self.MAC.setRX1Delay(frm_payload.get_rxdelay())
+            self.MAC.setDLsettings(frm_payload.get_dlsettings())
 
             
-        # cflist is optional.
-        # it defines the 5 additional lora frequencies following the
-        # 3 standard join frequencies. 
-        # I found this delivers the same frequencies in the config toml
-        # lora_freqs[3..7] which came from the TTN frequency plan
-        # Un-comment the following lines
-        # to use
-        # cflist=frm_payload.get_cflist())
-        # self.MAC.handleCFlist(cflist)
+            # cflist is optional.
+            # it defines the 5 additional lora frequencies following the
+            # 3 standard join frequencies. 
+            # I found this delivers the same frequencies in the config toml
+            # lora_freqs[3..7] which came from the TTN frequency plan
+            # Un-comment the following lines
+            # to use
+            # cflist=frm_payload.get_cflist())
+            # self.MAC.handleCFlist(cflist)
             
-        devaddr=lorawan.get_devaddr()
-        nwkskey=lorawan.derive_nwskey(self.devnonce)
-        appskey=lorawan.derive_appskey(self.devnonce)
+            devaddr=lorawan.get_devaddr()
+            nwkskey=lorawan.derive_nwskey(self.devnonce)
+            appskey=lorawan.derive_appskey(self.devnonce)
+        finally:
+            lorawan_release(lorawan)
                 
 
         self.MAC.setDevAddr(devaddr)
         self.MAC.setNwkSKey(nwkskey)
         self.MAC.setAppSKey(appskey)
 
-        log.info(f"process_JOIN_ACCEPT: devaddr: {devaddr}")
+        log.info(f"process_JOIN_ACCEPT: devaddr: {devaddr:08x}")
         log.info(f"process_JOIN_ACCEPT: nwkskey: {nwkskey}")
         log.info(f"process_JOIN_ACCEPT: appskey: {appskey}")
                
         # reset FCntUp after every JOIN
         self.MAC.setFCntUp(1)
+        
+        self.loadSessionKeys()
                 
         # cache any changed MAC values
         self.MAC.saveCache()
             
 
-    def process_DATA_DOWN(self,rawPayload):
+    def process_DATA_DOWN(self,frame):
         """
         downlink messages can be unconfirmed or confirmed
         
         Optional parts enclosed in [] byte count enclosed in ()
         
-        rawPayload=MHDR(1),DEVADDR(4),FCTL(1),FCNT(2),[FOPTS(1..N)],[FPORT(1)],[FRM_PAYLOAD(..N)],MIC(4)
-        
-        To detect if optional parts exist we need to calc the length.
+        frame=MHDR(1),DEVADDR(4),FCTL(1),FCNT(2),[FOPTS(1..N)],[FPORT(1)],[FRM_PAYLOAD(..N)],MIC(4)
         
+        :param frame: a DownlinkFrame wrapping the received packet. Fields are read
+                      from the packet as needed so nothing is copied.
         """
+        mtype=frame.mtype
         try:
             log.debug("process_DATA_DOWN")
        
-            mtype=rawPayload[0] & 0xF0
-            
-            # check if just MAC commands
-            rawPayloadLen=len(rawPayload)
-        
-            FOptsLen=rawPayload[5] & 0x0F
-        
             # message format - only FRM_PAYLOAD (if any) is encoded in MAC 1.0.x
-            # parts enclosed in [] are optional. Size in bytes is enclosed in ()
-            # MHDR(1),DEVADDR(4),FCTL(1),FCNT(2),[FOpts(1..N)] [FPort(1)],[FRM_PAYLOAD(1..N)],MIC(4)
-            
-            msgSize=12 + FOptsLen # excluding FPort & FRM_PAYLOAD
-            
-            if (rawPayloadLen-msgSize)==0:
-                log.info("rawPayload does not have a FRMpayload or FPort - probably just a MAC command")
-                self.MAC.processFopts(rawPayload[8:8+FOptsLen])
-                return
-                    
-            # looks like a proper downlink with data sent to me
-            # so lets try to understand it
             nwkskey=self.MAC.getNwkSKey()
             appskey=self.MAC.getAppSKey()
 
-            lorawan = lorawan_msg(nwkskey,appskey)
-            lorawan.read(rawPayload)
-            
-            decodedPayload=lorawan.get_payload() # must call before valid_mic()
-            
-            log.debug(f"Decoded DATA DOWN {decodedPayload}")
-            
-            lorawan.valid_mic()
+            if not frame.valid_mic(nwkskey):
+                log.warning("DATA_DOWN MIC is invalid. Message ignored.")
+                return
 
             self.validMsgRecvd=True
+            self.recordDownlink()
             
             self.MAC.setLastSNR(self.get_pkt_snr_value()) # used for MAC status reply
+            
+            FPort=frame.fport
+            decodedPayload=None
+            
+            if FPort is None:
+                log.info("downlink does not have a FRMpayload or FPort - probably just a MAC command")
+            elif FPort==0:
+                # FRMPayload is MAC commands encrypted with the NwkSKey
+                decodedPayload=frame.decrypt(nwkskey)
+            else:
+                decodedPayload=frame.decrypt(appskey)
+            
+                log.debug(f"Decoded DATA DOWN {list(decodedPayload)}")
                 
-            if self.downlinkCallback is not None:
-                log.debug("Calling downlinkCallback function")
-                self.downlinkCallback(decodedPayload,mtype,lorawan.get_mac_payload().get_fport())
+                if self.downlinkCallback is not None:
+                    log.debug("Calling downlinkCallback function")
+                    result=self.downlinkCallback(decodedPayload,mtype,FPort)
+                    if result is not None and hasattr(result,"send"):
+                        # an async callback, the coroutine is awaited by the async API
+                        self.pendingCallbacks.append(result)
              
             # finally process any MAC commands
             log.debug("handle any downlink MAC commands")
-            self.MAC.handleCommand(lorawan.get_mac_payload())
+            self.MAC.handleCommand(frame,decodedPayload)
 
             # we may need to ACK
             if mtype==MHDR.CONF_DATA_DOWN:
@@ -380,97 +546,373 @@ class Handler(LoRa):
         """convenience method """
         log.info(f"switching to RX2 {self.config[TTN][RX2_FREQUENCY]}")
         self.set_mode(MODE.STDBY)
-        self.set_freq(self.config[TTN][RX2_FREQUENCY])
+        # RX2 has its own frequency and data rate. Not configureRadio() which would
+        # replace the duty cycle of the channel just used for the uplink
+        self.set_profile(self.getRX2Profile())
+        BOARD.dio_clear(0)
         self.set_mode(MODE.RXCONT)
         log.info("RX Window is now RX2")
                     
-    def _transmit(self,config,payload):
+    def _transmit(self,config,payload,length=None):
         """
         send the payload. Listen for downlinks during RX1 and/or RX2 then process any found
         
+        The radio sleeps between the end of the transmission and the RX windows. Each
+        window is opened in RX single mode just before it is due and closes by itself
+        (RxTimeout) if no preamble is heard, see rx_symbol_timeout().
+        
         :config: will be radioSettings.JOIN or radioSettings.SEND
         :payload: bytearray
+        :length: number of bytes of payload to send, default is all of it
         """
-        log.debug(f"_transmit payload >{payload}<")
+        log.debug(f"_transmit payload length {len(payload) if length is None else length}")
         
-        # load the payload into the RFM95 and send it
-        self.set_mode(MODE.STDBY)
-        self.configureRadio(config)
-        self.write_payload(payload)
-        self.set_dio_mapping(txDone_map)
-        self.txStart=time.monotonic()
-        self.set_mode(MODE.TX)
+        self.startTransmit(config,payload,length)
         
         # waiting for tx_done - transmitter will go into STDBY automatically
-        # IRQ TxDone flag will be cleared
-        # on_tx_done will be called by pollInterruptRegister() which calls on_tx_done()
-
-        txDone=False
-        while not txDone:
-             txDone=self.get_irq_flags()["tx_done"]
-             if (time.monotonic() - self.txStart) > self.config["TX_TIMEOUT"]:
-                log.error(f"txDone interrupt not seen within timeout {self.config["TX_TIMEOUT"]}s")
-                self.set_mode(MODE.STDBY)
-                return
+        if not self.waitIrq(0,IRQ.TX_DONE,self.txStart+seconds_ns(self.txTimeout)):
+            log.error(f"txDone interrupt not seen within timeout {self.txTimeout}s")
+            self.set_mode(MODE.STDBY)
+            return
             
-        self.txEnd=time.monotonic()    # used (by caller) to calculate transmission time for FUP
-        self.clear_irq_flags(TxDone=1) # LoraRadio
-
-        log.info("txDone - switching to RX1")
+        self.transmitDone()
         
+        device_class=self.rxDeviceClass()
+
+        rx1Open,rx2Open=self.rxWindowTimes()
+
+        # RX1 uses the frequency plan's RX1 channel for the TX channel and the RX1 data rate
         # https://www.allaboutcircuits.com/textbook/radio-frequency-analysis-design/radio-frequency-demodulation/understanding-i-q-signals-and-quadrature-modulation/
-        self.set_invert_iq(1) # invert the LoRa I and Q signals - The Gateway sends downlinks this way to reduce interference
-        self.reset_ptr_rx()
+        # the gateway inverts the LoRa I and Q signals to reduce interference, the rx profile does the same
+        rx1Profile=self.getRX1Profile(config==radioSettings.JOIN)
+        self.sleepUntil(rx1Open-RX_WINDOW_MARGIN_NS)
+        self.openRxWindow(rx1Profile)
+        log.info("RX Window is now RX1")
+        rxDone=self.waitRxWindow(rx1Open+seconds_ns(self.rxWindowGuard()))
         
-        #rx windows for switching
-        RX1=1
-        RX2=2
+        if not rxDone:
+            self.sleepUntil(rx2Open-RX_WINDOW_MARGIN_NS)
+            if device_class=="C":
+                # class C remains listening in RX2
+                self.switchToRX2()
+                rxDone=self.waitIrq(0,IRQ.RX_DONE,rx2Open+seconds_ns(self.rxWindowGuard()))
+                if not rxDone:
+                    return
+            else:
+                self.openRxWindow(self.getRX2Profile())
+                log.info("RX Window is now RX2")
+                rxDone=self.waitRxWindow(rx2Open+seconds_ns(self.rxWindowGuard()))
+                if not rxDone:
+                    log.info("Nothing received during RX1 or RX2")
+                    self.set_mode(MODE.SLEEP)
+                    return
+                                  
+        self.processDownlinks()
+        self.discardPendingCallbacks()
+
+        if device_class=="C":
+            self.switchToRX2()
+        else:
+            self.set_mode(MODE.SLEEP)
         
-        device_class=self.getDeviceClass()
+    async def _transmitAsync(self,config,payload,length=None):
+        """
+        as _transmit() but other tasks run while waiting for TxDone and for
+        the RX windows to open and close. Any async downlink callbacks are
+        awaited by the caller once the radio has finished.
         
-        if device_class not in ["A","C"]:
-            log.warning(f"Unsupported device class {device_class} falling back to class A")
-            device_class="A"
-
-        # RX1 frequency does not need setting as it is always the same as the TX frequency
-        self.set_dio_mapping(rxDone_map)
-       
-        rx1_timeout = self.MAC.getRX1Delay() + self.config[TTN][RX_WINDOW]
-        rx2_timeout = self.MAC.getRX2Delay() + self.config[TTN][RX_WINDOW]
-
-        self.set_mode(MODE.RXCONT)     # LoraRadio is already in MODE.STDBY after transmitting
-        rxStart = time.monotonic()
+        The caller must hold self.radioLock, from before the frame was encoded
+        into self.txBuffer until this returns
+        
+        :config: will be radioSettings.JOIN or radioSettings.SEND
+        :payload: bytearray
+        :length: number of bytes of payload to send, default is all of it
+        """
+        self.startTransmit(config,payload,length)
+        
+        if not await self.waitIrqAsync(0,IRQ.TX_DONE,self.txStart+seconds_ns(self.txTimeout)):
+            log.error(f"txDone interrupt not seen within timeout {self.txTimeout}s")
+            self.set_mode(MODE.STDBY)
+            return
+            
+        self.transmitDone()
+        
+        device_class=self.rxDeviceClass()
+        
+        rx1Open,rx2Open=self.rxWindowTimes()
         
-        this_rx_window = RX1
+        rx1Profile=self.getRX1Profile(config==radioSettings.JOIN)
+        await self.sleepUntilAsync(rx1Open-RX_WINDOW_MARGIN_NS)
+        self.openRxWindow(rx1Profile)
         log.info("RX Window is now RX1")
+        rxDone=await self.waitRxWindowAsync(rx1Open+seconds_ns(self.rxWindowGuard()))
         
-        rxDone=False
-        while not rxDone:  # can be set in RX1 or RX2 windows
-            # do this first as it can call on_rx_done which sets rxDone
-            rxDone=self.get_irq_flags()["rx_done"]
-             
-            if not rxDone and this_rx_window == RX1:
-                if (time.monotonic() - rxStart) > rx1_timeout:
-                    self.switchToRX2()
-                    this_rx_window=RX2
-            elif not rxDone and this_rx_window == RX2:
-                if (time.monotonic() - rxStart) > rx2_timeout:
-                    
-                    # class C remains listening in RX2
-                    if device_class=="A":
-                        log.info("Nothing received during RX1 or RX2")
-                        self.set_mode(MODE.SLEEP)
+        if not rxDone:
+            await self.sleepUntilAsync(rx2Open-RX_WINDOW_MARGIN_NS)
+            if device_class=="C":
+                self.switchToRX2()
+                rxDone=await self.waitIrqAsync(0,IRQ.RX_DONE,rx2Open+seconds_ns(self.rxWindowGuard()))
+                if not rxDone:
                     return
-                                  
-        self.clear_irq_flags(RxDone=1) # LoraRadio
+            else:
+                self.openRxWindow(self.getRX2Profile())
+                log.info("RX Window is now RX2")
+                rxDone=await self.waitRxWindowAsync(rx2Open+seconds_ns(self.rxWindowGuard()))
+                if not rxDone:
+                    log.info("Nothing received during RX1 or RX2")
+                    self.set_mode(MODE.SLEEP)
+                    return
+                              
         self.processDownlinks()
-
-        # class C remains listening in RX2
-        if (this_rx_window!=RX2) and (device_class=="C"):
+        
+        if device_class=="C":
             self.switchToRX2()
         else:
             self.set_mode(MODE.SLEEP)
         
+    def rxDeviceClass(self):
+        """the device class which decides how the RX windows are used, A or C"""
+        device_class=self.getDeviceClass()
+        if device_class not in ["A","C"]:
+            log.warning(f"Unsupported device class {device_class} falling back to class A")
+            device_class="A"
+        return device_class
+        
+    def startTransmit(self,config,payload,length=None):
+        """
+        load the payload into the RFM95 and start sending it
+        
+        :config: radioSettings.JOIN or radioSettings.SEND
+        :payload: bytearray
+        :length: number of bytes of payload to send, default is all of it
+        """
+        self.set_mode(MODE.STDBY)
+        # prefer a channel whose sub-band has duty cycle budget left
+        avoid=self.channelsOffAir(config,self.frameAirTime(len(payload) if length is None else length))
+        self.configureRadio(config,avoid)
+        if self.config[TTN].get(LBT,0):
+            self.listenBeforeTalk(config,avoid)
+        self.write_payload(payload,length)
+        self.txAirTime=self.profile.time_on_air(len(payload) if length is None else length)
+        # the channel, so the sub-band, is only known now. Recorded and written to NVM,
+        # with the FCntUp set by encodeUplink(), before transmitting so a reset can't lose it
+        self.recordAirTime(self.profile.freq,self.txAirTime)
+        self.MAC.saveCache()
+        self.set_dio_mapping(txDone_map)
+        BOARD.dio_clear(0)
+        self.txStart=time.monotonic_ns()
+        self.set_mode(MODE.TX)
+        
+    def listenBeforeTalk(self,config,avoid=None):
+        """
+        check the channel chosen by configureRadio() is quiet before transmitting
+        
+        If a LoRa preamble is detected another channel is chosen. Once every
+        channel has been found busy the busy list is cleared and the device
+        waits a random time before checking again. After LBT_ATTEMPTS checks
+        the packet is sent on the last channel chosen.
+        
+        :config: radioSettings.JOIN or radioSettings.SEND
+        :param avoid: channel indexes not to use anyway, see channelsOffAir()
+        :return: True if a quiet channel was found
+        """
+        avoid=avoid or []
+        busy=list(avoid)
+        for attempt in range(LBT_ATTEMPTS):
+            if not self.channelActivity():
+                return True
+            log.info(f"listen before talk: channel {self.MAC.currentChannel} ({self.profile.freq}) busy")
+            busy.append(self.MAC.currentChannel)
+            if len(busy)>=len(self.MAC.cache[JOIN_FREQS if config==radioSettings.JOIN else TX_FREQS]):
+                busy=list(avoid)
+                time.sleep(randrange(LBT_BACKOFF)/1000)
+            self.configureRadio(config,busy)
+        log.warning("listen before talk: no quiet channel found, transmitting anyway")
+        return False
+        
+    def channelActivity(self):
+        """
+        run a channel activity detection (CAD) with the current profile
+        
+        The radio returns to STDBY when CAD is done
+        
+        :return: True if a LoRa preamble was detected
+        """
+        self.set_mode(MODE.STDBY)
+        self.clear_irq(IRQ.CAD_DONE|IRQ.CAD_DETECTED)
+        self.set_dio_mapping(cadDone_map)
+        BOARD.dio_clear(0)
+        self.set_mode(MODE.CAD)
+        if not self.waitIrq(0,IRQ.CAD_DONE,time.monotonic_ns()+seconds_ns(CAD_TIMEOUT)):
+            log.warning("CadDone not seen, assuming the channel is quiet")
+            self.set_mode(MODE.STDBY)
+            return False
+        detected=(self.get_irq() & IRQ.CAD_DETECTED)!=0
+        self.clear_irq(IRQ.CAD_DONE|IRQ.CAD_DETECTED)
+        return detected
+        
+    def transmitDone(self):
+        """
+        called when TxDone has been seen. Puts the radio to sleep until the RX windows
+        """
+        self.txEnd=time.monotonic_ns()
+        self.clear_irq(IRQ.TX_DONE) # LoraRadio
+        self.set_mode(MODE.SLEEP)
+        log.info("txDone - radio sleeping till RX1")
+        
+    def rxWindowTimes(self):
+        """
+        RX1 opens RX1Delay seconds after the end of the uplink and RX2 a further
+        RX2Delay seconds later (normally 1s)
+        
+        :return: (rx1Open,rx2Open) in time.monotonic_ns() nanoseconds
+        """
+        rx1Open=self.txEnd+seconds_ns(self.MAC.getRX1Delay())
+        return rx1Open,rx1Open+seconds_ns(self.MAC.getRX2Delay())
+        
+    def rxWindowGuard(self):
+        """
+        seconds to wait for RxDone/RxTimeout after a window opens. The radio
+        ends the window itself, this only guards against a missing interrupt.
+        A downlink, once its preamble is heard, can take nearly 3s at SF12
+        """
+        return self.config[TTN][RX_WINDOW]+MAX_DOWNLINK_AIRTIME
+        
+    def getRX1Profile(self,join=False):
+        """
+        the (IQ inverted) RadioProfile for RX1 after the last transmission: the
+        frequency plan's RX1 channel for the TX channel, unless a MAC command has
+        fixed the RX1 frequency, at the RX1 data rate (uplink DR less RX1DROffset)
+        
+        :param join: True after a join request, the join accept uses RX1DROffset 0
+        :return: RadioProfile
+        """
+        if self.txChannels is None:
+            # sent on the test frequency, listen on the same one
+            return self.profile.rx
+        dr=self.MAC.getRX1DataRate(0 if join else None)
+        if self.MAC.cache[RX1_FREQ_FIXED]:
+            sf,bw=self.MAC.dataRates[dr]
+            return self.getRadioProfile(self.MAC.cache[RX1_FREQUENCY],sf,bw,1)
+        return self.getProfileTable(RX1_FREQS,1).get(self.MAC.currentChannel,dr)
+        
+    def getRX2Profile(self):
+        """the (IQ inverted) RadioProfile for the RX2 frequency and data rate"""
+        freq,sf,bw=self.MAC.getRX2Settings()
+        return self.getRadioProfile(freq,sf,bw,1)
+        
+    def sleepUntil(self,when):
+        """
+        :param when: time.monotonic_ns() value
+        """
+        delay=when-time.monotonic_ns()
+        if delay>0:
+            time.sleep(delay/NS_PER_S)
+        
+    async def sleepUntilAsync(self,when):
+        """
+        :param when: time.monotonic_ns() value
+        """
+        delay=when-time.monotonic_ns()
+        if delay>0:
+            await asyncio.sleep(delay/NS_PER_S)
+        
+    def openRxWindow(self,profile):
+        """
+        start an RX single receive, the radio returns to STDBY on RxDone or RxTimeout
+        
+        :param profile: RadioProfile with IQ inverted
+        """
+        self.set_mode(MODE.STDBY)
+        self.set_profile(profile)
+        self.reset_ptr_rx()
+        self.set_dio_mapping(rxDone_map)   # DIO0 RxDone, DIO1 RxTimeout
+        BOARD.dio_clear(0)
+        BOARD.dio_clear(1)
+        self.set_mode(MODE.RXSINGLE)
+        
+    def waitRxWindow(self,deadline):
+        """
+        wait for an RX single window to end
+        
+        :param deadline: time.monotonic_ns() value to give up at
+        :return: True if a message was received (RxDone), False on RxTimeout or deadline
+        """
+        while True:
+            ended=self.rxWindowEnded(deadline)
+            if ended is not None:
+                return ended
+            time.sleep(IRQ_POLL_INTERVAL)
+        
+    async def waitRxWindowAsync(self,deadline):
+        """
+        as waitRxWindow() but lets other tasks run between checks
+        """
+        while True:
+            ended=self.rxWindowEnded(deadline)
+            if ended is not None:
+                return ended
+            await asyncio.sleep(IRQ_POLL_INTERVAL)
+        
+    def rxWindowEnded(self,deadline):
+        """
+        check if an RX single window has ended
+        
+        :param deadline: time.monotonic_ns() value to give up at
+        :return: None if the window is still open, True if a message was
+                 received (RxDone), False on RxTimeout or deadline
+        """
+        if self.irqSeen(0,IRQ.RX_DONE):
+            return True
+        if self.irqSeen(1,IRQ.RX_TIMEOUT):
+            self.clear_irq(IRQ.RX_TIMEOUT) # LoraRadio
+            return False
+        if time.monotonic_ns()>deadline:
+            log.warning("RX window did not end, no RxTimeout")
+            self.set_mode(MODE.STDBY)
+            return False
+        return None
+        
+    def waitIrq(self,dio,mask,deadline):
+        """
+        wait for a radio interrupt, see irqSeen()
+        
+        :param dio: 0 or 1, the DIO pin the IRQ is mapped to
+        :param mask: the IRQ flag to check when the pin isn't available e.g. IRQ.RX_DONE
+        :param deadline: time.monotonic_ns() value to give up at
+        :return: True if the IRQ fired before the deadline
+        """
+        while not self.irqSeen(dio,mask):
+            if time.monotonic_ns()>deadline:
+                return False
+            time.sleep(IRQ_POLL_INTERVAL)
+        return True
+        
+    async def waitIrqAsync(self,dio,mask,deadline):
+        """
+        as waitIrq() but lets other tasks run between checks
+        """
+        while not self.irqSeen(dio,mask):
+            if time.monotonic_ns()>deadline:
+                return False
+            await asyncio.sleep(IRQ_POLL_INTERVAL)
+        return True
+        
+    def irqSeen(self,dio,mask):
+        """
+        check for a radio interrupt
+        
+        Reads the DIO pin the IRQ is mapped to, if it is wired, otherwise
+        falls back to reading the IRQ flags register over SPI.
+        
+        :param dio: 0 or 1, the DIO pin the IRQ is mapped to (see txDone_map/rxDone_map)
+        :param mask: the IRQ flag to check when the pin isn't available e.g. IRQ.RX_DONE
+        :return: True if the IRQ has fired
+        """
+        if BOARD.dio_available(dio):
+            return BOARD.dio_fired(dio)
+        return (self.get_irq() & mask)!=0
+
     def payloadToDecList(self,payload):
         """convenience function for nice log message formatting
         Note adafruit_logging can crash on non-ascii
@@ -489,16 +931,17 @@ class Handler(LoRa):
         log.debug("Received downlink message...")
   
               
-        # read the payload from the radio
-        # this may or may not be a valid lorawan message
-        rawPayload = self.read_payload(nocheck=True)
+        # read the payload from the radio into its receive buffer
+        # this may or may not be a valid lorawan message. None if the CRC failed
+        rawPayload = self.read_payload_into()
+        self.clear_irq(IRQ.RX_DONE|IRQ.PAYLOAD_CRC_ERROR) # LoraRadio
         
-        log.debug(f"raw payload {self.payloadToDecList(rawPayload)}")
-                
         if rawPayload is None:
-            log.debug("rawPayload is None")
+            log.debug("rawPayload is None, CRC error")
             return
 
+        log.debug(f"raw payload {self.payloadToDecList(rawPayload)}")
+
         # 12 bytes is the absolute minimum rawPayload length
         if len(rawPayload)<12:
             log.debug("received invalid message. Too small.")
@@ -519,37 +962,245 @@ class Handler(LoRa):
             log.debug(f"received a message mtype={mtype} but we haven't joined yet. Ignored.")
             return
            
-        # check the destination devaddr
-        
-        destAddr=list(rawPayload[1:5])           # devaddr is little endian in the message received
-        destAddr.reverse()                       # make it big-endian
-        devAddr=list(self.MAC.getDevAddr())      # I store it big-endian so it looks the same as in the TTN console
+        # check the destination devaddr without decoding anything else
+        frame=self.rxFrame.wrap(rawPayload)
         
-        log.debug(f"Received destAddr {destAddr} my devAddr {devAddr}")
-        if destAddr!=devAddr:
+        if not frame.is_for(self.devAddr):
             # message is not for me
-            log.debug("downlink message is not addressed to me")
+            log.debug(f"downlink message is not addressed to me {hex(frame.devaddr)}")
+            return
+        
+        if not frame.is_valid():
+            log.debug("received invalid message. FOpts too long.")
             return
                
         # process any other downlink messages
         if mtype==MHDR.UNCONF_DATA_DOWN or mtype==MHDR.CONF_DATA_DOWN:
-            self.process_DATA_DOWN(rawPayload)
+            self.process_DATA_DOWN(frame)
             return
                 
         log.debug(f"Unhandled mtype {mtype}. Message ignored.")        
 
+    async def runPendingCallbacks(self):
+        """await the coroutines returned by an async downlinkCallback"""
+        while self.pendingCallbacks:
+            await self.pendingCallbacks.pop(0)
+            
+    def discardPendingCallbacks(self):
+        """an async downlinkCallback can't be awaited by the blocking API (send, join, receive)"""
+        for coro in self.pendingCallbacks:
+            log.warning("async downlinkCallback not run, use send_async(), join_async() or receive_async()")
+            coro.close()
+        self.pendingCallbacks=[]
 
     def lastAirTime(self):
         """
             return the duration of the last transmission
             enables user to adhere to LoRa Duty Cycle & TTN FUP
+            
+            This is the calculated time on air, it does not include SPI or polling delays
 
         :return: time of last transmission or 0 (none)
 
         """
-        if self.txStart is not None and self.txEnd is not None:
-            return self.txEnd-self.txStart
-        return 0
+        return self.txAirTime
+
+    def timeOnAir(self,payloadLen,port=1,dr=None):
+        """
+        how long an uplink would take to send, before sending it
+        
+        Includes any MAC command answers waiting to go with the next uplink.
+        
+        :param payloadLen: length of the application payload in bytes
+        :param port: FPort, None for a frame without one
+        :param dr: data rate, default is the current data rate
+        :return: seconds
+        """
+        return self.frameAirTime(frame_length(payloadLen,len(self.MAC.macReplies),port),dr)
+
+    def frameAirTime(self,length,dr=None):
+        """
+        :param length: PHY payload (whole frame) length in bytes
+        :param dr: data rate, default is the current data rate
+        :return: seconds
+        """
+        if dr is None:
+            dr=self.MAC.getDataRate()
+        # all channels have the same timing for a data rate
+        return self.getProfileTable(TX_FREQS).get(0,dr).time_on_air(length)
+
+    def getMaxPayload(self,dr=None):
+        """
+        :param dr: data rate, default is the current data rate
+        :return: the longest message, in bytes, which can be sent in one uplink
+        """
+        return self.MAC.getMaxPayload(dr)
+
+    def recordAirTime(self,freq,airTime,start=None):
+        """
+        add a transmission to the airtime ledgers
+        
+        The ledgers are kept in the MAC cache. startTransmit() records the
+        transmission, and writes the cache to NVM, just before transmitting so
+        the airtime survives a reset, or deep sleep, straight after the uplink
+        
+        :param freq: MHz
+        :param airTime: seconds
+        :param start: time.monotonic() when the transmission started, default is now
+        """
+        subBand=self.subBandIndex(freq)
+        self.airTimeUsed[subBand]+=airTime
+        
+        if start is None:
+            start=time.monotonic()
+        self.dutyCycleLedger.record(subBand,start,airTime)
+        self.fairUse.record(FairUseLedger.UPLINK,start,airTime)
+        self.MAC.setLedgers(self.dutyCycleLedger.save(),self.fairUse.save())
+
+    def recordDownlink(self):
+        """
+        count a downlink for the TTN fair use policy. Not written to NVM here,
+        the MAC cache is saved once the join accept or downlink has been
+        processed (MAC.handleCommand() always saves)
+        """
+        self.fairUse.record(FairUseLedger.DOWNLINK,time.monotonic(),1)
+        self.MAC.setLedgers(fairUse=self.fairUse.save())
+
+    def getFairUseRemaining(self):
+        """
+        what is left of the TTN fair use policy allowance
+        
+        :return: (seconds of uplink airtime, number of downlinks) left in the last 24 hours
+        """
+        return self.fairUse.remaining(FairUseLedger.UPLINK),self.fairUse.remaining(FairUseLedger.DOWNLINK)
+
+    def fairUseAllows(self,payloadLen,port=1,dr=None):
+        """
+        check an uplink fits in what is left of the TTN fair use airtime. Always
+        True unless "fair_use" is set in the TTN section of settings.json
+        
+        :param payloadLen: length of the application payload in bytes
+        :param port: FPort
+        :param dr: data rate, default is the current data rate
+        :return: True if the uplink can be sent
+        """
+        if not self.config[TTN].get(FAIR_USE,0):
+            return True
+        airTime=self.timeOnAir(payloadLen,port,dr)
+        if airTime<=self.fairUse.remaining(FairUseLedger.UPLINK):
+            return True
+        log.warning(f"uplink of {airTime:.3f}s would exceed the TTN fair use airtime, not sent")
+        return False
+
+    def fairUseDataRate(self,payloadLen,port=1):
+        """
+        the slowest data rate, faster than the current one and no faster than
+        "fair_use_dr" in the TTN section of settings.json, at which an uplink fits
+        in what is left of the fair use airtime now. The RX1 data rate follows it
+        
+        Off unless "fair_use_dr" is set (-1). It must be an uplink data rate of the
+        tx_freqs channels, e.g. no more than 5 in EU868 or AU915
+        
+        :param payloadLen: length of the application payload in bytes
+        :param port: FPort
+        :return: data rate index or None if there isn't one
+        """
+        maxDR=self.config[TTN].get(FAIR_USE_DR,-1)
+        remaining=self.fairUse.remaining(FairUseLedger.UPLINK)
+        for dr in range(self.MAC.getDataRate()+1,min(maxDR,len(self.MAC.dataRates)-1)+1):
+            if payloadLen>self.getMaxPayload(dr):
+                continue
+            if self.timeOnAir(payloadLen,port,dr)<=remaining and self.earliestTransmit(payloadLen,port,dr) is not None:
+                log.info(f"uplink can be sent at DR{dr} within the TTN fair use airtime")
+                return dr
+        return None
+
+    def subBandIndex(self,freq):
+        """
+        :return: index of freq's sub-band in the airtime ledgers, the last one if it isn't in the duty cycle table
+        """
+        subBand=self.MAC.getSubBand(freq)
+        return len(self.airTimeUsed)-1 if subBand is None else subBand
+
+    def channelsOffAir(self,config=radioSettings.SEND,airTime=0,now=None):
+        """
+        the channels which the duty cycle doesn't allow a transmission on yet
+        
+        :param config: radioSettings.JOIN or radioSettings.SEND (channel list to check)
+        :param airTime: seconds, the length of the transmission
+        :param now: time.monotonic() value, default is now
+        :return: list of channel indexes
+        """
+        if now is None:
+            now=time.monotonic()
+        freqs=self.MAC.cache[JOIN_FREQS if config==radioSettings.JOIN else TX_FREQS]
+        offAir=[]
+        for ch,freq in enumerate(freqs):
+            when=self.dutyCycleLedger.earliest(self.subBandIndex(freq),airTime,now)
+            if when is None or when>now:
+                offAir.append(ch)
+        return offAir
+
+    def dutyCycleAllows(self,airTime,config=radioSettings.SEND):
+        """
+        check the duty cycle allows a transmission now on at least one channel.
+        send() and join() refuse to transmit otherwise, only queued uplinks
+        wait for the budget, see queue()
+        
+        :param airTime: seconds, the length of the transmission
+        :param config: radioSettings.JOIN or radioSettings.SEND (channel list to check)
+        :return: True if it can be sent now
+        """
+        numChannels=len(self.MAC.cache[JOIN_FREQS if config==radioSettings.JOIN else TX_FREQS])
+        if len(self.channelsOffAir(config,airTime))<numChannels:
+            return True
+        log.warning(f"{airTime:.3f}s transmission would exceed the duty cycle of every channel, not sent")
+        return False
+
+    def earliestTransmit(self,payloadLen=0,port=1,dr=None,config=radioSettings.SEND):
+        """
+        when the duty cycle next allows an uplink of payloadLen bytes at data rate
+        dr on any channel. Each sub-band has its own budget
+        
+        :param payloadLen: length of the application payload in bytes
+        :param port: FPort, None for a frame without one
+        :param dr: data rate, default is the current data rate
+        :param config: radioSettings.SEND or radioSettings.JOIN (a join request, payloadLen and port are ignored)
+        :return: time.monotonic() value, now if it can be sent now. None if
+                 the uplink is too long for the duty cycle of every sub-band
+        """
+        if config==radioSettings.JOIN:
+            airTime=self.frameAirTime(JOIN_REQUEST_LENGTH,dr)
+        else:
+            airTime=self.timeOnAir(payloadLen,port,dr)
+        now=time.monotonic()
+        earliest=None
+        for freq in self.MAC.cache[JOIN_FREQS if config==radioSettings.JOIN else TX_FREQS]:
+            when=self.dutyCycleLedger.earliest(self.subBandIndex(freq),airTime,now)
+            if when is not None and (earliest is None or when<earliest):
+                earliest=when
+        return earliest
+
+    def getDutyCycleUsed(self,freq=None):
+        """
+        :param freq: MHz, None for all sub-bands
+        :return: seconds of airtime used in freq's sub-band during the last hour
+                 (DutyCycle.DUTY_CYCLE_WINDOW), or a list of them per sub-band
+        """
+        if freq is None:
+            return [self.dutyCycleLedger.used(i) for i in range(len(self.airTimeUsed))]
+        return self.dutyCycleLedger.used(self.subBandIndex(freq))
+
+    def getAirTimeUsed(self,freq=None):
+        """
+        :param freq: MHz, None for all sub-bands
+        :return: seconds of airtime used in freq's sub-band since start up, or
+                 a list of them per duty cycle table entry (last entry for any others)
+        """
+        if freq is None:
+            return list(self.airTimeUsed)
+        subBand=self.MAC.getSubBand(freq)
+        return self.airTimeUsed[-1 if subBand is None else subBand]
 
         
 
@@ -571,17 +1222,46 @@ class Handler(LoRa):
 
         log.debug("join() starting")
         
+        if not self.dutyCycleAllows(self.frameAirTime(JOIN_REQUEST_LENGTH),radioSettings.JOIN):
+            return
+        packet=self.joinRequest()
+        if packet is not None:
+            self._transmit(radioSettings.JOIN,packet)
+            
+    async def join_async(self):
+        """
+        as join() but other tasks can run until the join accept has been
+        received or the RX windows have closed
+        """
+        log.debug("join_async() starting")
+        
+        # held from the budget check until the RX windows close, so another
+        # task can't replace self.devnonce before the join accept is checked
+        async with self.radioLock:
+            if not self.dutyCycleAllows(self.frameAirTime(JOIN_REQUEST_LENGTH),radioSettings.JOIN):
+                return
+            packet=self.joinRequest()
+            if packet is not None:
+                await self._transmitAsync(radioSettings.JOIN,packet)
+        await self.runPendingCallbacks()
+       
+    def joinRequest(self):
+        """
+        build the JOIN_REQUEST payload
+        
+        :return: packet or None if already joined (e.g. ABP) or not using OTAA
+        """
         # have we already joined?
         # this will be true if using ABP
         if self.registered():
             log.debug("Already joined, nothing to do here. Just send data.")
-            return
+            return None
 
         mode=self.config[TTN][AUTH_MODE]
      
         if mode != AUTH_OTAA:
             log.error(f"Unknown auth_mode {mode}")
-            return
+            return None
 
         log.debug("Performing OTAA Join")
 
@@ -608,9 +1288,10 @@ class Handler(LoRa):
                     {'deveui': deveui, 'appeui': appeui, 'devnonce': self.devnonce})
                 
         packet=lorawan.to_raw()
+        lorawan_release(lorawan)
         log.info(f"Join: sending packet {packet} type {type(packet)} size={len(packet)}")
         
-        self._transmit(radioSettings.JOIN,packet)
+        return packet
        
     def receive(self):
         """Check if any downlinks have been received in class C operation
@@ -621,6 +1302,19 @@ class Handler(LoRa):
             of this.
             Users of class C devices need to factor frequent calls to this method in their program loop.
         """
+        self.checkRX2()
+        self.discardPendingCallbacks()
+        
+    async def receive_async(self):
+        """
+        as receive() but an async downlinkCallback is awaited
+        """
+        async with self.radioLock:
+            self.checkRX2()
+        await self.runPendingCallbacks()
+        
+    def checkRX2(self):
+        """process a downlink received while listening in RX2 (class C), see receive()"""
         # sanity chgecks
         if self.getDeviceClass() != "C":
             log.info("Device is not flagged as class C in settings.json")
@@ -633,11 +1327,11 @@ class Handler(LoRa):
             return
         
         # ok so we are class C and listening
-        # if a message has arrived process it and clear the IRQ flag
-        rxDone=self.get_irq_flags()["rx_done"]
-        if rxDone:
-            self.clear_irq_flags(RxDone=1) # LoraRadio
+        # if a message has arrived process it and clear the IRQ flag. DIO0 is
+        # only cleared once processDownlinks() has cleared RxDone and it has gone low
+        if self.irqSeen(0,IRQ.RX_DONE):
             self.processDownlinks()
+            BOARD.dio_clear(0)
         
     def getDeviceClass(self):
         """convenience function returns the capitalised device class from settings.json"""
@@ -705,91 +1399,275 @@ class Handler(LoRa):
         
         :param message: byte message (not the whole payload, read on)
         :param port: 1..253 is the available range 
+        :return: True if the frame was transmitted. An error after that, e.g. while
+                 handling a downlink, doesn't make it False
         """
-
+        self.txStart=None # set by startTransmit()
         try:
             
-            # check if joined
-            if not self.registered():
-                log.warn("_sendpacket() attempt to send uplink but not joined")
-                return
-              
-            nwkskey=self.MAC.getNwkSKey()
-            appskey=self.MAC.getAppSKey()
-            lorawan = lorawan_msg(nwkskey,appskey)
-            
+            length=self.encodeUplink(message,port)
+            if length is None:
+                return False
+
+            # now send it
+            self._transmit(radioSettings.SEND,self.txBuffer,length)
             
-            try:
-                FCntUp=self.MAC.getFCntUp()
-                if FCntUp is None:
-                    FCntUp=0
-            except:
-                FCntUp=0
+            self.prepareNextUplink()
+
+        except ValueError as err:
+            traceback.print_exception(err)
+            log.error(f"_sendPacket Value error {err}")
+
+        except Exception as e:
+            traceback.print_exception(e)
             
-            devaddr=self.MAC.getDevAddr()
+        return self.txStart is not None
+
+    async def _sendPacketAsync(self,message,port=1):
+        """
+        as _sendPacket() but using _transmitAsync(). The caller must hold self.radioLock
+        """
+        self.txStart=None # set by startTransmit()
+        try:
             
-            FOpts,FOptsLen=self.MAC.getFOpts() # can be an empty bytearray
-            
-            # create the LoRaWAN message
-            if FOptsLen>0:
-                lorawan.create(MHDR.UNCONF_DATA_UP,
-                    {
-                    'devaddr': devaddr, 
-                    'fcnt': FCntUp, 
-                    'data': message,
-                    'fport':port,
-                    'fopts':FOpts
-                    })
-            else:
-                FCtrl=0;
-                if self.confirmWithNextUplink:
-                    self.confirmWithNextUplink=False
-                    FCtrl=0x20 # bit 5 is an ACK
-                # we never send confirmed up so the last downlink must have come from the server
-                # if someone accidentally set the confirmed checkbox on the V3 messaging
-                # panel
-                lorawan.create(MHDR.UNCONF_DATA_UP,
-                    {
-                    'devaddr': devaddr,
-                    'fcnt': FCntUp,
-                    'data': message,
-                    'fport': port,
-                    'fctrl': FCtrl
-                    })
-
-            self.MAC.setFCntUp(FCntUp+1)
-        
-            # encode the packet
-            payload=lorawan.to_raw()
+            length=self.encodeUplink(message,port)
+            if length is None:
+                return False
 
-            # now send it
-            self._transmit(radioSettings.SEND,payload)
+            await self._transmitAsync(radioSettings.SEND,self.txBuffer,length)
+            
+            self.prepareNextUplink()
 
         except ValueError as err:
             traceback.print_exception(err)
-            log.error(f"_sendPacket Value error {err}")
+            log.error(f"_sendPacketAsync Value error {err}")
 
         except Exception as e:
             traceback.print_exception(e)
+            
+        return self.txStart is not None
+
+    def encodeUplink(self,message,port=1):
+        """
+        encode the uplink message and any MAC replies into self.txBuffer
+        
+        FCntUp is incremented, it reaches NVM when the frame is transmitted.
+        
+        :param message: byte message
+        :param port: 1..253
+        :return: frame length or None if not joined
+        """
+        # check if joined
+        if not self.registered():
+            log.warn("_sendpacket() attempt to send uplink but not joined")
+            return None
+          
+        nwkskey=self.MAC.getNwkSKey()
+        appskey=self.MAC.getAppSKey()
+        
+        try:
+            FCntUp=self.MAC.getFCntUp()
+            if FCntUp is None:
+                FCntUp=0
+        except:
+            FCntUp=0
+        
+        devaddr=self.MAC.getDevAddr()
+        
+        # kept until the frame is encoded so they aren't lost if encoding fails
+        FOpts,FOptsLen=self.MAC.getFOpts(clear=False) # can be empty
+        
+        FCtrl=0
+        if self.confirmWithNextUplink:
+            FCtrl=0x20 # bit 5 is an ACK
+        # we never send confirmed up so the last downlink must have come from the server
+        # if someone accidentally set the confirmed checkbox on the V3 messaging
+        # panel
+        
+        # encode the LoRaWAN message straight into the TX buffer
+        length=encode_uplink(self.txBuffer,nwkskey,appskey,devaddr,FCntUp,message,
+                             fport=port,fctrl=FCtrl,fopts=FOpts if FOptsLen>0 else None,
+                             keystream=self.keystream)
+
+        self.MAC.clearFOpts()
+        self.confirmWithNextUplink=False
+        # saved with the airtime ledgers by startTransmit(), one NVM write per uplink
+        self.MAC.setFCntUp(FCntUp+1,save=False)
 
-    def send_bytes(self, message,port=1):
+        return length
+
+    def send_bytes(self, message,port=1,dr=None):
         """
             Send a list of bytes over the LoRaWAN channel
 
             called by send("message") to create a byte array or directly if message
             is already a byte array
+
+            The uplink is not sent if no channel has duty cycle budget left, or
+            it would exceed the TTN fair use airtime. Use queue() to wait for it
+
+            :param dr: data rate for this uplink only, default is the current one
+            :return: False if not sent for those reasons, because not joined or
+                     because encoding or loading the frame into the radio failed
         """
         if self.MAC.getNwkSKey() is None or self.MAC.getAppSKey() is None:
             log.error("no nwkSKey or AppSKey - we need to JOIN first")
-            return
+            return False
 
-        self._sendPacket(message,port)
+        self.MAC.setUplinkDataRate(dr)
+        try:
+            if not self.fairUseAllows(len(message),port):
+                return False
+
+            if not self.dutyCycleAllows(self.timeOnAir(len(message),port)):
+                return False
+
+            return self._sendPacket(message,port)
+        finally:
+            self.MAC.setUplinkDataRate()
 
     def send(self, message, port=1):
         """
-            Send a string message over the channel
+            Send a string message over the channel, see send_bytes()
         """
         #self.send_bytes(list(map(ord, str(message))),port)
-        self.send_bytes(message.encode("utf-8"),port)
+        return self.send_bytes(message.encode("utf-8"),port)
+
+    async def send_bytes_async(self, message,port=1,dr=None):
+        """
+            as send_bytes() but other tasks can run while the uplink is sent and
+            the RX windows are open. Use from an asyncio task:-
+
+                await handler.send_bytes_async(b"hello")
+        """
+        if self.MAC.getNwkSKey() is None or self.MAC.getAppSKey() is None:
+            log.error("no nwkSKey or AppSKey - we need to JOIN first")
+            return False
+
+        # held from the budget checks until the RX windows close, so another
+        # task can't use up the budget or overwrite self.txBuffer in between
+        async with self.radioLock:
+            self.MAC.setUplinkDataRate(dr)
+            try:
+                if not self.fairUseAllows(len(message),port):
+                    return False
+
+                if not self.dutyCycleAllows(self.timeOnAir(len(message),port)):
+                    return False
+
+                sent=await self._sendPacketAsync(message,port)
+            finally:
+                self.MAC.setUplinkDataRate()
+        await self.runPendingCallbacks()
+        return sent
+
+    async def send_async(self, message, port=1):
+        """
+            as send() but other tasks can run while the uplink is sent and
+            the RX windows are open
+        """
+        return await self.send_bytes_async(message.encode("utf-8"),port)
 
 
+
+    def queue(self, message, port=1, priority=0, deadline=None, key=None):
+        """
+            Queue an uplink to be sent by sendQueued(), flush() or flush_async()
+            as soon as the duty cycle allows
+
+            :param message: str or bytes
+            :param port: FPort
+            :param priority: higher values are sent first
+            :param deadline: seconds from now after which the uplink is dropped unsent, None to keep it
+            :param key: any value. Queuing an uplink with the same key replaces the one waiting
+            :return: True if queued, False if the queue is full of higher priority uplinks
+        """
+        if isinstance(message,str):
+            message=message.encode("utf-8")
+        if deadline is not None:
+            deadline=time.monotonic()+deadline
+        return self.uplinks.put(Uplink(message,port,priority,deadline,key))
+
+    def nextSendTime(self):
+        """
+            when the next queued uplink can be sent. Expired uplinks are dropped
+
+            If the fair use airtime would hold the uplink back, and "fair_use_dr"
+            is set, it is sent now at the slowest faster data rate which fits
+            instead, see fairUseDataRate()
+
+            :return: time.monotonic() value, None if nothing is queued
+        """
+        self.uplinks.expire()
+        while len(self.uplinks):
+            uplink=self.uplinks.peek()
+            uplink.dr=None
+            when=self.earliestTransmit(len(uplink.message),uplink.port)
+            if when is not None and self.config[TTN].get(FAIR_USE,0):
+                # defer until enough of the last 24 hours airtime has expired
+                now=time.monotonic()
+                fupWhen=self.fairUse.earliest(FairUseLedger.UPLINK,self.timeOnAir(len(uplink.message),uplink.port),now)
+                if fupWhen is None or fupWhen>now:
+                    uplink.dr=self.fairUseDataRate(len(uplink.message),uplink.port)
+                if uplink.dr is not None:
+                    when=max(self.earliestTransmit(len(uplink.message),uplink.port,uplink.dr),now)
+                else:
+                    when=None if fupWhen is None else max(when,fupWhen)
+            if when is not None:
+                return when
+            log.warning(f"{uplink} is too long for the duty cycle or fair use policy at this data rate, dropped")
+            self.uplinks.pop()
+        return None
+
+    def sendQueued(self):
+        """
+            Send the highest priority queued uplink if the duty cycle allows it now.
+            Call this from your program loop.
+
+            :return: True if an uplink was sent, False if none was due or
+                     send_bytes() refused it, it stays queued
+        """
+        when=self.nextSendTime()
+        if when is None or when>time.monotonic():
+            return False
+        uplink=self.uplinks.pop()
+        if self.send_bytes(uplink.message,uplink.port,uplink.dr):
+            return True
+        # refused before transmitting, nothing else can have been queued
+        self.uplinks.put(uplink)
+        return False
+
+    def flush(self):
+        """
+            Send all the queued uplinks, waiting for the duty cycle between them
+
+            :return: True if the queue was emptied, False if an uplink was
+                     refused (e.g. not joined), it and the rest stay queued
+        """
+        while True:
+            when=self.nextSendTime()
+            if when is None:
+                return True
+            if when>time.monotonic():
+                self.sleepUntil(seconds_ns(when))
+                continue
+            if not self.sendQueued():
+                return False
+
+    async def flush_async(self):
+        """
+            as flush() but other tasks can run while waiting for the duty cycle
+        """
+        while True:
+            when=self.nextSendTime()
+            if when is None:
+                return True
+            if when>time.monotonic():
+                # another task may queue or send while waiting so check again
+                await self.sleepUntilAsync(seconds_ns(when))
+                continue
+            uplink=self.uplinks.pop()
+            if not await self.send_bytes_async(uplink.message,uplink.port,uplink.dr):
+                # put it back, put() decides if it still fits should other tasks have queued meanwhile
+                self.uplinks.put(uplink)
+                return False
@@ -29,6 +29,10 @@ from .Strings import *
 import random
 from microcontroller import nvm # used for caching
 
+# max application payload when the frequency plan has no max_payload table,
+# the smallest allowed at any data rate in all regions
+DEFAULT_MAX_PAYLOAD=11
+
 # MAC commands have requests and answers
 # the ID of the command is the same whether it is a REQ or ANS
 class MCMD:
@@ -94,6 +98,9 @@ class MAC_commands(object):
         self.lastSNR=0
         
         self.currentChannel=None  # changes with each transmission
+        self.uplinkDR=None        # data rate for one uplink instead of the cached one, see setUplinkDataRate()
+        self.dataRates=self.config[self.frequency_plan][DATA_RATES] # (sf,bw) indexed by DR
+        self.channelsVersion=0    # incremented whenever a channel frequency list changes
 
         if not self.loadCache(): # load any cached values
             # initialise values from user config file
@@ -169,7 +176,10 @@ class MAC_commands(object):
             return bytearray([0x00,0x00,0x00,0x00])
     
     def setDevAddr(self,DevAddr):
-        # DevAddr comes from a downlink and may be a bytearray
+        # DevAddr comes from a join accept as an int, kept as 4 bytes big endian
+        # like the ABP devaddr in settings.json
+        if type(DevAddr) is int:
+            DevAddr=DevAddr.to_bytes(4,"big")
         self.cache[DEVADDR]=list(DevAddr)
         self.saveCache()
         
@@ -199,40 +209,76 @@ class MAC_commands(object):
     def getFCntUp(self):
         return self.cache[FCNTUP]
         
-    def setFCntUp(self,count):
+    def setFCntUp(self,count,save=True):
+        """
+        :param save: False to leave the NVM write to the caller's next saveCache()
+        """
         self.cache[FCNTUP]=count
-        self.saveCache()
+        if save:
+            self.saveCache()
+
+    def pickChannel(self,numChannels,avoid=None):
+        """
+        randomly choose a channel index
+        
+        :param numChannels: length of the channel list
+        :param avoid: channel indexes not to use e.g. found busy by listen before talk.
+                      Ignored if that leaves nothing to choose from, the handler
+                      checks the duty cycle allows at least one channel before
+                      it gets this far (Handler.dutyCycleAllows())
+        :return: channel index
+        """
+        if avoid:
+            free=[ch for ch in range(numChannels) if ch not in avoid]
+            if free:
+                return free[random.randint(0,len(free)-1)]
+        return random.randint(0,numChannels-1)
 
-    def getJoinSettings(self):
+    def getJoinSettings(self,avoid=None):
         """
         When joining only the first three frequencies
         should be used
         
         max duty cycle is also selected
         
+        :param avoid: channel indexes not to use, see pickChannel()
         :return (freq,sf,bw)
         """
-        self.currentChannel=random.randint(0,len(self.cache[JOIN_FREQS])-1)
+        self.currentChannel=self.pickChannel(len(self.cache[JOIN_FREQS]),avoid)
 
         freq=self.cache[JOIN_FREQS][self.currentChannel]
 
         self.cache[MAX_DUTY_CYCLE]=self.getMaxDutyCycle(freq)
         
-        sf,bw=self.config[self.frequency_plan][DATA_RATES][self.cache[DATA_RATE]]
+        sf,bw=self.dataRates[self.cache[DATA_RATE]]
 
         log.debug(f"using join settings: freq {freq} sf {sf} bw {bw}")
         return freq,sf,bw
 
     def getDataRate(self):
+        """
+        :return: the data rate of the next uplink, see setUplinkDataRate()
+        """
+        if self.uplinkDR is not None:
+            return self.uplinkDR
         return self.cache[DATA_RATE]
 
+    def setUplinkDataRate(self,dr=None):
+        """
+        use another data rate, for the uplink and its RX1 window, without
+        changing the one set by the network (LinkADRReq)
+        
+        :param dr: data rate index, None to go back to the cached data rate
+        """
+        self.uplinkDR=dr
+
     def getLastSendSettings(self):
         """
         :return tuple: (freq,sf,bw)
         """
         return self.lastSendSettings
         
-    def getSendSettings(self):
+    def getSendSettings(self,avoid=None):
         """
         randomly choose a frequency (channel)
         
@@ -240,14 +286,15 @@ class MAC_commands(object):
         
         Use current data rate
         
+        :param avoid: channel indexes not to use, see pickChannel()
         :return (freq,sf,bw)
         """
-        self.currentChannel=random.randint(0,len(self.cache[TX_FREQS])-1)
+        self.currentChannel=self.pickChannel(len(self.cache[TX_FREQS]),avoid)
 
         freq=self.cache[TX_FREQS][self.currentChannel]
         self.cache[DUTY_CYCLE]=self.getMaxDutyCycle(freq)
           
-        sf,bw=self.config[self.frequency_plan][DATA_RATES][self.cache[DATA_RATE]]
+        sf,bw=self.dataRates[self.getDataRate()]
         
         log.debug(f"using send settings: freq {freq} sf {sf} bw {bw}")
         return freq,sf,bw
@@ -266,12 +313,30 @@ class MAC_commands(object):
         else:
             freq = self.cache[RX1_FREQS][self.currentChannel]
 
-        sf, bw = self.config[self.frequency_plan][DATA_RATES][self.cache[RX1_DR]]
+        sf, bw = self.dataRates[self.getRX1DataRate()]
 
         log.debug(f"RX1 settings : freq {freq} sf {sf} bw {bw}")
 
         return freq, sf, bw
 
+    def getRX1DataRate(self,offset=None):
+        """
+        the RX1 data rate follows the uplink data rate, less RX1DROffset, as
+        given by the frequency plan's DR_offset_table. rx1_DR is used if the
+        plan has no table
+        
+        :param offset: RX1DROffset, default is the one cached from the join
+                       accept or RXParamSetupReq. Join accepts use 0
+        :return: data rate index
+        """
+        if offset is None:
+            offset=self.cache.get(RX1_DR_OFFSET,0)
+        table=self.config[self.frequency_plan].get(DR_OFFSET_TABLE)
+        dr=self.getDataRate()
+        if table is None or dr>=len(table) or offset>=len(table[dr]):
+            return self.cache[RX1_DR]
+        return table[dr][offset]
+
     def getRX2Settings(self):
         """
         RX2 is a fixed frequency,sf and bw
@@ -280,7 +345,7 @@ class MAC_commands(object):
         """
         freq=self.cache[RX2_FREQUENCY]
         
-        sf,bw=self.config[self.frequency_plan][DATA_RATES][self.cache[RX2_DR]]
+        sf,bw=self.dataRates[self.cache[RX2_DR]]
         
         log.debug(f"rx2 settings freq {freq} sf {sf} bw {bw}")
         return freq,sf,bw
@@ -301,6 +366,75 @@ class MAC_commands(object):
         log.error(f"unable to locate max duty cycle for {freq}. Using 0.1 instead")
         return 0.1
 
+    def getSubBand(self,freq):
+        """
+        sub-bands are the entries in the frequency plan duty cycle table
+        
+        :param freq: MHz
+        :return: index into the duty cycle table or None if freq isn't listed
+        """
+        DC_table=self.config[self.frequency_plan][DUTY_CYCLE_TABLE]
+        for i,(minFreq,maxFreq,dc) in enumerate(DC_table):
+            if minFreq<=freq <=maxFreq:
+                return i
+        return None
+
+    def getNumSubBands(self):
+        return len(self.config[self.frequency_plan][DUTY_CYCLE_TABLE])
+
+    def getSubBandDutyCycles(self):
+        """
+        :return: list of max duty cycle (percent) per sub-band, plus the lowest of
+                 them for frequencies which are not in the table
+        """
+        dutyCycles=[dc for (minFreq,maxFreq,dc) in self.config[self.frequency_plan][DUTY_CYCLE_TABLE]]
+        dutyCycles.append(min(dutyCycles) if dutyCycles else 0.1)
+        return dutyCycles
+
+    def getDutyCycleLedger(self):
+        """
+        :return: the saved airtime ledger, see DutyCycleLedger.save(), or None
+        """
+        return self.cache.get(DUTY_CYCLE_LEDGER)
+
+    def getFairUseLedger(self):
+        """
+        :return: the saved fair use ledger, see FairUseLedger.save(), or None
+        """
+        return self.cache.get(FAIR_USE_LEDGER)
+
+    def setLedgers(self,dutyCycle=None,fairUse=None):
+        """
+        update the airtime ledgers in the cache
+        
+        Not saved here, that would double the NVM writes per uplink. The handler
+        saves the cache, FCntUp included, just before each transmission
+        
+        :param dutyCycle: DutyCycleLedger.save() or None to leave as is
+        :param fairUse: FairUseLedger.save() or None to leave as is
+        """
+        if dutyCycle is not None:
+            self.cache[DUTY_CYCLE_LEDGER]=dutyCycle
+        if fairUse is not None:
+            self.cache[FAIR_USE_LEDGER]=fairUse
+
+    def getMaxPayload(self,dr=None):
+        """
+        the largest application payload (FRMPayload, N in the regional parameters)
+        at a data rate, less any MAC command answers waiting to go in FOpts
+        
+        :param dr: data rate index, default is the current data rate
+        :return: bytes
+        """
+        if dr is None:
+            dr=self.getDataRate()
+        maxPayload=self.config[self.frequency_plan].get(MAX_PAYLOAD)
+        if maxPayload is None or dr>=len(maxPayload):
+            maxPayload=DEFAULT_MAX_PAYLOAD
+        else:
+            maxPayload=maxPayload[dr]
+        return max(maxPayload-len(self.macReplies),0)
+
     def getSfBw(self,drIndex):
         """
         gets the data rate for a given data rate index
@@ -311,7 +445,7 @@ class MAC_commands(object):
 
         """
 
-        sf,bw=self.config[self.frequency_plan][DATA_RATES][drIndex]
+        sf,bw=self.dataRates[drIndex]
 
         return (sf,bw)
 
@@ -344,6 +478,7 @@ class MAC_commands(object):
             self.cache[TX_FREQS] = self.cache.get(TX_FREQS,self.config[self.frequency_plan][TX_FREQS])
             self.cache[RX1_FREQS] = self.cache.get(RX1_FREQS,self.config[self.frequency_plan][RX1_FREQS])
             self.newChannelIndex=0
+            self.channelsVersion+=1
             
             log.info("Frequency Plan loaded ok")
 
@@ -364,6 +499,7 @@ class MAC_commands(object):
         rx1_dr=dr_table_row[rx1_dr_offset]
         
         self.cache[RX1_DR]=rx1_dr
+        self.cache[RX1_DR_OFFSET]=rx1_dr_offset
         self.cache[RX2_DR]=settings & 0x0F
         self.saveCache()
         
@@ -374,7 +510,7 @@ class MAC_commands(object):
         :param  a: byte array of 3 octets 
         :return f: frequency in xxx.y mHz  format
         """
-        freq=(a[2] << 16 ) + (a[1] << 8) + a[0] * 100
+        freq=((a[2] << 16 ) + (a[1] << 8) + a[0]) * 100
         # frequency is like 868100000 but we want 868.1
         return freq/1000000    
         
@@ -437,6 +573,7 @@ class MAC_commands(object):
 
         # RXParamSetup
         self.cache[RX1_DR]=self.cache.get(RX1_DR,self.config[TTN][RX1_DR])
+        self.cache[RX1_DR_OFFSET]=self.cache.get(RX1_DR_OFFSET,0)
         self.cache[RX2_DR]=self.cache.get(RX2_DR,self.config[TTN][RX2_DR])
 
         # TX and RX1 frequencies change, RX2 is constant (in UK)
@@ -550,7 +687,7 @@ class MAC_commands(object):
         self.cache[FCNTDN]=FCntDn
         self.saveCache()
 
-    def getFOpts(self):
+    def getFOpts(self,clear=True):
         """
         these are the MAC replies. The spec says the server can send multiple
         commands in a packet.
@@ -558,7 +695,8 @@ class MAC_commands(object):
         The replies are cleared when this method is called otherwise
         they would be sent to TTN with every uplink
         
-        :param: None
+        :param clear: False to keep the replies until clearFOpts() is called,
+                      e.g. once the uplink carrying them has been encoded
         :return: (Fopts,FoptsLen)
         :rtype: tuple
         """
@@ -567,7 +705,10 @@ class MAC_commands(object):
 
         log.info(f"check for FOpts to attach to uplink len={FOptsLen} FOpts={list(FOpts)}")
 
-        self.macReplies=bytearray() # clear them as we don't want to send with every messages
+        if clear:
+            self.clearFOpts()
+        else:
+            FOpts=bytes(FOpts)
 
         if FOptsLen==0:
             log.info("no FOpts")
@@ -579,6 +720,12 @@ class MAC_commands(object):
         log.warning(f"FOpts len={FOptsLen} exceeds 16 bytes={FOpts}")
         return [],0
 
+    def clearFOpts(self):
+        """
+        drop the MAC replies once they have been attached to an uplink
+        """
+        self.macReplies=bytearray() # clear them as we don't want to send with every messages
+
 ####################################################
 #
 # here are the MAC command handlers
@@ -587,7 +734,7 @@ class MAC_commands(object):
 #
 ####################################################
 
-    def handleCommand(self, macPayload):
+    def handleCommand(self, frame, frmPayload=None):
         """
         these are commands originated from the server
 
@@ -598,39 +745,32 @@ class MAC_commands(object):
 
         This method is called if a message includes a MAC payload
         
-        :param macPayload: a MAC payload object
+        :param frame: a DownlinkFrame
+        :param frmPayload: the decrypted FRMPayload, needed if FPort is 0
         """
         log.debug("checking MAC payload for MAC commands")
 
-
-        FCtrl=macPayload.get_fhdr().get_fctrl()
-        FOptsLen=FCtrl & 0x0F
-
-        FCnt=macPayload.get_fhdr().get_fcnt() # frame downlink frame counter
+        FCnt=frame.fcnt # frame downlink frame counter
         log.debug(f"received frame FCnt={FCnt} expecting > FCntDn={self.cache[FCNTDN]}")
-  
-        if not type(FCnt) is int:
-            # probably a 2 byte list little endian
-            FCnt=FCnt[0]+FCnt[1]*256
-        self.cache[FCNTDN]=int(FCnt)
-    
+        self.cache[FCNTDN]=FCnt
 
         # MAC commands can appear in FOpts field or FRMpayload but not both
         # MAC commands appear in FRMpayload if FPort is zero
-        FPort=macPayload.get_fport()
+        FPort=frame.fport
         if FPort==0: # MAC commands in Form payload
-            FOpts=macPayload.get_frm_payload()
+            FOpts=frmPayload
         else:
-            FOpts=macPayload.get_fhdr().get_fopts()
+            FOpts=frame.fopts
     
         self.macReplies=bytearray() # no replies, yet
         
-        if len(FOpts)==0:
-            # no MAC commands
+        if FOpts is None or len(FOpts)==0:
+            # no MAC commands, save FCntDn and the handler's downlink count
             log.debug("No FOpts to process")
+            self.saveCache()
             return
 
-        self.processFopts(FOpts)
+        self.processFopts(FOpts) # saves the cache
 
     def processFopts(self,FOpts):
         """
@@ -639,7 +779,7 @@ class MAC_commands(object):
         :param FOpts: array of MAC commands
         
         """
-        log.info(f"handling downlink FOpts {FOpts}")
+        log.info(f"handling downlink FOpts {list(FOpts)}")
         
         self.macIndex=0
         self.macCmds=FOpts
@@ -732,37 +872,43 @@ class MAC_commands(object):
         DLsettings [RFU:7,RX1DROffset:6..4,RX2DataRate:3..0]
 
         reply is 1 byte with bit encoding
-        RFU:7..3,RX1DROffsetAck:2, RX2DataRateACK:2,ChannelACK:0
+        RFU:7..3,RX1DROffsetAck:2, RX2DataRateACK:1,ChannelACK:0
         """
         log.debug("RX_PARAM_SETUP_REQ")
 
         DLSettings=self.macCmds[self.macIndex+1]
 
-        # TODO only if all are valid otherwise no change
+        # nothing is changed unless all three are valid
         reply=0x00
         
-        rx1_dr_offset=(DLSettings & 0xE0) >> 4
-        if 0<=rx1_dr_offset<=5:
-            reply=reply or 0x01
+        rx1_dr_offset=(DLSettings & 0x70) >> 4
+        table=self.config[self.frequency_plan].get(DR_OFFSET_TABLE)
+        if rx1_dr_offset<(len(table[0]) if table else 6):
+            reply|=0x04
             
         rx2_dr_index=(DLSettings & 0x0F)
-        if 0<=rx2_dr_index<=8:
-            reply=reply or 0x02
+        if rx2_dr_index<len(self.dataRates):
+            reply|=0x02
             
-        freq=self._computeFreq(self.macCmds[self.macIndex+2:self.macIndex+4])
+        freq=self._computeFreq(self.macCmds[self.macIndex+2:self.macIndex+5])
         
-        if freq in self.cache[RX1_FREQS][self.currentChannel]:
-            reply=reply or 0x04
+        # a downlink channel of the plan, or its RX2 frequency
+        if freq in self.cache[RX1_FREQS] or freq==self.config[TTN][RX2_FREQUENCY] or freq==self.cache[RX2_FREQUENCY]:
+            reply|=0x01
             
         if reply==0x07:
-            self.cache[RX1_DR]+=rx1_dr_offset
+            self.cache[RX1_DR_OFFSET]=rx1_dr_offset
+            self.cache[RX1_DR]=self.getRX1DataRate()
             self.cache[RX2_DR]=rx2_dr_index
             self.cache[RX2_FREQUENCY]=freq
+            log.info(f"RX_PARAM_SETUP_REQ rx1_dr_offset {rx1_dr_offset} rx2_DR {rx2_dr_index} rx2 freq {freq}")
+        else:
+            log.warning(f"RX_PARAM_SETUP_REQ refused, status {reply}")
         
         # Channel ACK       0=unusable, 1 ok
         # RX2DataRateAck    0=unknown data rate, 1 ok
-        # RX1DROffsetACK    0=not in allowed ranbge, 1 ok
-        self.macReplies+=bytearray([MCMD.RX_PARAM_SETUP_REQ,0x07])
+        # RX1DROffsetACK    0=not in allowed range, 1 ok
+        self.macReplies+=bytearray([MCMD.RX_PARAM_SETUP_REQ,reply])
         self.macIndex+=5
 
     def dev_status_req(self):
@@ -816,6 +962,7 @@ class MAC_commands(object):
         else:
             self.cache[TX_FREQS][chIndex]=newFreq
             self.channelDRRange[chIndex] = (minDR,maxDR)
+            self.channelsVersion+=1
             
             log.info(f"NewChannelReq chIndex {chIndex} freq {newFreq} maxDR {maxDR} minDR {minDR}")
 
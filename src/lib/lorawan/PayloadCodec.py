@@ -0,0 +1,181 @@
+"""
+PayloadCodec.py
+
+Packs sensor readings into as few bytes as possible, a byte saved is airtime
+saved under both the duty cycle and the TTN fair use policy.
+
+The schema is a list of fields, plain dicts so the same list can be kept in
+settings.json on the device and TTN.toml for the decoder in "TTN MQTT Client/TTN.py":
+
+    {"name": "temperature", "bits": 10, "scale": 0.1, "offset": -40, "delta_bits": 5}
+
+    name        key of the reading in the values passed to encode()
+    bits        width of the field, 0 for a varint (7 bits per group, LSB group first,
+                each group preceded by a 1 bit flag set if another group follows)
+    scale       resolution, the field holds round((value - offset) / scale)
+    offset      value of the field's 0 (e.g. the lowest temperature to be sent)
+    delta_bits  width of the zigzag encoded change since the last uplink, 0 for a
+                varint, leave it out to always send the whole field
+
+Fields are bit packed, MSB first, after a header byte:
+
+    bit 7       1 for a delta frame, 0 for a key frame with every field whole
+    bits 0..6   frame sequence number
+
+A delta frame holds the changes since the frame before it, the decoder can only
+use it if it has that frame. Key frames are sent every keyFrameInterval frames,
+and whenever a change is too big for its delta_bits, so a lost uplink only
+loses the readings until the next one.
+"""
+from LogManager import LogMan
+log=LogMan.getLogger("PayloadCodec") # uses the default log level
+
+# header byte
+DELTA_FRAME = 0x80
+SEQUENCE_MASK = 0x7F
+
+# frames between key frames
+KEY_FRAME_INTERVAL = 8
+
+class _BitWriter:
+
+    def __init__(self):
+        self.data = bytearray()
+        self.acc = 0
+        self.bits = 0
+
+    def write(self, value, bits):
+        """append the low bits of value, MSB first"""
+        self.acc = (self.acc << bits) | (value & ((1 << bits) - 1))
+        self.bits += bits
+        while self.bits >= 8:
+            self.bits -= 8
+            self.data.append((self.acc >> self.bits) & 0xFF)
+        self.acc &= (1 << self.bits) - 1
+
+    def writeVarint(self, value):
+        """append an unsigned value in 7 bit groups"""
+        while True:
+            more = value > 0x7F
+            self.write(1 if more else 0, 1)
+            self.write(value, 7)
+            value >>= 7
+            if not more:
+                return
+
+    def getBytes(self):
+        """the bytes written, the last padded with 0 bits"""
+        if self.bits:
+            return bytes(self.data) + bytes(((self.acc << (8 - self.bits)) & 0xFF,))
+        return bytes(self.data)
+
+def zigzag(value):
+    """map a signed int to unsigned, 0,-1,1,-2.. to 0,1,2,3.."""
+    return value * 2 if value >= 0 else -value * 2 - 1
+
+class Field:
+
+    __slots__ = ("name", "bits", "scale", "offset", "deltaBits")
+
+    def __init__(self, name, bits=16, scale=1, offset=0, delta_bits=None):
+        """
+        :param name: key of the reading in the values passed to PayloadEncoder.encode()
+        :param bits: width in bits, 0 for a varint
+        :param scale: resolution, the field holds round((value - offset) / scale)
+        :param offset: value of the field's 0
+        :param delta_bits: width of the change since the last uplink, 0 for a varint, None to send it whole
+        """
+        self.name = name
+        self.bits = bits
+        self.scale = scale
+        self.offset = offset
+        self.deltaBits = delta_bits
+
+    def quantize(self, value):
+        """
+        :param value: reading
+        :return: the int held in the field, clamped to its range
+        """
+        q = round((value - self.offset) / self.scale)
+        if self.bits:
+            top = (1 << self.bits) - 1
+            if q < 0 or q > top:
+                log.warning(f"{self.name}={value} out of range, clamped")
+                q = 0 if q < 0 else top
+        elif q < 0:
+            log.warning(f"{self.name}={value} below offset, clamped")
+            q = 0
+        return q
+
+    def __repr__(self):
+        return f"Field({self.name} bits={self.bits} scale={self.scale} offset={self.offset} delta_bits={self.deltaBits})"
+
+class PayloadEncoder:
+
+    def __init__(self, schema, keyFrameInterval=KEY_FRAME_INTERVAL):
+        """
+        :param schema: list of Field or field dicts (see the module docstring)
+        :param keyFrameInterval: frames between key frames, 1 to never send a delta frame
+        """
+        self.fields = [f if isinstance(f, Field) else Field(**f) for f in schema]
+        self.keyFrameInterval = keyFrameInterval
+        self.last = None        # the fields as sent in the last frame
+        self.sequence = 0
+        self.sinceKeyFrame = 0
+
+    def reset(self):
+        """
+        send a key frame next, e.g. after a rejoin when the decoder may have
+        lost track of the last frame
+        """
+        self.last = None
+
+    def _deltas(self, values):
+        """
+        :return: the zigzag changes since the last frame, None if a key frame must be sent
+        """
+        if self.last is None or self.sinceKeyFrame + 1 >= self.keyFrameInterval:
+            return None
+        deltas = []
+        for field, q, last in zip(self.fields, values, self.last):
+            if field.deltaBits is None:
+                deltas.append(None)
+                continue
+            z = zigzag(q - last)
+            if field.deltaBits and z >> field.deltaBits:
+                return None
+            deltas.append(z)
+        return deltas
+
+    def encode(self, values):
+        """
+        :param values: dict of name: reading, or the readings in schema order
+        :return: bytes to send with Handler.send_bytes() or queue()
+        """
+        if isinstance(values, dict):
+            values = [values[f.name] for f in self.fields]
+        values = [f.quantize(v) for f, v in zip(self.fields, values)]
+
+        deltas = self._deltas(values)
+        self.sequence = (self.sequence + 1) & SEQUENCE_MASK
+        w = _BitWriter()
+        if deltas is None:
+            w.write(self.sequence, 8)
+            self.sinceKeyFrame = 0
+        else:
+            w.write(DELTA_FRAME | self.sequence, 8)
+            self.sinceKeyFrame += 1
+
+        for field, q, z in zip(self.fields, values, deltas or [None] * len(values)):
+            if z is not None:
+                bits = field.deltaBits
+            else:
+                bits = field.bits
+                z = q
+            if bits:
+                w.write(z, bits)
+            else:
+                w.writeVarint(z)
+
+        self.last = values
+        return w.getBytes()
@@ -0,0 +1,76 @@
+"""
+AirTime.py
+
+LoRa symbol and packet timing, calculated rather than measured, using the formula
+in the SX1276 datasheet section 4.1.1.7 (Time on air)
+
+    Tsym = 2^SF / BW
+    Tpreamble = (preamble + 4.25) * Tsym
+    payload symbols = 8 + max(ceil((8*PL - 4*SF + 28 + 16*CRC - 20*IH) / (4*(SF - 2*DE))) * (CR + 4), 0)
+    time on air = Tpreamble + payload symbols * Tsym
+
+Used to check duty cycle and TTN fair use limits before a packet is sent.
+"""
+from .constants import CODING_RATE
+
+# bandwidth in Hz for each BW register value (see constants.BW)
+BW_HZ = (7800, 10400, 15600, 20800, 31250, 41700, 62500, 125000, 250000, 500000)
+
+# the datasheet requires LowDataRateOptimize when a symbol lasts longer than 16ms
+LDRO_SYMBOL_MS = 16
+
+# LoRaWAN uses an 8 symbol preamble
+PREAMBLE_SYMBOLS = 8
+
+def symbol_time(sf, bw):
+    """
+    :param sf: spreading factor 6..12
+    :param bw: BW register value 0..9
+    :return: seconds
+    """
+    return (1 << sf) / BW_HZ[bw]
+
+def low_data_rate_optimize(sf, bw):
+    """
+    :param sf: spreading factor 6..12
+    :param bw: BW register value 0..9
+    :return: 1 if the symbol time is over 16ms
+    """
+    return 1 if (1 << sf) * 1000 > LDRO_SYMBOL_MS * BW_HZ[bw] else 0
+
+def payload_symbols(length, sf, bw, coding_rate=CODING_RATE.CR4_5, explicit_header=True, crc=True, ldro=None):
+    """
+    :param length: PHY payload length in bytes (the whole LoRaWAN frame)
+    :param sf: spreading factor 6..12
+    :param bw: BW register value 0..9
+    :param coding_rate: 1..4 (4/5..4/8)
+    :param explicit_header: False for implicit header mode
+    :param crc: True if the payload CRC is sent (uplinks)
+    :param ldro: low data rate optimize 0/1, None to use what the radio profile would set
+    :return: number of symbols after the preamble
+    """
+    if ldro is None:
+        ldro = low_data_rate_optimize(sf, bw)
+    ih = 0 if explicit_header else 1
+    n = 8 * length - 4 * sf + 28 + (16 if crc else 0) - 20 * ih
+    d = 4 * (sf - 2 * ldro)
+    blocks = -(-n // d) # ceil
+    if blocks < 0:
+        blocks = 0
+    return 8 + blocks * (coding_rate + 4)
+
+def time_on_air(length, sf, bw, coding_rate=CODING_RATE.CR4_5, preamble=PREAMBLE_SYMBOLS,
+                explicit_header=True, crc=True, ldro=None):
+    """
+    :param length: PHY payload length in bytes (the whole LoRaWAN frame)
+    :param sf: spreading factor 6..12
+    :param bw: BW register value 0..9
+    :param coding_rate: 1..4 (4/5..4/8)
+    :param preamble: preamble length in symbols
+    :param explicit_header: False for implicit header mode
+    :param crc: True if the payload CRC is sent (uplinks)
+    :param ldro: low data rate optimize 0/1, None to use what the radio profile would set
+    :return: seconds
+    """
+    symbols = preamble + 4.25 + payload_symbols(length, sf, bw, coding_rate, explicit_header, crc, ldro)
+    return symbols * symbol_time(sf, bw)
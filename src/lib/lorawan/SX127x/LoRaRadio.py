@@ -34,8 +34,38 @@ log=LogMan.getLogger("LoraRadio") # use default level
 
 from .constants import *
 from .board_config import BOARD
+from .RadioProfile import frf
 import time
 
+# registers which the radio changes by itself (status, counters, AGC) or where a
+# read/write has a side effect (FIFO, IRQ flags). These always go to the chip,
+# they are never answered from, or skipped by, the register shadow. See _read_u8()
+_VOLATILE_REGISTERS = (
+    REG.LORA.FIFO, REG.LORA.OP_MODE, REG.LORA.LNA,
+    REG.LORA.FIFO_ADDR_PTR, REG.LORA.FIFO_RX_CURR_ADDR,
+    REG.LORA.IRQ_FLAGS, REG.LORA.RX_NB_BYTES,
+    REG.LORA.RX_HEADER_CNT_MSB, REG.LORA.RX_HEADER_CNT_MSB + 1,
+    REG.LORA.RX_PACKET_CNT_MSB, REG.LORA.RX_PACKET_CNT_MSB + 1,
+    REG.LORA.MODEM_STAT, REG.LORA.PKT_SNR_VALUE, REG.LORA.PKT_RSSI_VALUE,
+    REG.LORA.RSSI_VALUE, REG.LORA.HOP_CHANNEL, REG.LORA.FIFO_RX_BYTE_ADDR,
+    REG.LORA.FEI_MSB, REG.LORA.FEI_MSB + 1, REG.LORA.FEI_MSB + 2, REG.LORA.RSSI_WIDEBAND,
+    REG.LORA.IRQ_FLAGS1, REG.LORA.IRQ_FLAGS2,
+    )
+_NUM_REGISTERS = 0x80
+_VOLATILE = bytearray(_NUM_REGISTERS)
+for _r in _VOLATILE_REGISTERS:
+    _VOLATILE[_r] = 1
+_NOT_KNOWN = bytes(_NUM_REGISTERS)
+
+# modes the radio leaves by itself, going back to STDBY, on TxDone, RxDone/RxTimeout
+# and CadDone. The cached mode can't be trusted once one of these has been started
+_SELF_ENDING_MODES = (MODE.TX, MODE.RXSINGLE, MODE.CAD)
+
+# mode transition times from the SX1276 datasheet. Only waking from SLEEP needs a
+# wait, the FIFO can't be used until the crystal oscillator has started (TS_OSC).
+# FS/TX/RX/CAD start up is sequenced by the chip and ends with an interrupt
+_OSC_STARTUP = 0.00025
+
 try:
     # these don't appear to exist in the circuitpython installed
     # but were in the adafruit_rfm9x library code
@@ -98,7 +128,8 @@ class LoRa(object):
     backup_registers = []
     verbose = True
     dio_mapping = [None] * 6          # store the dio mapping here
-    #_BUFFER = bytearray(4)            # for SPI transfers
+    register_shadow = True            # set False to always read/write the chip (debugging)
+    verify_mode = False               # set True to read back OP_MODE after every mode change (debugging)
 
     def __init__(self, verbose=VERBOSE, do_calibration=True, calibration_freq=868.1):
         """ Init the object
@@ -109,6 +140,17 @@ class LoRa(object):
         :param do_calibration: Call rx_chain_calibration, default is True.
         """
         
+        # write-through copy of the LoRa mode registers. _known[addr] is 1 when
+        # _shadow[addr] holds the value last written to/read from the chip
+        self._shadow = bytearray(_NUM_REGISTERS)
+        self._known = bytearray(_NUM_REGISTERS)
+        self._shadowActive = False  # only used in LoRa mode, FSK mode has a different register map
+
+        # fixed SPI buffers so register access and packet reception don't allocate
+        self._cmd = bytearray(2)         # address (+ value for _write_u8)
+        self._byte = bytearray(1)        # _read_u8 result
+        self.rx_buffer = bytearray(256)  # the whole FIFO, see read_payload_into()
+        
         self.reset()
         
         try:
@@ -153,18 +195,56 @@ class LoRa(object):
             length = len(buf)
             
         address=address & 0x7F # make sure bit 7 is 0 -> read
-        addr=bytearray([address])
+
+        # burst reads of registers (not the FIFO) can be answered from the shadow
+        # if all of them are known
+        shadowed = self._shadowActive and address != REG.LORA.FIFO
+        if shadowed:
+            known = self._known
+            for i in range(address, address + length):
+                if _VOLATILE[i] or not known[i]:
+                    break
+            else:
+                for i in range(length):
+                    buf[i] = self._shadow[address + i]
+                return
+
+        cmd = self._cmd
+        cmd[0] = address
 
         with BOARD.spidev as spidev:
-            spidev.write(addr, end=1)
+            spidev.write(cmd, end=1)
             spidev.readinto(buf, end=length)
 
+        if shadowed:
+            self._update_shadow(address, buf, length)
+
     def _read_u8(self, address: int) -> int:
         # Read a single byte from the provided address and return it.
-        buf=bytearray(4)
+        # Non volatile registers are returned from the shadow once known
+        if self._shadowActive and self._known[address] and not _VOLATILE[address]:
+            return self._shadow[address]
+        buf = self._byte
         self._read_into(address, buf, length=1)
         return buf[0]
 
+    def _update_shadow(self, address, buf, length):
+        """record register values written to or read from the chip"""
+        shadow = self._shadow
+        known = self._known
+        for i in range(length):
+            reg = address + i
+            if not _VOLATILE[reg]:
+                shadow[reg] = buf[i]
+                known[reg] = 1
+
+    def invalidate_registers(self):
+        """
+        forget all shadowed register values, the next read of each register goes to the chip.
+        Called by reset() and when the radio leaves LoRa mode
+        """
+        self._known[:] = _NOT_KNOWN
+
     def _write_from(self, address: int, buf: ReadableBuffer, length: Optional[int] = None) -> None:
         # Write a number of bytes to the provided address and taken from the
         # provided buffer.  If no length is specified (the default) the entire
@@ -172,11 +252,17 @@ class LoRa(object):
         if length is None:
             length = len(buf)
         
-        address=(address | 0x80) & 0xFF
-        addr = bytearray([address])  # Set top bit to 1 to indicate a write.
+        address=(address | 0x80) & 0xFF  # Set top bit to 1 to indicate a write.
+        cmd = self._cmd
+        cmd[0] = address
+        if type(buf) is list:
+            buf=bytearray(buf) # SPI needs a buffer, bytearrays/memoryviews are written as is
         with BOARD.spidev as spidev:
-            spidev.write(addr,end=1)
-            spidev.write(bytearray(buf), end=length)
+            spidev.write(cmd,end=1)
+            spidev.write(buf, end=length)
+
+        if self._shadowActive and (address & 0x7F) != REG.LORA.FIFO:
+            self._update_shadow(address & 0x7F, buf, length)
                 
 
     def _write_u8(self, address: int, val: int) -> None:
@@ -186,15 +272,31 @@ class LoRa(object):
         addr=(address | 0x80) & 0xFF # Set top bit to 1 to indicate a write.
         val=(val & 0xFF)
         
-        buf = bytearray([addr,val])
+        address &= 0x7F
+        shadowed = self._shadowActive and not _VOLATILE[address]
+        if shadowed and self._known[address] and self._shadow[address] == val:
+            return # no change
+        
+        buf = self._cmd
+        buf[0] = addr
+        buf[1] = val
                            
         with BOARD.spidev as spidev:
             spidev.write(buf, end=2)
 
+        if shadowed:
+            self._shadow[address] = val
+            self._known[address] = 1
+
     def reset(self) -> None:
         """Perform a reset of the chip."""
         # See section 7.2.2 of the datasheet for reset description.
         log.info(f"resetting RFM9x")
+        # registers return to their power on values
+        self.invalidate_registers()
+        self._shadowActive = False
+        self.mode = None
+        self.profile = None  # last RadioProfile written, see set_profile()
         if BOARD.RST is not None:
             BOARD.RST.value = False  # Set Reset Low
             time.sleep(0.0001)  # 100 us
@@ -239,11 +341,16 @@ class LoRa(object):
         """ Set the mode
         mode reg bit 7 can only be changed in SLEEP mode. If the bit is about to be changed
         switch to SLEEP first
+
+        The mode is written without reading it back. The cached mode (self.mode) is used to
+        decide if the SLEEP hop is needed and the documented transition times, not polling,
+        to wait for the chip. Set verify_mode to check every change on the chip.
         :param mode: Set the mode. Use constants.MODE class
         :return:    New mode
         """
         # the mode is backed up in self.mode
-        if mode == self.mode:
+        current = self.mode
+        if mode == current and mode not in _SELF_ENDING_MODES:
             return mode
         
         if self.verbose:
@@ -253,33 +360,50 @@ class LoRa(object):
                 #
                 raise Exception(f"set_mode KeyError mode requested {hex(mode)}")
  
+        if current is None:
+            current = self.get_mode()
+
         # check if bit 7 of the mode register is about to change
-        current_mode_long_range=self.get_mode() & 0x80
-        req_mode_long_range=mode & 0x80
-        
-        if current_mode_long_range!=req_mode_long_range:
-            # mode is requesting a bit 7 change which can only be done from SLEEP mode first
-            self._write_u8(REG.LORA.OP_MODE, MODE.SLEEP)
-            while not self.mode_ready(MODE.SLEEP):
-                time.sleep(0.0001)
+        if (current ^ mode) & 0x80:
+            # mode is requesting a bit 7 change which can only be done from SLEEP mode.
+            # SLEEP in the current modulation, change the bit while asleep, then set the mode
+            self._set_op_mode(current & 0x88)
+            current = mode & 0x88
+            self._set_op_mode(current)
+            # the register map is different in FSK and LoRa mode
+            self.invalidate_registers()
  
-        # set the mode
-        self._write_u8(REG.LORA.OP_MODE, mode)
-        while not self.mode_ready(mode):
-            time.sleep(0.0001) # mode change can take a short time
+        # set the mode, unless the SLEEP hop already did
+        if mode != current:
+            self._set_op_mode(mode)
+            if current & 0x07 == 0 and mode & 0x07 != 0:
+                time.sleep(_OSC_STARTUP)
         
         self.mode=mode
+        self._shadowActive = self.register_shadow and (mode & 0x80) != 0
         return mode
 
-    def write_payload(self, payload):
+    def _set_op_mode(self, mode):
+        """ write the OP_MODE register, reading it back until it matches if verify_mode is set
+        :param mode: register value
+        """
+        self._write_u8(REG.LORA.OP_MODE, mode)
+        if self.verify_mode:
+            while not self.mode_ready(mode):
+                time.sleep(0.0001) # mode change can take a short time
+
+    def write_payload(self, payload, payload_size=None):
         """ Get FIFO ready for TX: Set FifoAddrPtr to FifoTxBaseAddr. The transceiver is put into STDBY mode.
-        :param payload: Payload to write (list)
+        :param payload: Payload to write (list, bytearray or memoryview)
+        :param payload_size: number of bytes of payload to write. Default is len(payload). Allows a
+                             frame to be encoded into a larger, re-used, buffer and written without copying
         :return:    Written payload
         """
-        payload_size = len(payload)
-        assert payload_size<252,"payload size cannot exceed 252 bytes"
+        if payload_size is None:
+            payload_size = len(payload)
+        assert payload_size<=255,"payload size cannot exceed 255 bytes"
         
-        log.debug(f"write_payload {list(payload)}")
+        log.debug(f"write_payload {payload_size} bytes")
         
         self.set_mode(MODE.STDBY) # if needed
         base_addr = self.get_fifo_tx_base_addr()
@@ -297,28 +421,43 @@ class LoRa(object):
         self.set_fifo_addr_ptr(base_addr)
 
     def rx_is_good(self):
-        """ Check the IRQ flags for RX errors
+        """ Check the IRQ flags for RX errors, before RxDone is cleared.
+        True only if RxDone is set and neither PayloadCrcError nor RxTimeout is.
+        (It used to test the flags as a dict and so failed every good packet.)
         :return: True if no errors
         :rtype: bool
         """
-        flags = self.get_irq_flags()
-        return not any([flags[s] for s in ['valid_header', 'crc_error', 'rx_done', 'rx_timeout']])
+        flags = self.get_irq()
+        return (flags & IRQ.RX_DONE) != 0 and (flags & (IRQ.PAYLOAD_CRC_ERROR | IRQ.RX_TIMEOUT)) == 0
 
     def read_payload(self , nocheck = False):
         """ Read the payload from FIFO
-        :param nocheck: If True then check rx_is_good()
-        :return: Payload
-        :rtype: list[int]
+        :param nocheck: If False then check rx_is_good() first
+        :return: Payload, a new bytearray. See read_payload_into() to avoid the allocation
+        :rtype: bytearray
+        """
+        payload = self.read_payload_into(nocheck=nocheck)
+        if payload is None:
+            return None
+        return bytearray(payload)
+
+    def read_payload_into(self, buf=None, nocheck=False):
+        """ Read the last received packet from the FIFO without allocating
+        :param buf: buffer of at least 256 bytes, default is the radio's rx_buffer which is
+                    overwritten by the next call
+        :param nocheck: If False then check rx_is_good() first
+        :return: memoryview of the packet in buf, None if the check fails
         """
         if not nocheck and not self.rx_is_good():
             return None
+        if buf is None:
+            buf = self.rx_buffer
         rx_nb_bytes = self.get_rx_nb_bytes()
         fifo_rx_current_addr = self.get_fifo_rx_current_addr()
         self.set_fifo_addr_ptr(fifo_rx_current_addr)
 
-        payload = bytearray([0] * rx_nb_bytes)
-        self._read_into(REG.LORA.FIFO,payload)
-        return payload
+        self._read_into(REG.LORA.FIFO, buf, rx_nb_bytes)
+        return memoryview(buf)[:rx_nb_bytes]
 
     def get_freq(self): 
         """
@@ -357,14 +496,12 @@ class LoRa(object):
         434,868 or 915. Driving at a frequency other than spec MAY work but will be sub-optimal
         thus affecting range.
         """
-        if val < 240 or val > 960:
-            raise RuntimeError("frequency_mhz must be between 240 and 960")
-        # Calculate FRF register 24-bit value.
-        frf = int((val * 1000000.0) / _RH_RF95_FSTEP) & 0xFFFFFF
+        # Calculate FRF register 24-bit value, raises RuntimeError if out of range
+        f = frf(val)
         # Extract byte values and update registers.
-        msb = frf >> 16
-        mid = (frf >> 8) & 0xFF
-        lsb = frf & 0xFF
+        msb = f >> 16
+        mid = (f >> 8) & 0xFF
+        lsb = f & 0xFF
         
         self._write_u8(REG.LORA.FR_MSB, msb)
         self._write_u8(REG.LORA.FR_MID, mid)
@@ -373,6 +510,34 @@ class LoRa(object):
         # make sure the registers were set correctly
         self.check_freq(msb,mid,lsb)    
 
+    def set_profile(self, profile):
+        """
+        program a RadioProfile (frequency, SF, BW, power, IQ and sync word) in one go.
+
+        Each run of consecutive registers in the profile is written as one SPI burst.
+        With the register shadow active, registers already holding the wanted value are
+        trimmed from the ends of a run and a run which hasn't changed at all is skipped,
+        so switching between profiles which share a channel costs one or two transfers.
+
+        The radio should be in SLEEP or STDBY mode.
+
+        :param profile: RadioProfile
+        """
+        shadow = self._shadow
+        known = self._known
+        for address, values in profile.bursts:
+            first = 0
+            last = len(values)
+            if self._shadowActive:
+                while first < last and known[address + first] and shadow[address + first] == values[first]:
+                    first += 1
+                while last > first and known[address + last - 1] and shadow[address + last - 1] == values[last - 1]:
+                    last -= 1
+                if first == last:
+                    continue
+            self._write_from(address + first, memoryview(values)[first:last])
+        self.profile = profile
+
     def get_pa_config(self, convert_dBm=False):
         v = self._read_u8(REG.LORA.PA_CONFIG)
         pa_select    = v >> 7
@@ -529,8 +694,23 @@ class LoRa(object):
         self._write_u8(REG.LORA.IRQ_FLAGS_MASK, v)
         return self._read_u8(REG.LORA.IRQ_FLAGS_MASK)
 
+    def get_irq(self):
+        """
+        :return: the IRQ_FLAGS register as an int, test it with the IRQ masks e.g. flags & IRQ.RX_DONE
+        """
+        return self._read_u8(REG.LORA.IRQ_FLAGS)
+
+    def clear_irq(self, mask=IRQ.ALL):
+        """
+        clear IRQ flags with a single register write (flags are cleared by writing 1)
+
+        :param mask: IRQ masks or'd together e.g. IRQ.RX_DONE | IRQ.RX_TIMEOUT
+        """
+        self._write_u8(REG.LORA.IRQ_FLAGS, mask)
+
     def get_irq_flags(self):
-        v = self._read_u8(REG.LORA.IRQ_FLAGS)
+        """ the IRQ flags as a dict, for debugging. Use get_irq() when polling """
+        v = self.get_irq()
         return dict(
                 rx_timeout     = v >> 7 & 0x01,
                 rx_done        = v >> 6 & 0x01,
@@ -569,24 +749,16 @@ class LoRa(object):
                         RxTimeout=None, RxDone=None, PayloadCrcError=None, 
                         ValidHeader=None, TxDone=None, CadDone=None, 
                         FhssChangeChannel=None, CadDetected=None):
-        
-        values={'RxTimeout':RxTimeout,
-             'RxDone':RxDone,
-             'PayloadCrcError':PayloadCrcError,
-             'ValidHeader':ValidHeader,
-             'TxDone':TxDone,
-             'CadDone':CadDone,
-             'FhssChangeChannel':FhssChangeChannel,
-             'CadDetected':CadDetected}
+        """ keyword version of clear_irq(), returns the flags left set """
         v = 0
-        for i, s in enumerate(['CadDetected', 'FhssChangeChannel', 'CadDone', 
-                                'TxDone', 'ValidHeader', 'PayloadCrcError', 
-                                'RxDone', 'RxTimeout']):
-            this_bit = values[s]
-            if this_bit is not None:
-                v = set_bit(v, eval('MASK.IRQ_FLAGS.' + s), this_bit)
-        self._write_u8(REG.LORA.IRQ_FLAGS,v)
-        return self._read_u8(REG.LORA.IRQ_FLAGS)
+        for flag, mask in ((RxTimeout, IRQ.RX_TIMEOUT), (RxDone, IRQ.RX_DONE),
+                           (PayloadCrcError, IRQ.PAYLOAD_CRC_ERROR), (ValidHeader, IRQ.VALID_HEADER),
+                           (TxDone, IRQ.TX_DONE), (CadDone, IRQ.CAD_DONE),
+                           (FhssChangeChannel, IRQ.FHSS_CHANGE_CHANNEL), (CadDetected, IRQ.CAD_DETECTED)):
+            if flag:
+                v |= mask
+        self.clear_irq(v)
+        return self.get_irq()
 
     def get_rx_nb_bytes(self):
         return self._read_u8(REG.LORA.RX_NB_BYTES)
@@ -0,0 +1,223 @@
+"""
+RadioProfile.py
+
+The LoRa register values for one radio configuration (frequency, SF, BW, TX power,
+IQ inversion and sync word) worked out once, when the profile is created, and
+grouped into runs of consecutive registers so LoRa.set_profile() can write each
+run as a single SPI burst.
+
+Profiles are immutable so a handler can keep one per channel/data rate and re-use
+it for every transmission. A ProfileTable does that for a whole frequency plan:
+the FRF bytes of every channel and the modem config bytes of every data rate are
+worked out once so choosing a profile is an index lookup.
+"""
+from .constants import REG, CODING_RATE
+from .AirTime import symbol_time, low_data_rate_optimize, time_on_air
+
+_FXOSC = 32000000.0
+_FSTEP = _FXOSC / 524288 # The Frequency Synthesizer step = FXOSC / 2^^19
+
+# RX windows are opened this many seconds early to allow for timing errors. The
+# RX single symbol timeout keeps the receiver on long enough to cover it either side
+RX_WINDOW_MARGIN = 0.02
+# and long enough to detect the preamble
+RX_MIN_SYMBOLS = 8
+
+def frf(freq):
+    """
+    convert a frequency to the 24 bit FRF register value
+
+    :param freq: MHz
+    :return: int
+    """
+    if freq < 240 or freq > 960:
+        raise RuntimeError("frequency_mhz must be between 240 and 960")
+    return int((freq * 1000000.0) / _FSTEP) & 0xFFFFFF
+
+def frf_bytes(freq):
+    """
+    :param freq: MHz
+    :return: bytes FR_MSB, FR_MID, FR_LSB
+    """
+    f = frf(freq)
+    return bytes((f >> 16, (f >> 8) & 0xFF, f & 0xFF))
+
+def rx_symbol_timeout(sf, bw, margin=RX_WINDOW_MARGIN):
+    """
+    the RX single mode timeout for an RX window opened margin seconds early
+
+    :param sf: spreading factor 6..12
+    :param bw: BW register value 0..9
+    :return: symbols, 10 bits
+    """
+    symbols = RX_MIN_SYMBOLS + int(2 * margin / symbol_time(sf, bw) + 0.999)
+    return min(symbols, 0x3FF)
+
+def modem_bytes(sf, bw, coding_rate=CODING_RATE.CR4_5, rx_crc=1, symb_timeout=None):
+    """
+    :param sf: spreading factor 6..12
+    :param bw: BW register value 0..9
+    :param symb_timeout: RX single mode timeout, None for rx_symbol_timeout(sf, bw)
+    :return: bytes MODEM_CONFIG_1, MODEM_CONFIG_2, SYMB_TIMEOUT_LSB, MODEM_CONFIG_3
+    """
+    if symb_timeout is None:
+        symb_timeout = rx_symbol_timeout(sf, bw)
+    return bytes((
+        (bw << 4) | (coding_rate << 1),  # explicit header mode
+        (sf << 4) | (rx_crc << 2) | ((symb_timeout >> 8) & 0x03),
+        symb_timeout & 0xFF,
+        (low_data_rate_optimize(sf, bw) << 3) | 0x04,  # AGC auto on
+        ))
+
+def _bursts(regs):
+    """
+    group register values into runs of consecutive addresses
+
+    :param regs: dict of address: value
+    :return: tuple of (start address, bytes)
+    """
+    runs = []
+    start = None
+    values = None
+    for address in sorted(regs):
+        if start is not None and address == start + len(values):
+            values.append(regs[address])
+            continue
+        if start is not None:
+            runs.append((start, bytes(values)))
+        start = address
+        values = bytearray([regs[address]])
+    if start is not None:
+        runs.append((start, bytes(values)))
+    return tuple(runs)
+
+class RadioProfile:
+
+    __slots__ = ("freq", "sf", "bw", "coding_rate", "crc", "invert_iq", "bursts", "rx")
+
+    def __init__(self, freq, sf, bw, max_power=7, output_power=15, pa_select=1, invert_iq=0,
+                 sync_word=None, coding_rate=CODING_RATE.CR4_5, rx_crc=1, symb_timeout=None,
+                 frf_regs=None, modem_regs=None):
+        """
+        :param freq: MHz
+        :param sf: spreading factor 6..12
+        :param bw: BW register value 0..9 (see constants.BW)
+        :param max_power: PA_CONFIG MaxPower 0..7
+        :param output_power: PA_CONFIG OutputPower 0..15
+        :param pa_select: 0->RFO, 1->PA_BOOST
+        :param invert_iq: 1 to receive downlinks (gateways invert IQ), 0 to transmit
+        :param sync_word: None to leave the sync word register alone
+        :param coding_rate: 1..4 (4/5..4/8)
+        :param rx_crc: 1 to enable the payload CRC
+        :param symb_timeout: RX single mode timeout in symbols, 10 bits. None to work it out from sf and bw
+        :param frf_regs: precomputed frf_bytes(freq), see ProfileTable
+        :param modem_regs: precomputed modem_bytes(sf, bw, ...), see ProfileTable
+        """
+        self.freq = freq
+        self.sf = sf
+        self.bw = bw
+        self.coding_rate = coding_rate
+        self.crc = rx_crc
+        self.invert_iq = invert_iq
+        self.rx = None  # the IQ inverted twin, used to listen on the same channel after transmitting
+
+        if frf_regs is None:
+            frf_regs = frf_bytes(freq)
+        if modem_regs is None:
+            modem_regs = modem_bytes(sf, bw, coding_rate, rx_crc, symb_timeout)
+
+        regs = {
+            REG.LORA.FR_MSB: frf_regs[0],
+            REG.LORA.FR_MID: frf_regs[1],
+            REG.LORA.FR_LSB: frf_regs[2],
+            REG.LORA.PA_CONFIG: (pa_select << 7) | (max_power << 4) | output_power,
+            REG.LORA.MODEM_CONFIG_1: modem_regs[0],
+            REG.LORA.MODEM_CONFIG_2: modem_regs[1],
+            REG.LORA.SYMB_TIMEOUT_LSB: modem_regs[2],
+            REG.LORA.MODEM_CONFIG_3: modem_regs[3],
+            # bit 6 inverts IQ on receive, bit 0 (set) leaves transmit normal
+            REG.LORA.INVERT_IQ: 0x27 | ((invert_iq & 1) << 6),
+            REG.LORA.INVERT_IQ2: 0x19 if invert_iq else 0x1D,
+            }
+        if sync_word is not None:
+            regs[REG.LORA.SYNC_WORD] = sync_word
+
+        self.bursts = _bursts(regs)
+
+    def time_on_air(self, length):
+        """
+        :param length: PHY payload length in bytes
+        :return: seconds to transmit it with this profile
+        """
+        return time_on_air(length, self.sf, self.bw, self.coding_rate, crc=self.crc)
+
+    def __repr__(self):
+        return f"RadioProfile(freq={self.freq} sf={self.sf} bw={self.bw} invert_iq={self.invert_iq})"
+
+def profile_pair(freq, sf, bw, **kwargs):
+    """
+    :return: the transmit RadioProfile for a channel with its .rx (IQ inverted) twin
+    """
+    tx = RadioProfile(freq, sf, bw, invert_iq=0, **kwargs)
+    rx = RadioProfile(freq, sf, bw, invert_iq=1, **kwargs)
+    tx.rx = rx
+    rx.rx = rx
+    return tx
+
+class ProfileTable:
+    """
+    the radio profiles for a list of channel frequencies and a frequency plan's data rates
+
+    The FRF bytes for every channel and modem config bytes for every data rate are
+    calculated when the table is made. Profiles are built from them on first use,
+    a RadioProfile for every channel and data rate of a plan would take several kB
+    of RAM, and kept in a flat list indexed by channel * number of data rates + DR.
+    """
+
+    def __init__(self, freqs, dataRates, invert_iq=0, **kwargs):
+        """
+        :param freqs: list of channel frequencies (MHz)
+        :param dataRates: list of (sf, bw) indexed by DR
+        :param invert_iq: 0 for uplink channels (profiles get an .rx twin), 1 for downlink only channels
+        :param kwargs: power, sync word etc, see RadioProfile
+        """
+        coding_rate = kwargs.get("coding_rate", CODING_RATE.CR4_5)
+        rx_crc = kwargs.get("rx_crc", 1)
+        symb_timeout = kwargs.get("symb_timeout")
+        self.freqs = tuple(freqs)
+        self.dataRates = tuple((sf, bw) for sf, bw in dataRates)
+        self.invert_iq = invert_iq
+        self.kwargs = kwargs
+        self.numDR = len(self.dataRates)
+
+        self.frf = bytearray(3 * len(self.freqs))
+        for ch, freq in enumerate(self.freqs):
+            self.frf[3 * ch:3 * ch + 3] = frf_bytes(freq)
+
+        self.modem = bytearray(4 * self.numDR)
+        for dr, (sf, bw) in enumerate(self.dataRates):
+            self.modem[4 * dr:4 * dr + 4] = modem_bytes(sf, bw, coding_rate, rx_crc, symb_timeout)
+
+        self.profiles = [None] * (len(self.freqs) * self.numDR)
+
+    def get(self, channel, dr):
+        """
+        :param channel: index into freqs
+        :param dr: data rate index
+        :return: RadioProfile
+        """
+        i = channel * self.numDR + dr
+        profile = self.profiles[i]
+        if profile is None:
+            sf, bw = self.dataRates[dr]
+            frfRegs = self.frf[3 * channel:3 * channel + 3]
+            modemRegs = self.modem[4 * dr:4 * dr + 4]
+            if self.invert_iq:
+                profile = RadioProfile(self.freqs[channel], sf, bw, invert_iq=1,
+                                       frf_regs=frfRegs, modem_regs=modemRegs, **self.kwargs)
+                profile.rx = profile
+            else:
+                profile = profile_pair(self.freqs[channel], sf, bw,
+                                       frf_regs=frfRegs, modem_regs=modemRegs, **self.kwargs)
+            self.profiles[i] = profile
+        return profile
@@ -1,6 +1,10 @@
 """ Defines the MCUclass that contains the board pin mappings.
 
-NOTE: DIO pins are not used because the code polls the IRQ register after TX and during RX
+NOTE: DIO0 (TxDone/RxDone) and DIO1 (RxTimeout) are optional. When they are wired and listed
+in settings.json the handler waits on them instead of polling the IRQ register over SPI.
+keypad is used, if the firmware has it, to watch the pins in the background so the line
+going high is not missed while the MCU sleeps. keypad, unlike countio, also reports a line
+which was already high when dio_clear() was called.
 
 """
 import board
@@ -12,6 +16,14 @@ import digitalio
 import busio
 from adafruit_bus_device.spi_device import SPIDevice
 
+try:
+    import keypad
+except ImportError:
+    keypad = None # DIO pins are read as digital inputs
+
+# seconds between keypad scans of the DIO pins
+DIO_SCAN_INTERVAL = 0.001
+
 class MCU():
     """ Board initialisation/teardown and pin configuration is kept here."""
     
@@ -34,6 +46,15 @@ class MCU():
         else:
             MCU.RST=None
 
+        # rfm95 DIO0 and DIO1 (optional)
+        MCU.DIO=[None,None]
+        MCU.DIO_FIRED=[False,False]  # a keypad press event has been seen since dio_clear()
+        for n in range(2):
+            name=f"DIO{n}"
+            if name in Board and Board[name][:2]=="GP":
+                MCU.DIO[n]=MCU._dio_pin(getattr(board, Board[name]))
+                log.info(f"{name} on {Board[name]}")
+
         # SPI
         try:
             SPI_CLK = getattr(board, Board["SPI_CLK"])
@@ -62,6 +83,54 @@ class MCU():
             log.info("MCU Device setup finished")
 
 
+    @staticmethod
+    def _dio_pin(pin):
+        """a keypad scanner if possible, otherwise a plain input"""
+        if keypad is not None:
+            try:
+                return keypad.Keys((pin,), value_when_pressed=True, pull=False, interval=DIO_SCAN_INTERVAL)
+            except (ValueError, RuntimeError) as e:
+                log.warning(f"{pin} can't be scanned ({e}), read as a digital input")
+        dio = digitalio.DigitalInOut(pin)
+        dio.direction = digitalio.Direction.INPUT
+        return dio
+
+    @staticmethod
+    def dio_available(n):
+        """True if DIOn is wired and configured in settings.json"""
+        return MCU.DIO[n] is not None
+
+    @staticmethod
+    def dio_clear(n):
+        """
+        forget any earlier events on DIOn, call before starting the radio operation
+        it signals. A line already high is reported again by the next scan
+        """
+        dio = MCU.DIO[n]
+        MCU.DIO_FIRED[n] = False
+        if dio is not None and not isinstance(dio, digitalio.DigitalInOut):
+            dio.events.clear()
+            dio.reset()  # assume released, so a pin held high gives a new press event
+
+    @staticmethod
+    def dio_fired(n):
+        """
+        :return: True if DIOn has been high since dio_clear(), whether it went
+                 high before or after. The radio holds the pin high until the
+                 IRQ flag mapped to it is cleared.
+        """
+        dio = MCU.DIO[n]
+        if isinstance(dio, digitalio.DigitalInOut):
+            return dio.value
+        if not MCU.DIO_FIRED[n]:
+            event = dio.events.get()
+            while event is not None:
+                if event.pressed:
+                    MCU.DIO_FIRED[n] = True
+                    break
+                event = dio.events.get()
+        return MCU.DIO_FIRED[n]
+
     @staticmethod
     def led_on(value=1):
         """ Switch the proto shields LED
@@ -118,6 +118,19 @@ class MASK:
         CadDetected         = 0
 
 
+class IRQ:
+    """ IRQ_FLAGS register bit masks for LoRa.get_irq()/clear_irq() """
+    RX_TIMEOUT          = 1 << MASK.IRQ_FLAGS.RxTimeout
+    RX_DONE             = 1 << MASK.IRQ_FLAGS.RxDone
+    PAYLOAD_CRC_ERROR   = 1 << MASK.IRQ_FLAGS.PayloadCrcError
+    VALID_HEADER        = 1 << MASK.IRQ_FLAGS.ValidHeader
+    TX_DONE             = 1 << MASK.IRQ_FLAGS.TxDone
+    CAD_DONE            = 1 << MASK.IRQ_FLAGS.CadDone
+    FHSS_CHANGE_CHANNEL = 1 << MASK.IRQ_FLAGS.FhssChangeChannel
+    CAD_DETECTED        = 1 << MASK.IRQ_FLAGS.CadDetected
+    ALL                 = 0xFF
+
+
 class REG:
 
     @add_lookup
@@ -156,8 +169,10 @@ class REG:
         MODEM_CONFIG_3     = 0x26
         PPM_CORRECTION     = 0x27
         FEI_MSB            = 0x28
+        RSSI_WIDEBAND      = 0x2C
         DETECT_OPTIMIZE    = 0X31
         INVERT_IQ          = 0x33
+        INVERT_IQ2         = 0x3B
         DETECTION_THRESH   = 0X37
         SYNC_WORD          = 0X39
         IRQ_FLAGS1         = 0x3E
@@ -192,5 +207,6 @@ class REG:
         PACKET_CONFIG_1    = 0x30
         FIFO_THRESH        = 0x35
         IMAGE_CAL          = 0x3B
+        TEMP               = 0x3C
         DIO_MAPPING_1      = 0x40
         DIO_MAPPING_2      = 0x41
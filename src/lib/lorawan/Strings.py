@@ -27,6 +27,7 @@ JOIN_TIMEOUT="join_timeout"
 
 RX_WINDOW="rx_window" # duration
 RX1_DR="rx1_DR"
+RX1_DR_OFFSET="rx1_DR_offset" # RX1DROffset from the join accept or RXParamSetupReq
 RX2_DR="rx2_DR"
 RX1_FREQUENCY="rx1_frequency"
 RX1_FREQ_FIXED="rx1_freq_fixed"
@@ -44,6 +45,10 @@ DUTY_CYCLE="duty_cycle"
 DUTY_CYCLE_RANGE="duty_cycle_range"
 DUTY_CYCLE_TABLE="duty_cycle_table"
 MAX_DUTY_CYCLE="max_duty_cycle"
+DUTY_CYCLE_LEDGER="duty_cycle_ledger" # airtime per sub-band, see DutyCycle.py
+FAIR_USE="fair_use" # 1 to keep uplinks within the TTN fair use policy, see FairUse.py
+FAIR_USE_LEDGER="fair_use_ledger"
+FAIR_USE_DR="fair_use_dr" # fastest data rate a queued uplink may use to stay within the fair use airtime, -1 never
 
 SF_RANGE="sf_range"
 DEVADDR="devaddr"
@@ -64,9 +69,11 @@ CH_MASK="ch_Mask"
 CH_MASK_CTL="ch_Mask_Ctrl"
 NB_TRANS="nb_Trans"
 RX_CRC="rx_crc"
+LBT="listen_before_talk" # 1 to check for channel activity (CAD) before transmitting
 
 DATA_RATES="data_rates"
 DATA_RATE="data_rate"
+MAX_PAYLOAD="max_payload" # largest FRMPayload (N) indexed by DR
 ADR_DATA_RATE="ADR_data_rate"
 BANDWIDTHS="bandwidths"
 MAX_CHANNELS="max_channels"
@@ -0,0 +1,111 @@
+"""
+UplinkQueue.py
+
+Uplinks waiting to be sent by Handler.sendQueued(), highest priority first.
+Uplinks of the same priority are sent in the order they were queued.
+
+An uplink can have a deadline, after which it is dropped unsent, and a key.
+Queuing an uplink with the same key as one still waiting replaces the waiting
+one, so only the latest e.g. sensor reading is sent.
+"""
+from LogManager import LogMan
+log=LogMan.getLogger("UplinkQueue") # uses the default log level
+
+import time
+
+class Uplink:
+
+    __slots__ = ("message", "port", "priority", "deadline", "key", "dr")
+
+    def __init__(self, message, port=1, priority=0, deadline=None, key=None):
+        """
+        :param message: bytes to send
+        :param port: FPort 1..223
+        :param priority: higher values are sent first
+        :param deadline: time.monotonic() value after which the uplink is dropped, None to keep it till sent
+        :param key: uplinks with the same key replace each other, None to always queue
+        """
+        self.message = message
+        self.port = port
+        self.priority = priority
+        self.deadline = deadline
+        self.key = key
+        self.dr = None      # set by Handler.nextSendTime() to send faster than the current data rate
+
+    def __repr__(self):
+        return f"Uplink(port={self.port} priority={self.priority} len={len(self.message)} key={self.key})"
+
+class UplinkQueue:
+
+    def __init__(self, maxLength=8):
+        """
+        :param maxLength: most uplinks kept. When full a new uplink replaces the
+                          lowest priority one, if that is lower than its own
+        """
+        self.maxLength = maxLength
+        self.uplinks = []   # sorted, highest priority first
+
+    def __len__(self):
+        return len(self.uplinks)
+
+    def put(self, uplink):
+        """
+        queue an uplink
+
+        :param uplink: Uplink
+        :return: True if queued, False if the queue is full of higher priority uplinks
+        """
+        uplinks = self.uplinks
+
+        if uplink.key is not None:
+            for i, waiting in enumerate(uplinks):
+                if waiting.key == uplink.key:
+                    log.debug(f"{uplink} replaces {waiting}")
+                    del uplinks[i]
+                    break
+
+        if len(uplinks) >= self.maxLength:
+            # the last entry is the lowest priority, most recently queued
+            if uplinks[-1].priority >= uplink.priority:
+                log.warning(f"uplink queue full, {uplink} dropped")
+                return False
+            log.warning(f"uplink queue full, {uplinks[-1]} dropped")
+            uplinks.pop()
+
+        # after any of the same priority
+        i = len(uplinks)
+        while i > 0 and uplinks[i - 1].priority < uplink.priority:
+            i -= 1
+        uplinks.insert(i, uplink)
+        return True
+
+    def expire(self, now=None):
+        """
+        drop uplinks whose deadline has passed
+
+        :param now: time.monotonic() value, default is now
+        :return: number of uplinks dropped
+        """
+        if now is None:
+            now = time.monotonic()
+        before = len(self.uplinks)
+        self.uplinks = [u for u in self.uplinks if u.deadline is None or u.deadline >= now]
+        dropped = before - len(self.uplinks)
+        if dropped:
+            log.info(f"{dropped} expired uplinks dropped")
+        return dropped
+
+    def peek(self):
+        """
+        :return: the next Uplink to send or None
+        """
+        return self.uplinks[0] if self.uplinks else None
+
+    def pop(self):
+        """
+        :return: the next Uplink to send, removed from the queue, or None
+        """
+        return self.uplinks.pop(0) if self.uplinks else None
+
+    def clear(self):
+        self.uplinks = []